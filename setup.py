@@ -65,8 +65,7 @@ setup(
         # eg: "aspectlib==1.1.1", "six>=1.7",
     ],
     extras_require={
-        # eg:
-        #   "rst": ["docutils>=0.11"],
-        #   ":python_version=='3.8'": ["backports.zoneinfo"],
+        'zstd': ['zstandard'],
+        'msgpack': ['msgpack'],
     },
 )
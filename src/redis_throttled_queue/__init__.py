@@ -1,26 +1,241 @@
+import asyncio
+import heapq
+from collections import deque
+from collections.abc import Mapping
+from enum import Enum
 from enum import IntEnum
+from hashlib import blake2b
 from logging import getLogger
+from math import ceil
+from operator import itemgetter
 from pathlib import Path
+from time import perf_counter
 from time import time
+from typing import AsyncIterator
+from typing import Awaitable
+from typing import Callable
+from typing import Iterable
+from typing import Iterator
+from typing import NamedTuple
+from typing import Optional
 from typing import Union
 
 from packaging.version import Version
 from redis.asyncio import StrictRedis as AsyncStrictRedis
+from redis.asyncio.cluster import RedisCluster as AsyncRedisCluster
 from redis.client import StrictRedis
+from redis.cluster import RedisCluster
+
+from .codec import Codec
+from .metrics import Metrics
 
 __version__ = '1.0.0'
 __file_as_path__ = Path(__file__)
 
 logger = getLogger(__name__)
 
+#: Highest weight that can be given to a name (see ``ThrottledQueue.set_weights``).
+MAX_WEIGHT = 10000
+#: Highest class that can be given to a name (see ``ThrottledQueue.set_classes``).
+MAX_CLASS = 15
+
 
 class Resolution(IntEnum):
     SECOND = 1
     MINUTE = 60
 
 
+class Strategy(Enum):
+    """
+    Throttling strategy:
+
+    * ``FIXED_WINDOW``: names get up to `limit` items in every window (could be `2 * limit` items close together around
+      the end of a window and the start of the next one).
+    * ``GCRA``: names get an item every ``resolution / limit`` seconds (with `burst` items allowed at once after being
+      idle), thus the items are spread evenly. The `window` argument is ignored.
+    """
+
+    FIXED_WINDOW = 'fixed-window'
+    GCRA = 'gcra'
+
+
+class PopStatus(IntEnum):
+    EMPTY = 0
+    ITEM = 1
+    THROTTLED = 2
+
+
+class PopResult(NamedTuple):
+    """
+    Result of ``pop_ex``. Depending on the `status` you get:
+
+    * ``PopStatus.ITEM``: the `value`, `name` and `priority` of the item.
+    * ``PopStatus.THROTTLED``: the `retry_after` seconds (until the current window ends, or until the first delayed item is
+      due if that's sooner).
+    * ``PopStatus.EMPTY``: the `retry_after` seconds until the first delayed item is due, if there are any.
+    """
+
+    status: PopStatus
+    value: Union[str, bytes, None] = None
+    name: Union[str, bytes, None] = None
+    priority: Optional[float] = None
+    retry_after: Optional[float] = None
+
+
+class QueueStats(NamedTuple):
+    """
+    Result of ``stats``:
+
+    * `total`: the count of items in the queue.
+    * `active_names`: the count of names that have items.
+    * `by_depth`: ``(name, item count)`` tuples for the names with most items.
+    * `by_usage`: ``(name, items popped)`` tuples for the most used names in the window.
+    """
+
+    total: int
+    active_names: int
+    by_depth: list
+    by_usage: list
+
+
 LIBRARY = __file_as_path__.with_name('library.lua').read_text()
 
+PushItems = Union[Iterable[tuple], Mapping]
+
+
+def _push_many_args(items: PushItems, item_args: Optional[Callable] = None) -> list:
+    """
+    Flattens the `items` given to ``push_many`` into ``RTQ_PUSH_MANY`` arguments (the data is converted to the ``DATA``
+    and ``BODY`` arguments by `item_args`, if given).
+
+    Accepts an iterable of ``(name, data)``, ``(name, data, priority)`` or ``(name, data, priority, cost)`` tuples, or a
+    mapping of ``name`` to an iterable of ``data``, ``(data, priority)`` or ``(data, priority, cost)`` tuples.
+    """
+    if isinstance(items, Mapping):
+        items = ((name, *entry) if isinstance(entry, tuple) else (name, entry) for name, entries in items.items() for entry in entries)
+    args = []
+    for item in items:
+        if len(item) == 4:
+            name, data, priority, cost = item
+            _check_cost(cost)
+        elif len(item) == 3:
+            name, data, priority = item
+            cost = 1
+        else:
+            name, data = item
+            priority = 0
+            cost = 1
+        if (b':' if isinstance(name, bytes) else ':') in name:
+            raise ValueError('Incorrect value for `key`. Cannot contain ":".')
+        data, body = (data, '') if item_args is None else item_args(data)
+        args.extend((name, priority, data, cost, body))
+    return args
+
+
+def _limits_args(limits: Mapping, field: str = 'limit', maximum: Optional[int] = None, minimum: int = 0) -> tuple:
+    """
+    Splits the `limits` given to ``set_limits`` (or ``set_weights``, ``set_classes``) in a dict of values to set and a
+    list of names to reset.
+    """
+    updates = {}
+    removals = []
+    for name, limit in limits.items():
+        if limit is None:
+            removals.append(name)
+        elif maximum is None and (not isinstance(limit, int) or limit < minimum):
+            raise ValueError(f'Incorrect value for `{field}` of {name!r}. Must be a non-negative integer or None, not {limit!r}.')
+        elif maximum is not None and (not isinstance(limit, int) or not minimum <= limit <= maximum):
+            raise ValueError(
+                f'Incorrect value for `{field}` of {name!r}. Must be an integer from {minimum} to {maximum} or None, not {limit!r}.'
+            )
+        else:
+            updates[name] = limit
+    return updates, removals
+
+
+def _weights_args(weights: Mapping) -> tuple:
+    return _limits_args(weights, 'weight', MAX_WEIGHT, 1)
+
+
+def _classes_args(classes: Mapping) -> tuple:
+    return _limits_args(classes, 'class', MAX_CLASS)
+
+
+def _extract_result(result: list, decode: Optional[Callable] = None) -> list:
+    """
+    Converts the flat list returned by ``RTQ_EXTRACT`` into ``(name, item, priority)`` tuples (``(name, item, priority, cost)``
+    for the items that don't cost 1). The items are passed through `decode`, if given.
+    """
+    items = []
+    for i in range(0, len(result), 4):
+        name, item, priority, cost = result[i : i + 4]
+        if decode is not None:
+            item = decode(item)
+        cost = int(cost)
+        items.append((name, item, float(priority)) if cost == 1 else (name, item, float(priority), cost))
+    return items
+
+
+def _check_cost(cost: int):
+    if not isinstance(cost, int) or cost < 1:
+        raise ValueError(f'Incorrect value for `cost`. Must be a positive integer, not {cost!r}.')
+
+
+def _timestamp_ms(value: Optional[float], field: str) -> Union[int, str]:
+    """
+    Converts a timestamp (seconds since the epoch) to milliseconds, rounded up (``''`` for ``None``).
+    """
+    if value is None:
+        return ''
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError(f'Incorrect value for `{field}`. Must be a timestamp (seconds since the epoch) or None, not {value!r}.')
+    return ceil(value * 1000)
+
+
+def _check_batch(batch: int):
+    if not isinstance(batch, int) or batch < 1:
+        raise ValueError(f'Incorrect value for `batch`. Must be a positive integer, not {batch!r}.')
+
+
+def _is_cluster(redis_client) -> bool:
+    return isinstance(redis_client, (RedisCluster, AsyncRedisCluster))
+
+
+def _has_hash_tag(key: str) -> bool:
+    """
+    Checks if the `key` has a hash tag: a non-empty ``{...}`` section (only the first ``{`` counts).
+    """
+    start = key.find('{')
+    return start >= 0 and key.find('}', start + 1) > start + 1
+
+
+def _pop_many_result(result: list, with_names: bool, decode: Optional[Callable] = None) -> list:
+    """
+    Converts the flat ``NAME, ITEM`` list returned by ``RTQ_POP_MANY`` (the items are passed through `decode`, if given).
+    """
+    items = result[1::2] if decode is None else list(map(decode, result[1::2]))
+    if with_names:
+        return list(zip(result[::2], items))
+    else:
+        return items
+
+
+def _decodes_responses(redis_client) -> bool:
+    """
+    Checks if the `redis_client` was created with ``decode_responses=True``.
+    """
+    get_encoder = getattr(redis_client, 'get_encoder', None)
+    if get_encoder is not None:
+        return get_encoder().decode_responses
+    return getattr(redis_client, 'decode_responses', False)
+
+
+def _merge_top(pairs: list, result: list, top: int) -> list:
+    """
+    Merges the flat ``NAME, COUNT`` list returned by ``RTQ_STATS`` into the `pairs` and keeps the `top` ones.
+    """
+    return heapq.nlargest(top, [*pairs, *zip(result[::2], result[1::2])], key=itemgetter(1))
+
 
 class ThrottledQueue:
     """
@@ -32,8 +247,16 @@ class ThrottledQueue:
     """
 
     limit: int
-    resolution: int
+    resolution: Union[Resolution, float]
+    server_time: bool
+    metrics: Optional[Metrics]
+    page_size: int
+    cluster: bool
+    strategy: Strategy
+    burst: int
     last_activity: float
+    codec: Optional[Codec]
+    payload_threshold: Optional[int]
     _client: StrictRedis
     _library_missing: bool = True
 
@@ -45,25 +268,87 @@ class ThrottledQueue:
         resolution=Resolution.SECOND,
         validate_version=True,
         register_library=True,
+        page_size: int = 10,
+        cluster: Optional[bool] = None,
+        strategy: Strategy = Strategy.FIXED_WINDOW,
+        burst: int = 1,
+        server_time: bool = False,
+        metrics: Optional[Metrics] = None,
+        codec: Optional[Codec] = None,
+        payload_threshold: Optional[int] = None,
     ):
         """
         :param redis_client:
-            An instance of :class:`~StrictRedis`.
+            An instance of :class:`~StrictRedis` (or :class:`~redis.cluster.RedisCluster`).
         :param prefix:
             Redis key prefix.
         :param limit:
             Throttling limit. The queue won't retrieve more items in the given resolution for a given `key`.
+            This is the default, names can have their own limit (see ``set_limit``).
         :param resolution:
-            Resolution to use. This decides how many time window keys you will have in Redis.
+            Resolution to use. This decides how many time window keys you will have in Redis. Besides the
+            :class:`Resolution` values any number of seconds can be used (e.g.: ``0.2``), with a millisecond precision.
+        :param page_size:
+            How many names are read at a time when looking for a name to pop from. Another page is only read if all the
+            names in the page turned out to be empty.
+        :param cluster:
+            Use Redis Cluster compatible key names: the `prefix` gets wrapped in a hash tag (e.g.: ``'{myqueue}'``), unless it
+            already has one, so that all the keys of the queue are in the same slot. Autodetected from the `redis_client` type.
+        :param strategy:
+            Throttling strategy (see :class:`Strategy`). Don't change it for a queue that has items.
+        :param burst:
+            For the ``GCRA`` strategy: how many items a name can get at once after being idle.
+        :param server_time:
+            Compute the default window from the Redis server clock instead of the local one. Use it when the consumers'
+            clocks are not synchronized well enough for the resolution.
+        :param metrics:
+            A :class:`~redis_throttled_queue.metrics.Metrics` instance that gets counters and latencies for the
+            operations of this queue (it can be shared by multiple queues). The pop functions are then asked to
+            report how many names they scanned.
+        :param codec:
+            A :class:`~redis_throttled_queue.codec.Codec` that encodes the items on push and decodes them on pop (e.g.:
+            ``JSONCodec() | ZstdCodec()``). The `redis_client` must not use ``decode_responses=True``, as the encoded
+            items are binary.
+        :param payload_threshold:
+            Store the items of this size or larger (in bytes, after encoding) out of line: the queue only holds a content
+            hash (thus items are still deduplicated by content) and the body is kept in a separate hash, from where the pop
+            functions take it. The queues stay small (and in the compact encoding), so pops and pushes don't slow down
+            with the payload size. ``None`` (the default) stores all the items inline.
         """
         self._client = redis_client
         if not isinstance(prefix, str):
             raise TypeError(f'Incorrect type for `prefix`. Must be str, not {type(prefix)}.')
+        if cluster is None:
+            cluster = _is_cluster(redis_client)
+        if cluster and not _has_hash_tag(prefix):
+            prefix = f'{{{prefix}}}'
+        self.cluster = cluster
         self._prefix = prefix
         self.limit = limit
+        self._resolution_ms = round(resolution * 1000)
+        if self._resolution_ms < 1:
+            raise ValueError(f'Incorrect value for `resolution`. Must be at least 1 millisecond, not {resolution!r}.')
         self.resolution = resolution
+        # passed as is to the library (in seconds), integers are kept as integers
+        self._resolution_arg = self._resolution_ms // 1000 if self._resolution_ms % 1000 == 0 else self._resolution_ms / 1000
+        self.server_time = server_time
+        self.metrics = metrics
+        if codec is not None and _decodes_responses(redis_client):
+            raise ValueError('Incorrect value for `codec`. Cannot be used with a redis client that has decode_responses=True.')
+        self.codec = codec
+        if payload_threshold is not None and (not isinstance(payload_threshold, int) or payload_threshold < 1):
+            raise ValueError(f'Incorrect value for `payload_threshold`. Must be a positive integer or None, not {payload_threshold!r}.')
+        self.payload_threshold = payload_threshold
+        self.page_size = page_size
+        self.strategy = Strategy(strategy)
+        self.burst = burst
         self.last_activity = time()
         self._count_key = f'{self._prefix}:total'
+        self._wakeup_key = f'{self._prefix}:wakeup'
+        self._names_key = f'{self._prefix}:names'
+        self._limits_key = f'{self._prefix}:limits'
+        self._weights_key = f'{self._prefix}:weights'
+        self._classes_key = f'{self._prefix}:classes'
         if register_library:
             self.register_library(redis_client)
         if validate_version:
@@ -85,25 +370,408 @@ class ThrottledQueue:
         """
         return int(self._client.get(self._count_key) or 0)
 
-    def push(self, name: str, data: Union[str, bytes], *, priority: int = 0):
+    def push(
+        self,
+        name: str,
+        data: Union[str, bytes],
+        *,
+        priority: int = 0,
+        cost: int = 1,
+        not_before: Optional[float] = None,
+        expires_at: Optional[float] = None,
+    ):
         """
         Push an item.
+
+        :param cost:
+            How much of the name's limit the item uses up when popped (e.g.: a bulk request worth 50 units). An item is
+            only popped if it fits in what's left of the limit in the current window, otherwise the name waits for the
+            next window (where the item is popped first). Items that cost more than the limit are popped alone, at the
+            start of a window. With ``Strategy.GCRA`` the next item of the name is delayed accordingly.
+        :param not_before:
+            A timestamp (seconds since the epoch, compared with the Redis server clock) before which the item must not be
+            popped (e.g.: a retry with backoff). Until then the item is kept aside: it is not counted in ``len()`` and it
+            doesn't use up anything. The pops move the due items into their queues (up to 100 at a time), as if they were
+            pushed then. Pushing the same delayed item again keeps the earliest `not_before` and the highest priority.
+        :param expires_at:
+            A timestamp (seconds since the epoch, compared with the Redis server clock) after which the item is dropped
+            instead of popped (e.g.: a request nobody waits for anymore). Expired items are dropped by the pops (they don't
+            use up anything) and by ``purge_expired``, until then they are counted in ``len()``. Pushing the same item again
+            replaces its expiry (or removes it, if not given).
+        :return: ``1`` if the item was added (or delayed), ``0`` if it was already queued (or already delayed) or if it
+            would expire before it's due.
+        """
+        added = self._call('push', *self._push_args(name, data, priority, cost, not_before, expires_at))
+        self._count_pushed(1, added)
+        return added
+
+    def push_many(self, items: PushItems) -> int:
+        """
+        Push multiple items in a single call.
+
+        :param items:
+            An iterable of ``(name, data)``, ``(name, data, priority)`` or ``(name, data, priority, cost)`` tuples, or a
+            mapping of ``name`` to an iterable of ``data``, ``(data, priority)`` or ``(data, priority, cost)`` tuples.
+        :return: The count of items actually added (items that were already queued only get their priority raised and
+            their cost replaced).
+        """
+        args = _push_many_args(items, self._item_args)
+        if not args:
+            return 0
+        self.last_activity = time()
+        added = self._call('push_many', 'RTQ_PUSH_MANY', 1, self._prefix, *args)
+        self._count_pushed(len(args) // 5, added)
+        return added
+
+    def _push_args(
+        self,
+        name: str,
+        data: Union[str, bytes],
+        priority: int,
+        cost: int,
+        not_before: Optional[float] = None,
+        expires_at: Optional[float] = None,
+    ) -> tuple:
+        """
+        Validates an item and builds the ``fcall`` arguments to push it.
         """
         if ':' in name:
             raise ValueError('Incorrect value for `key`. Cannot contain ":".')
+        _check_cost(cost)
+        not_before = _timestamp_ms(not_before, 'not_before')
+        expires_at = _timestamp_ms(expires_at, 'expires_at')
         self.last_activity = time()
-        return self._client.fcall('RTQ_PUSH', 0, self._prefix, name, priority, data)
+        data, body = self._item_args(data)
+        if expires_at != '':
+            extra = (cost, body, not_before, expires_at)
+        elif not_before != '':
+            extra = (cost, body, not_before)
+        else:
+            extra = (cost, body) if body else () if cost == 1 else (cost,)
+        return 'RTQ_PUSH', 1, self._prefix, name, priority, data, *extra
 
-    def pop(self, window: Union[str, bytes, int] = Ellipsis) -> Union[str, bytes, None]:
+    def _push_each(self, calls: list) -> list:
         """
-        Pop an item, if any available.
+        Runs the ``RTQ_PUSH`` `calls` (built by ``_push_args``) in a pipeline, in a single round trip. Returns the result of
+        every call (an exception for the calls that failed).
+        """
+        start = perf_counter()
+        with self._client.pipeline(transaction=False) as pipe:
+            for args in calls:
+                pipe.fcall(*args)
+            results = pipe.execute(raise_on_error=False)
+        if self.metrics is not None:
+            self.metrics.timing('push_pipeline', perf_counter() - start)
+            self._count_pushed(len(calls), sum(result for result in results if not isinstance(result, Exception)))
+        return results
+
+    def _item_args(self, data) -> tuple:
+        """
+        Returns the ``DATA`` and ``BODY`` arguments for an item: the encoded item and an empty body, or for the items stored
+        out of line (see `payload_threshold`) the content hash and the encoded item.
+        """
+        if self.codec is not None:
+            data = self.codec.encode(data)
+        if self.payload_threshold is None:
+            return data, ''
+        raw = data.encode() if isinstance(data, str) else data
+        if memoryview(raw).nbytes < self.payload_threshold:
+            return data, ''
+        return blake2b(raw, digest_size=16).hexdigest(), data
+
+    def _decode(self, data):
+        return data if self.codec is None or data is None else self.codec.decode(data)
+
+    def _call(self, operation: str, *args):
+        """
+        Calls a redis function (timed as `operation` if there are metrics).
+        """
+        if self.metrics is None:
+            return self._client.fcall(*args)
+        start = perf_counter()
+        try:
+            return self._client.fcall(*args)
+        finally:
+            self.metrics.timing(operation, perf_counter() - start)
+
+    def _pop_call(self, operation: str, function: str, window: Union[str, bytes, int], *args):
+        """
+        Calls a pop `function`. If there are metrics the function is asked for stats, and the scanned names are counted.
         """
+        if self.metrics is None:
+            return self._client.fcall(*self._pop_args(function, window, *args))
+        result, scanned = self._call(operation, *self._pop_args(function, window, *args, 1))
+        self.metrics.count(f'{operation}.scanned', scanned)
+        return result
+
+    def _count(self, name: str, value: int = 1):
+        if self.metrics is not None:
+            self.metrics.count(name, value)
+
+    def _count_pushed(self, pushed: int, added: int):
+        if self.metrics is not None:
+            self.metrics.count('push.added', added)
+            self.metrics.count('push.deduplicated', pushed - added)
+
+    def _count_popped_many(self, result: list):
+        if self.metrics is not None:
+            self.metrics.count('pop_many.calls')
+            self.metrics.count('pop_many.items', len(result) // 2)
+
+    def _get_window(self, window: Union[str, bytes, int]) -> Union[str, bytes, int]:
         if window is Ellipsis:
-            window = int(time()) // self.resolution % 60
-        value = self._client.fcall('RTQ_POP', 0, self._prefix, window, self.limit, int(self.resolution))
-        if value is not None:
+            if self.server_time:
+                return ''
+            window = int(time() * 1000) // self._resolution_ms % 60
+        return window
+
+    def _pop_args(self, function: str, window: Union[str, bytes, int], *args) -> tuple:
+        """
+        Builds the ``fcall`` arguments for the pop `function` (``RTQ_POP``, ``RTQ_POP_EX`` or ``RTQ_POP_MANY``) according
+        to the strategy.
+        """
+        if self.strategy is Strategy.GCRA:
+            return (
+                function.replace('RTQ_', 'RTQ_GCRA_', 1),
+                1,
+                self._prefix,
+                self.limit,
+                self._resolution_arg,
+                self.burst,
+                self.page_size,
+                *args,
+            )
+        else:
+            return function, 1, self._prefix, self._get_window(window), self.limit, self._resolution_arg, self.page_size, *args
+
+    def _get_wait(self, retry_after: Optional[float], deadline: Optional[float]) -> Optional[float]:
+        """
+        Computes how long a blocked ``pop`` should wait for a wakeup: until the `deadline` or the `retry_after`, whichever
+        comes first (a `retry_after` of ``None`` means only a push can make an item available). Returns ``0`` to wait
+        forever or ``None`` to give up.
+        """
+        wait = retry_after
+        if deadline is not None:
+            remaining = deadline - time()
+            if remaining <= 0:
+                return None
+            wait = remaining if wait is None else min(wait, remaining)
+        return 0 if wait is None else max(wait, 0.001)
+
+    def _pop_ex_result(self, result: list, window: Union[str, bytes, int]) -> PopResult:
+        """
+        Converts the list returned by ``RTQ_POP_EX``.
+        """
+        status = PopStatus(result[0])
+        if status is PopStatus.ITEM:
             self.last_activity = time()
-        return value
+            _, name, value, priority = result
+            return PopResult(status, self._decode(value), name, float(priority))
+        elif status is PopStatus.THROTTLED:
+            retry_after = result[1] / 1000
+            if window is Ellipsis and not self.server_time and self.strategy is Strategy.FIXED_WINDOW:
+                resolution = self._resolution_ms / 1000
+                retry_after = min(retry_after, resolution - time() % resolution)
+            return PopResult(status, retry_after=max(retry_after, 0.001))
+        elif len(result) > 1:
+            return PopResult(status, retry_after=result[1] / 1000)
+        else:
+            return PopResult(status)
+
+    def pop(self, window: Union[str, bytes, int] = Ellipsis, *, timeout: Optional[float] = None) -> Union[str, bytes, None]:
+        """
+        Pop an item, if any available.
+
+        :param timeout:
+            If given, wait up to this many seconds for an item to become available (use ``0`` to wait indefinitely).
+            The wait is done with a ``BLPOP`` on a wakeup key that is written on every push and on every pop that leaves
+            items behind, thus the `redis_client` should have a ``socket_timeout`` greater than the `timeout`.
+            If everything is throttled the wait ends when the current window ends (or when the first delayed item is due).
+        """
+        if timeout is None:
+            value = self._pop_call('pop', 'RTQ_POP', window)
+            if value is not None:
+                self.last_activity = time()
+            self._count('pop.miss' if value is None else 'pop.item')
+            return self._decode(value)
+
+        deadline = None if not timeout else time() + timeout
+        while True:
+            result = self.pop_ex(window)
+            if result.status is PopStatus.ITEM:
+                return result.value
+            wait = self._get_wait(result.retry_after, deadline)
+            if wait is None:
+                return
+            self._wait_for_wakeup(wait)
+
+    def _wait_for_wakeup(self, wait: float):
+        """
+        Blocks until a push (or a pop that left items behind) happened or `wait` seconds passed (``0`` waits forever).
+        """
+        self._client.blpop(self._wakeup_key, wait)
+
+    def pop_ex(self, window: Union[str, bytes, int] = Ellipsis) -> PopResult:
+        """
+        Pop an item, if any available, and tell why if there isn't.
+
+        :return: A :class:`PopResult`, from which you can tell if the queue is empty or throttled (and for how long).
+        """
+        result = self._pop_ex_result(self._pop_call('pop_ex', 'RTQ_POP_EX', window), window)
+        self._count(f'pop_ex.{result.status.name.lower()}')
+        return result
+
+    def pop_many(self, count: int, window: Union[str, bytes, int] = Ellipsis, *, with_names: bool = False) -> list:
+        """
+        Pop up to `count` items in a single call.
+
+        The items come in the same order ``count`` successive ``pop()`` calls would return them and the limit is
+        respected for every name.
+
+        :param with_names: If true, ``(name, item)`` tuples are returned instead of just the items.
+        """
+        result = self._pop_call('pop_many', 'RTQ_POP_MANY', window, count)
+        if result:
+            self.last_activity = time()
+        self._count_popped_many(result)
+        return _pop_many_result(result, with_names, self.codec and self.codec.decode)
+
+    def names(self) -> list:
+        """
+        Get the names that have items queued.
+        """
+        return self._client.zrange(self._names_key, 0, -1)
+
+    def set_limit(self, name: str, limit: Optional[int]):
+        """
+        Set the throttling limit of a name (``None`` to use the queue's `limit` again). The limits are stored in Redis, thus
+        shared by all the consumers.
+
+        A lower limit applies right away, a higher limit only applies in the next window if the name already reached its
+        limit in the current window.
+        """
+        self.set_limits({name: limit})
+
+    def set_limits(self, limits: Mapping):
+        """
+        Set the throttling limits of multiple names (a mapping of name to limit, ``None`` to use the queue's `limit` again).
+        """
+        self._update_hash(self._limits_key, *_limits_args(limits))
+
+    def _update_hash(self, key: str, updates: dict, removals: list):
+        if not updates and not removals:
+            return
+        with self._client.pipeline() as pipe:
+            if updates:
+                pipe.hset(key, mapping=updates)
+            if removals:
+                pipe.hdel(key, *removals)
+            pipe.execute()
+
+    def limits(self) -> dict:
+        """
+        Get the names that have their own throttling limit (a dict of name to limit).
+        """
+        return {name: int(limit) for name, limit in self._client.hgetall(self._limits_key).items()}
+
+    def set_weights(self, weights: Mapping):
+        """
+        Set the scheduling weights of multiple names (a mapping of name to weight, from 1 to ``MAX_WEIGHT``, ``None`` to
+        use the default weight of 1 again).
+
+        Within a window names are served in proportion to their weights: a name with weight 3 gets 3 items for every item
+        a name with weight 1 gets (as long as both have items and are under their limit). Item costs are taken into account,
+        thus this is a deficit round robin when the costs vary. Weights don't change the limits.
+
+        Only used by the ``FIXED_WINDOW`` strategy. Names get their weight when they are first seen in a window, thus changes
+        apply in the next window for the names already served.
+        """
+        self._update_hash(self._weights_key, *_weights_args(weights))
+
+    def weights(self) -> dict:
+        """
+        Get the names that have their own scheduling weight (a dict of name to weight).
+        """
+        return {name: int(weight) for name, weight in self._client.hgetall(self._weights_key).items()}
+
+    def set_classes(self, classes: Mapping):
+        """
+        Set the scheduling classes of multiple names (a mapping of name to class, from 0 to ``MAX_CLASS``, ``None`` to use
+        the default class of 0 again).
+
+        Classes have strict priority: names in a class are only served when all the names in the lower classes are empty
+        or reached their limit in the window. Weights apply between the names of the same class.
+
+        Only used by the ``FIXED_WINDOW`` strategy. Changes apply in the next window for the names already served.
+        """
+        self._update_hash(self._classes_key, *_classes_args(classes))
+
+    def classes(self) -> dict:
+        """
+        Get the names that have their own scheduling class (a dict of name to class).
+        """
+        return {name: int(cls) for name, cls in self._client.hgetall(self._classes_key).items()}
+
+    def extract(self, names: Iterable[str]) -> list:
+        """
+        Remove the given names with all their items, in a single call. Used to move names to another queue. The delayed
+        items are not removed (they get queued again once due).
+
+        :return: A list of ``(name, item, priority)`` tuples, ``(name, item, priority, cost)`` for the items that don't
+            cost 1 (which can be given to ``push_many``).
+        """
+        names = list(names)
+        if not names:
+            return []
+        return _extract_result(self._client.fcall('RTQ_EXTRACT', 1, self._prefix, *names), self.codec and self.codec.decode)
+
+    def purge_expired(self, batch: int = 1000) -> int:
+        """
+        Drop up to `batch` expired items (earliest expiry first), in a single call. The pops already drop some of them as
+        they go, this is for the queues that are not popped often.
+
+        :return: How many items were dropped (call again while it's `batch`).
+        """
+        _check_batch(batch)
+        dropped = self._call('purge_expired', 'RTQ_PURGE_EXPIRED', 1, self._prefix, batch)
+        self._count('purge_expired.dropped', dropped)
+        return dropped
+
+    def _stats_args(
+        self, window: Union[str, bytes, int], top: int, page_size: int, names_cursor: Union[str, bytes], usage_cursor: Union[str, bytes]
+    ) -> tuple:
+        return (
+            'RTQ_STATS',
+            1,
+            self._prefix,
+            self._get_window(window),
+            self.limit,
+            self._resolution_arg,
+            top,
+            page_size,
+            names_cursor,
+            usage_cursor,
+        )
+
+    def stats(self, top: int = 10, window: Union[str, bytes, int] = Ellipsis, *, page_size: int = 1000) -> QueueStats:
+        """
+        Get a snapshot of the queue: the total, the count of names, the `top` names by item count and by usage in the
+        `window`. This takes a call for every `page_size` names (the server is not blocked for long on big queues), thus
+        the numbers are not exact if the queue changes in the meantime.
+
+        :return: A :class:`QueueStats`.
+        """
+        names_cursor = usage_cursor = ''
+        by_depth = []
+        by_usage = []
+        while True:
+            total, active_names, names_cursor, usage_cursor, depth_page, usage_page = self._client.fcall_ro(
+                *self._stats_args(window, top, page_size, names_cursor, usage_cursor)
+            )
+            by_depth = _merge_top(by_depth, depth_page, top)
+            by_usage = _merge_top(by_usage, usage_page, top)
+            if not names_cursor and not usage_cursor:
+                return QueueStats(total, active_names, by_depth, by_usage)
 
     @property
     def idle_seconds(self) -> float:
@@ -112,19 +780,36 @@ class ThrottledQueue:
         """
         return time() - self.last_activity
 
-    def cleanup(self):
+    def cleanup(self, batch: Optional[int] = None):
         """
         Cleanup all associated redis data to this queue.
+
+        :param batch:
+            If given, an iterator is returned instead. Every step removes the keys of up to `batch` names or windows (with
+            a separate ``RTQ_CLEANUP`` call, so the server is not blocked for long on big queues) and yields how many keys
+            were removed.
         """
-        return self._client.fcall('RTQ_CLEANUP', 0, self._prefix)
+        if batch is None:
+            return self._call('cleanup', 'RTQ_CLEANUP', 1, self._prefix)
+        _check_batch(batch)
+        return self._cleanup_steps(batch)
+
+    def _cleanup_steps(self, batch: int) -> Iterator[int]:
+        remaining = True
+        while remaining:
+            unlinked, remaining = self._call('cleanup', 'RTQ_CLEANUP', 1, self._prefix, batch)
+            self._count('cleanup.unlinked', unlinked)
+            yield unlinked
 
     @classmethod
     def register_library(cls, redis_client: StrictRedis):
         """
         Registers the redis functions. Called from ``__init__``, if enabled.
+
+        On Redis Cluster the library is always loaded (on all the primaries).
         """
         if cls._library_missing:
-            if not redis_client.function_list('RTQ'):
+            if _is_cluster(redis_client) or not redis_client.function_list('RTQ'):
                 redis_client.function_load(LIBRARY, replace=True)
             cls._library_missing = False
 
@@ -148,7 +833,7 @@ class AsyncThrottledQueue(ThrottledQueue):
         You have to call this manually.
         """
         if cls._library_missing:
-            if not await redis_client.function_list('RTQ'):
+            if _is_cluster(redis_client) or not await redis_client.function_list('RTQ'):
                 await redis_client.function_load(LIBRARY, replace=True)
             cls._library_missing = False
 
@@ -164,28 +849,358 @@ class AsyncThrottledQueue(ThrottledQueue):
         """
         return int(await self._client.get(self._count_key) or 0)
 
-    async def push(self, name: str, data: Union[str, bytes], *, priority: int = 0):
+    async def push(
+        self,
+        name: str,
+        data: Union[str, bytes],
+        *,
+        priority: int = 0,
+        cost: int = 1,
+        not_before: Optional[float] = None,
+        expires_at: Optional[float] = None,
+    ):
         """
         Asyncio variant for ``push``.
         """
-        if ':' in name:
-            raise ValueError('Incorrect value for `key`. Cannot contain ":".')
+        added = await self._call('push', *self._push_args(name, data, priority, cost, not_before, expires_at))
+        self._count_pushed(1, added)
+        return added
+
+    async def push_many(self, items: PushItems) -> int:
+        """
+        Asyncio variant for ``push_many``.
+        """
+        args = _push_many_args(items, self._item_args)
+        if not args:
+            return 0
         self.last_activity = time()
-        return await self._client.fcall('RTQ_PUSH', 0, self._prefix, name, priority, data)
+        added = await self._call('push_many', 'RTQ_PUSH_MANY', 1, self._prefix, *args)
+        self._count_pushed(len(args) // 5, added)
+        return added
+
+    async def _push_each(self, calls: list) -> list:
+        """
+        Asyncio variant for ``_push_each``.
+        """
+        start = perf_counter()
+        async with self._client.pipeline(transaction=False) as pipe:
+            for args in calls:
+                pipe.fcall(*args)
+            results = await pipe.execute(raise_on_error=False)
+        if self.metrics is not None:
+            self.metrics.timing('push_pipeline', perf_counter() - start)
+            self._count_pushed(len(calls), sum(result for result in results if not isinstance(result, Exception)))
+        return results
 
-    async def pop(self, window: Union[str, bytes, int] = Ellipsis) -> Union[str, bytes, None]:
+    async def _call(self, operation: str, *args):
+        """
+        Asyncio variant for ``_call``.
+        """
+        if self.metrics is None:
+            return await self._client.fcall(*args)
+        start = perf_counter()
+        try:
+            return await self._client.fcall(*args)
+        finally:
+            self.metrics.timing(operation, perf_counter() - start)
+
+    async def _pop_call(self, operation: str, function: str, window: Union[str, bytes, int], *args):
+        """
+        Asyncio variant for ``_pop_call``.
+        """
+        if self.metrics is None:
+            return await self._client.fcall(*self._pop_args(function, window, *args))
+        result, scanned = await self._call(operation, *self._pop_args(function, window, *args, 1))
+        self.metrics.count(f'{operation}.scanned', scanned)
+        return result
+
+    async def pop(self, window: Union[str, bytes, int] = Ellipsis, *, timeout: Optional[float] = None) -> Union[str, bytes, None]:
         """
         Asyncio variant for ``pop``.
         """
-        if window is Ellipsis:
-            window = int(time()) // self.resolution % 60
-        value = await self._client.fcall('RTQ_POP', 0, self._prefix, window, self.limit, int(self.resolution))
-        if value is not None:
+        if timeout is None:
+            value = await self._pop_call('pop', 'RTQ_POP', window)
+            if value is not None:
+                self.last_activity = time()
+            self._count('pop.miss' if value is None else 'pop.item')
+            return self._decode(value)
+
+        deadline = None if not timeout else time() + timeout
+        while True:
+            result = await self.pop_ex(window)
+            if result.status is PopStatus.ITEM:
+                return result.value
+            wait = self._get_wait(result.retry_after, deadline)
+            if wait is None:
+                return
+            await self._wait_for_wakeup(wait)
+
+    async def _wait_for_wakeup(self, wait: float):
+        """
+        Asyncio variant for ``_wait_for_wakeup``.
+        """
+        await self._client.blpop(self._wakeup_key, wait)
+
+    async def pop_ex(self, window: Union[str, bytes, int] = Ellipsis) -> PopResult:
+        """
+        Asyncio variant for ``pop_ex``.
+        """
+        result = self._pop_ex_result(await self._pop_call('pop_ex', 'RTQ_POP_EX', window), window)
+        self._count(f'pop_ex.{result.status.name.lower()}')
+        return result
+
+    async def pop_many(self, count: int, window: Union[str, bytes, int] = Ellipsis, *, with_names: bool = False) -> list:
+        """
+        Asyncio variant for ``pop_many``.
+        """
+        result = await self._pop_call('pop_many', 'RTQ_POP_MANY', window, count)
+        if result:
+            self.last_activity = time()
+        self._count_popped_many(result)
+        return _pop_many_result(result, with_names, self.codec and self.codec.decode)
+
+    async def _pop_many_ex(self, count: int, window: Union[str, bytes, int] = Ellipsis) -> tuple:
+        """
+        Pop up to `count` items and, if less were available, tell why in the same call (``RTQ_POP_MANY_EX``).
+
+        :return: The items and ``None`` if `count` items were popped, otherwise the :class:`PopResult` ``pop_ex`` would
+            have returned.
+        """
+        result, miss = await self._pop_call('pop_many', 'RTQ_POP_MANY_EX', window, count)
+        if result:
             self.last_activity = time()
-        return value
+        self._count_popped_many(result)
+        return _pop_many_result(result, False, self.codec and self.codec.decode), miss and self._pop_ex_result(miss, window)
+
+    def consume(
+        self,
+        handler: Optional[Callable[[Union[str, bytes]], Awaitable]] = None,
+        *,
+        concurrency: int = 1,
+        window: Union[str, bytes, int] = Ellipsis,
+    ) -> 'AsyncConsumer':
+        """
+        Consume items continuously. Without a `handler` you get the items::
+
+            async for item in queue.consume(concurrency=10):
+                ...
+
+        With a `handler` (a coroutine function) every item is handled in a separate task and you get the results::
+
+            async for result in queue.consume(handler, concurrency=10):
+                ...
+
+        :param concurrency:
+            Maximum number of handler tasks in flight (or items fetched ahead if there's no `handler`). When more than one
+            slot is free the items are fetched with a single ``pop_many`` call.
+        :return: An :class:`AsyncConsumer`.
+        """
+        return AsyncConsumer(self, handler, concurrency, window)
+
+    async def names(self) -> list:
+        """
+        Asyncio variant for ``names``.
+        """
+        return await self._client.zrange(self._names_key, 0, -1)
+
+    async def set_limit(self, name: str, limit: Optional[int]):
+        """
+        Asyncio variant for ``set_limit``.
+        """
+        await self.set_limits({name: limit})
+
+    async def set_limits(self, limits: Mapping):
+        """
+        Asyncio variant for ``set_limits``.
+        """
+        await self._update_hash(self._limits_key, *_limits_args(limits))
+
+    async def _update_hash(self, key: str, updates: dict, removals: list):
+        if not updates and not removals:
+            return
+        async with self._client.pipeline() as pipe:
+            if updates:
+                pipe.hset(key, mapping=updates)
+            if removals:
+                pipe.hdel(key, *removals)
+            await pipe.execute()
+
+    async def limits(self) -> dict:
+        """
+        Asyncio variant for ``limits``.
+        """
+        return {name: int(limit) for name, limit in (await self._client.hgetall(self._limits_key)).items()}
+
+    async def set_weights(self, weights: Mapping):
+        """
+        Asyncio variant for ``set_weights``.
+        """
+        await self._update_hash(self._weights_key, *_weights_args(weights))
+
+    async def weights(self) -> dict:
+        """
+        Asyncio variant for ``weights``.
+        """
+        return {name: int(weight) for name, weight in (await self._client.hgetall(self._weights_key)).items()}
+
+    async def set_classes(self, classes: Mapping):
+        """
+        Asyncio variant for ``set_classes``.
+        """
+        await self._update_hash(self._classes_key, *_classes_args(classes))
+
+    async def classes(self) -> dict:
+        """
+        Asyncio variant for ``classes``.
+        """
+        return {name: int(cls) for name, cls in (await self._client.hgetall(self._classes_key)).items()}
+
+    async def extract(self, names: Iterable[str]) -> list:
+        """
+        Asyncio variant for ``extract``.
+        """
+        names = list(names)
+        if not names:
+            return []
+        return _extract_result(await self._client.fcall('RTQ_EXTRACT', 1, self._prefix, *names), self.codec and self.codec.decode)
 
-    async def cleanup(self):
+    async def purge_expired(self, batch: int = 1000) -> int:
         """
-        Asyncio variant for ``cleanup``.
+        Asyncio variant for ``purge_expired``.
         """
-        return await self._client.fcall('RTQ_CLEANUP', 0, self._prefix)
+        _check_batch(batch)
+        dropped = await self._call('purge_expired', 'RTQ_PURGE_EXPIRED', 1, self._prefix, batch)
+        self._count('purge_expired.dropped', dropped)
+        return dropped
+
+    async def stats(self, top: int = 10, window: Union[str, bytes, int] = Ellipsis, *, page_size: int = 1000) -> QueueStats:
+        """
+        Asyncio variant for ``stats``.
+        """
+        names_cursor = usage_cursor = ''
+        by_depth = []
+        by_usage = []
+        while True:
+            total, active_names, names_cursor, usage_cursor, depth_page, usage_page = await self._client.fcall_ro(
+                *self._stats_args(window, top, page_size, names_cursor, usage_cursor)
+            )
+            by_depth = _merge_top(by_depth, depth_page, top)
+            by_usage = _merge_top(by_usage, usage_page, top)
+            if not names_cursor and not usage_cursor:
+                return QueueStats(total, active_names, by_depth, by_usage)
+
+    def cleanup(self, batch: Optional[int] = None) -> Union[Awaitable, AsyncIterator[int]]:
+        """
+        Asyncio variant for ``cleanup``. Returns an awaitable, or an async iterator if `batch` is given.
+        """
+        if batch is None:
+            return self._call('cleanup', 'RTQ_CLEANUP', 1, self._prefix)
+        _check_batch(batch)
+        return self._cleanup_steps(batch)
+
+    async def _cleanup_steps(self, batch: int) -> AsyncIterator[int]:
+        remaining = True
+        while remaining:
+            unlinked, remaining = await self._call('cleanup', 'RTQ_CLEANUP', 1, self._prefix, batch)
+            self._count('cleanup.unlinked', unlinked)
+            yield unlinked
+
+
+class AsyncConsumer:
+    """
+    Async iterator returned by :meth:`AsyncThrottledQueue.consume`.
+
+    When the queue is empty it waits for a push and when the queue is throttled it waits until the current window ends.
+
+    Exceptions raised by the handler are raised from the iteration. Call ``stop()`` for a graceful stop (no more items are
+    fetched, the iteration ends after the items already fetched are handled) or ``aclose()`` to cancel the handler tasks
+    (the items they were handling are lost). Used as an async context manager it is closed on exit.
+    """
+
+    stopped: bool = False
+
+    def __init__(
+        self,
+        queue: AsyncThrottledQueue,
+        handler: Optional[Callable[[Union[str, bytes]], Awaitable]],
+        concurrency: int,
+        window: Union[str, bytes, int],
+    ):
+        if concurrency < 1:
+            raise ValueError('Incorrect value for `concurrency`. Must be at least 1.')
+        self._queue = queue
+        self._handler = handler
+        self._concurrency = concurrency
+        self._window = window
+        self._ready = deque()  # fetched items or finished handler tasks
+        self._tasks = set()
+        self._waiter = None
+
+    def __aiter__(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    def stop(self):
+        """
+        Stops fetching items. The iteration ends once the items already fetched are handled.
+        """
+        self.stopped = True
+        if self._waiter:
+            self._waiter.cancel()
+
+    async def aclose(self):
+        """
+        Cancels the handler tasks and the wait for items.
+        """
+        self.stop()
+        pending = [*self._tasks, self._waiter] if self._waiter else [*self._tasks]
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        self._tasks.clear()
+        self._ready.clear()
+        self._waiter = None
+
+    async def _fetch(self, count: int) -> tuple:
+        """
+        Fetches up to `count` items. Returns the items and, if less than `count` were available, how long to wait for a
+        wakeup (``0`` meaning indefinitely).
+        """
+        items, miss = await self._queue._pop_many_ex(count, self._window)
+        if miss is None:
+            return items, None
+        elif miss.retry_after is None:
+            return items, 0
+        return items, max(miss.retry_after, 0.001)
+
+    async def __anext__(self):
+        while True:
+            if self._ready:
+                item = self._ready.popleft()
+                return item.result() if self._handler else item
+            if self.stopped and not self._tasks:
+                raise StopAsyncIteration
+
+            free = self._concurrency - len(self._tasks)
+            if not self.stopped and free and not self._waiter:
+                items, wait = await self._fetch(free)
+                if self._handler:
+                    self._tasks.update(asyncio.ensure_future(self._handler(item)) for item in items)
+                else:
+                    self._ready.extend(items)
+                if self._ready or wait is None:
+                    continue
+                self._waiter = asyncio.ensure_future(self._queue._wait_for_wakeup(wait))
+
+            done, _ = await asyncio.wait({*self._tasks, self._waiter} - {None}, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task is self._waiter:
+                    self._waiter = None
+                else:
+                    self._tasks.discard(task)
+                    self._ready.append(task)
@@ -0,0 +1,98 @@
+"""
+Command line entry point::
+
+    python -m redis_throttled_queue worker mymodule:handle_item --url redis://localhost --prefix myqueue --threads 4 --processes 8
+"""
+
+import argparse
+import logging
+import sys
+
+from . import Resolution
+from . import Strategy
+from .worker import Runner
+from .worker import resolve_handler
+
+
+def resolution(value: str):
+    """
+    Converts a ``--resolution`` value: a :class:`Resolution` name or a number of seconds.
+    """
+    try:
+        return Resolution[value.upper()]
+    except KeyError:
+        pass
+    try:
+        seconds = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f'must be one of {", ".join(member.name.lower() for member in Resolution)} or a number of seconds'
+        ) from None
+    if seconds <= 0:
+        raise argparse.ArgumentTypeError('must be a positive number of seconds')
+    return seconds
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m redis_throttled_queue', description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest='command', metavar='COMMAND')
+    commands.required = True
+
+    worker = commands.add_parser('worker', help='Run a handler for every item in a queue.')
+    worker.add_argument('handler', help='Handler callable, in the "module:callable" format.')
+    worker.add_argument('--url', default='redis://localhost:6379/0', help='Redis URL. Default: %(default)s')
+    worker.add_argument('--cluster', action='store_true', help='Connect to a Redis Cluster.')
+    worker.add_argument('--decode-responses', action='store_true', help='Decode the items (the handler gets str instead of bytes).')
+    worker.add_argument('--prefix', required=True, help='Redis key prefix of the queue.')
+    worker.add_argument('--limit', type=int, default=10, help='Throttling limit. Default: %(default)s')
+    worker.add_argument(
+        '--resolution',
+        type=resolution,
+        default='second',
+        help='Window length: second, minute or a number of seconds (e.g.: 0.2). Default: %(default)s',
+    )
+    worker.add_argument('--server-time', action='store_true', help='Compute the windows from the Redis server clock.')
+    worker.add_argument(
+        '--strategy', choices=[member.value for member in Strategy], default=Strategy.FIXED_WINDOW.value, help='Default: %(default)s'
+    )
+    worker.add_argument('--burst', type=int, default=1, help='Items allowed at once with the gcra strategy. Default: %(default)s')
+    worker.add_argument('--page-size', type=int, default=10, help='Default: %(default)s')
+    worker.add_argument('--threads', type=int, default=1, help='Worker threads per process. Default: %(default)s')
+    worker.add_argument(
+        '--processes', type=int, default=0, help='Worker processes (0 runs the threads in this process). Default: %(default)s'
+    )
+    worker.add_argument('--batch', type=int, default=10, help='How many items a worker fetches at a time. Default: %(default)s')
+    worker.add_argument('--report-interval', type=float, default=60, help='Seconds between throughput reports. Default: %(default)s')
+
+    args = parser.parse_args(argv)
+    try:
+        resolve_handler(args.handler)
+    except (ImportError, AttributeError, ValueError, TypeError) as exc:
+        parser.error(f'cannot load handler {args.handler!r}: {exc}')
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(processName)s %(levelname)s %(message)s')
+    try:
+        runner = Runner(
+            args.url,
+            args.prefix,
+            args.handler,
+            threads=args.threads,
+            processes=args.processes,
+            batch=args.batch,
+            limit=args.limit,
+            resolution=args.resolution,
+            page_size=args.page_size,
+            strategy=Strategy(args.strategy),
+            burst=args.burst,
+            server_time=args.server_time,
+            redis_options={'decode_responses': args.decode_responses},
+            cluster=args.cluster,
+            report_interval=args.report_interval,
+        )
+    except ValueError as exc:
+        parser.error(str(exc))
+    runner.run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,175 @@
+import abc
+import json
+import lzma
+import zlib
+from typing import Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def _buffer(data):
+    """
+    Returns `data` in a form the compressors take as is: ``str`` is encoded, ``bytes``, ``bytearray`` and ``memoryview``
+    are passed through (no copy is made).
+    """
+    return data.encode() if isinstance(data, str) else data
+
+
+class Codec(abc.ABC):
+    """
+    Converts the items on push (``encode``) and back on pop (``decode``)::
+
+        queue = ThrottledQueue(redis_client, 'myqueue', codec=JSONCodec() | ZlibCodec())
+
+    Codecs can be chained with ``|``: the items are encoded from left to right and decoded from right to left.
+
+    The encoded items are what Redis deduplicates, thus encoding must be deterministic (the same item always encodes to
+    the same bytes). Don't change the codec of a queue that has items.
+
+    Subclass and implement ``encode`` and ``decode`` for other formats.
+    """
+
+    @abc.abstractmethod
+    def encode(self, data) -> bytes:
+        pass
+
+    @abc.abstractmethod
+    def decode(self, data: bytes):
+        pass
+
+    def __or__(self, other: 'Codec') -> 'ChainCodec':
+        return ChainCodec(self, other)
+
+    def __repr__(self):
+        return f'{type(self).__name__}()'
+
+
+class ChainCodec(Codec):
+    """
+    Applies multiple codecs, in order (usually a serializer and then a compressor).
+    """
+
+    def __init__(self, *codecs: Codec):
+        self.codecs = tuple(inner for codec in codecs for inner in (codec.codecs if isinstance(codec, ChainCodec) else (codec,)))
+
+    def encode(self, data) -> bytes:
+        for codec in self.codecs:
+            data = codec.encode(data)
+        return data
+
+    def decode(self, data: bytes):
+        for codec in reversed(self.codecs):
+            data = codec.decode(data)
+        return data
+
+    def __repr__(self):
+        return ' | '.join(map(repr, self.codecs))
+
+
+class ZlibCodec(Codec):
+    """
+    Compresses with :mod:`zlib`. Popped items are ``bytes``.
+    """
+
+    def __init__(self, level: int = 6):
+        self.level = level
+
+    def encode(self, data) -> bytes:
+        return zlib.compress(_buffer(data), self.level)
+
+    def decode(self, data: bytes) -> bytes:
+        return zlib.decompress(data)
+
+    def __repr__(self):
+        return f'ZlibCodec(level={self.level})'
+
+
+class LzmaCodec(Codec):
+    """
+    Compresses with :mod:`lzma` (raw LZMA2 streams, without the ``.xz`` container overhead). Slower than zlib, but
+    compresses better. Popped items are ``bytes``.
+    """
+
+    def __init__(self, preset: int = 6):
+        self.preset = preset
+        self._filters = [{'id': lzma.FILTER_LZMA2, 'preset': preset}]
+
+    def encode(self, data) -> bytes:
+        return lzma.compress(_buffer(data), format=lzma.FORMAT_RAW, filters=self._filters)
+
+    def decode(self, data: bytes) -> bytes:
+        return lzma.decompress(data, format=lzma.FORMAT_RAW, filters=self._filters)
+
+    def __repr__(self):
+        return f'LzmaCodec(preset={self.preset})'
+
+
+class ZstdCodec(Codec):
+    """
+    Compresses with Zstandard (requires the ``zstandard`` package). Popped items are ``bytes``.
+    """
+
+    def __init__(self, level: int = 3, dict_data: Optional[bytes] = None):
+        """
+        :param dict_data:
+            A trained dictionary (see ``zstandard.train_dictionary``), greatly improves the compression of small items
+            that have a lot in common. All the producers and consumers must use the same dictionary.
+        """
+        if zstandard is None:
+            raise RuntimeError('ZstdCodec requires the zstandard package (pip install zstandard).')
+        self.level = level
+        dictionary = None if dict_data is None else zstandard.ZstdCompressionDict(dict_data)
+        self._compressor = zstandard.ZstdCompressor(level=level, dict_data=dictionary, write_checksum=False, write_content_size=True)
+        self._decompressor = zstandard.ZstdDecompressor(dict_data=dictionary)
+
+    def encode(self, data) -> bytes:
+        return self._compressor.compress(_buffer(data))
+
+    def decode(self, data: bytes) -> bytes:
+        return self._decompressor.decompress(data)
+
+    def __repr__(self):
+        return f'ZstdCodec(level={self.level})'
+
+
+class JSONCodec(Codec):
+    """
+    Serializes with :mod:`json` (compact, UTF-8). Any JSON serializable item can be pushed.
+    """
+
+    def __init__(self, sort_keys: bool = False):
+        """
+        :param sort_keys:
+            Sort the keys of the objects, so that items that only differ in key order get deduplicated.
+        """
+        self.sort_keys = sort_keys
+
+    def encode(self, data) -> bytes:
+        return json.dumps(data, separators=(',', ':'), ensure_ascii=False, sort_keys=self.sort_keys).encode()
+
+    def decode(self, data: bytes):
+        return json.loads(data)
+
+
+class MsgpackCodec(Codec):
+    """
+    Serializes with MessagePack (requires the ``msgpack`` package). More compact and faster than JSON.
+    """
+
+    def __init__(self):
+        if msgpack is None:
+            raise RuntimeError('MsgpackCodec requires the msgpack package (pip install msgpack).')
+
+    def encode(self, data) -> bytes:
+        return msgpack.packb(data, use_bin_type=True)
+
+    def decode(self, data: bytes):
+        return msgpack.unpackb(data, raw=False)
@@ -1,120 +1,1375 @@
 #!lua name=RTQ
 
+local function add_name(PREFIX, NAME)
+    --[[
+    Adds NAME to the names key, unless already there. Every name gets a sequence number when it's added (this is what
+    windows use to tell apart the names that were queued before they started).
+    ]]
+    local names_key = PREFIX .. ':names'
+    if not redis.call('ZSCORE', names_key, NAME) then
+        redis.call('ZADD', names_key, redis.call('INCR', PREFIX .. ':sequence'), NAME)
+    end
+end
+
+local function set_cost(PREFIX, NAME, DATA, COST, ADDED)
+    --[[
+    Saves the COST of the ITEM in PREFIX:cost:NAME (only if it's not 1, the default). Items that were already queued get
+    their cost replaced.
+    ]]
+    if tonumber(COST) ~= 1 then
+        redis.call('HSET', PREFIX .. ':cost:' .. NAME, DATA, COST)
+    elseif ADDED == 0 then
+        redis.call('HDEL', PREFIX .. ':cost:' .. NAME, DATA)
+    end
+end
+
+local function set_body(PREFIX, NAME, DATA, BODY, ADDED)
+    --[[
+    Saves the BODY of an item stored out of line in PREFIX:data:NAME (DATA being its content hash, which is what the queue
+    holds). Nothing is saved if the item was already queued, or if BODY is empty (the item is stored inline).
+    ]]
+    if BODY ~= '' and tonumber(ADDED) > 0 then
+        redis.call('HSET', PREFIX .. ':data:' .. NAME, DATA, BODY)
+    end
+end
+
+local function set_expiry(PREFIX, NAME, DATA, EXPIRES_AT, ADDED)
+    --[[
+    Saves the EXPIRES_AT (milliseconds, server time) of the ITEM in PREFIX:expiry (zset of (EXPIRES_AT, NAME:DATA)), after
+    which it's dropped instead of popped. Items that were already queued get their expiry replaced (or removed, if
+    EXPIRES_AT is not given).
+    ]]
+    if EXPIRES_AT then
+        redis.call('ZADD', PREFIX .. ':expiry', EXPIRES_AT, NAME .. ':' .. DATA)
+    elseif ADDED == 0 then
+        redis.call('ZREM', PREFIX .. ':expiry', NAME .. ':' .. DATA)
+    end
+end
+
+local function forget_item(PREFIX, NAME, ITEM)
+    --[[
+    Removes what's kept about an ITEM besides its queue entry: its cost, its body and its expiry.
+    ]]
+    redis.call('HDEL', PREFIX .. ':cost:' .. NAME, ITEM)
+    redis.call('HDEL', PREFIX .. ':data:' .. NAME, ITEM)
+    redis.call('ZREM', PREFIX .. ':expiry', NAME .. ':' .. ITEM)
+end
+
+local function take_body(PREFIX, NAME, ITEM)
+    --[[
+    Returns the body of the ITEM (removing it from PREFIX:data:NAME) if it was stored out of line, or the ITEM itself.
+    ]]
+    local data_key = PREFIX .. ':data:' .. NAME
+    local body = redis.call('HGET', data_key, ITEM)
+    if body then
+        redis.call('HDEL', data_key, ITEM)
+        return body
+    end
+    return ITEM
+end
+
+local function add_item(PREFIX, NAME, PRIORITY, DATA, COST, BODY, EXPIRES_AT)
+    --[[
+    Adds the item in PREFIX:queue:NAME (items already queued only get their priority raised, if higher) with its COST, BODY
+    and EXPIRES_AT. The caller is responsible for adding NAME in the names key and updating the total counter.
+
+    Returns 1 if the item was added or 0 if it was already queued.
+    ]]
+    local added = redis.call('ZADD', PREFIX .. ':queue:' .. NAME, 'GT', PRIORITY, DATA)
+    set_cost(PREFIX, NAME, DATA, COST, added)
+    set_body(PREFIX, NAME, DATA, BODY, added)
+    set_expiry(PREFIX, NAME, DATA, EXPIRES_AT, added)
+    return added
+end
+
+local function wake_up(PREFIX)
+    --[[
+    Signals consumers blocked in `BLPOP PREFIX:wakeup` that there might be something to pop.
+    The list never holds more than one element: one consumer is woken up, and that one wakes up the next if it popped
+    something and there are still items left.
+    ]]
+    local wakeup_key = PREFIX .. ':wakeup'
+    if redis.call('LLEN', wakeup_key) == 0 then
+        redis.call('RPUSH', wakeup_key, 1)
+    end
+end
+
+local function now_ms()
+    --[[
+    Returns the server time, in milliseconds.
+    ]]
+    local time = redis.call('TIME')
+    return time[1] * 1000 + math.floor(time[2] / 1000)
+end
+
+-- How many due items are moved into their queues at most, by every pop call (see `promote_due`).
+local PROMOTE_BATCH = 100
+-- How many expired items are dropped at most, by every pop call (see `purge_expired`).
+local PURGE_BATCH = 100
+
+local function delay_item(PREFIX, NAME, PRIORITY, DATA, COST, BODY, EXPIRES_AT, DUE)
+    --[[
+    Saves an item that is not due yet (DUE being in milliseconds) until `promote_due` moves it into its queue:
+
+        PREFIX:delayed - zset of (DUE, NAME:DATA)
+        PREFIX:delayed-items - hash of (NAME:DATA, "PRIORITY COST EXPIRES_AT BODY"), EXPIRES_AT being empty if not given
+
+    Delayed items are not in PREFIX:total and their names are not in PREFIX:names, thus they are not counted and don't use
+    up anything. Items that were already delayed keep the earliest DUE and the highest PRIORITY, and get their COST and
+    EXPIRES_AT replaced.
+
+    Returns 1 if the item was delayed or 0 if it was already delayed.
+    ]]
+    local member = NAME .. ':' .. DATA
+    local items_key = PREFIX .. ':delayed-items'
+    local added = redis.call('ZADD', PREFIX .. ':delayed', 'LT', DUE, member)
+    if added == 0 then
+        local saved = redis.call('HGET', items_key, member)
+        local priority = string.sub(saved, 1, string.find(saved, ' ', 1, true) - 1)
+        if tonumber(priority) > tonumber(PRIORITY) then
+            PRIORITY = priority
+        end
+    end
+    redis.call('HSET', items_key, member, PRIORITY .. ' ' .. COST .. ' ' .. (EXPIRES_AT or '') .. ' ' .. BODY)
+    return added
+end
+
+local function promote_due(PREFIX, NOW)
+    --[[
+    Moves the delayed items that are due at NOW (up to PROMOTE_BATCH, earliest first) into their queues, as if they were
+    pushed then (the items that expired in the meantime are dropped). Only takes a ZRANGE on PREFIX:delayed when nothing
+    is due.
+
+    Returns how many items were added (items that were already queued only get their priority raised).
+    ]]
+    local delayed_key = PREFIX .. ':delayed'
+    local due = redis.call('ZRANGE', delayed_key, '-inf', NOW, 'BYSCORE', 'LIMIT', 0, PROMOTE_BATCH)
+    if #due == 0 then
+        return 0
+    end
+    local items_key = PREFIX .. ':delayed-items'
+    local saved = redis.call('HMGET', items_key, unpack(due))
+    local added = 0
+    for i, member in ipairs(due) do
+        local separator = string.find(member, ':', 1, true)
+        local name = string.sub(member, 1, separator - 1)
+        local fields = saved[i]
+        local first = string.find(fields, ' ', 1, true)
+        local second = string.find(fields, ' ', first + 1, true)
+        local third = string.find(fields, ' ', second + 1, true)
+        local priority = string.sub(fields, 1, first - 1)
+        local cost = string.sub(fields, first + 1, second - 1)
+        local expires_at = tonumber(string.sub(fields, second + 1, third - 1))
+        if not expires_at or expires_at > NOW then
+            local data = string.sub(member, separator + 1)
+            if add_item(PREFIX, name, priority, data, cost, string.sub(fields, third + 1), expires_at) > 0 then
+                added = added + 1
+                add_name(PREFIX, name)
+            end
+        end
+    end
+    redis.call('ZREM', delayed_key, unpack(due))
+    redis.call('HDEL', items_key, unpack(due))
+    if added > 0 then
+        redis.call('INCRBY', PREFIX .. ':total', added)
+        wake_up(PREFIX)
+    end
+    return added
+end
+
+local function purge_expired(PREFIX, BATCH, NOW)
+    --[[
+    Drops up to BATCH items that expired at NOW (earliest expiry first) from their queues. Names left without items are
+    removed from PREFIX:names. Only takes a ZRANGE on PREFIX:expiry when nothing expired.
+
+    Returns how many items were dropped (PREFIX:total is updated).
+    ]]
+    local expiry_key = PREFIX .. ':expiry'
+    local expired = redis.call('ZRANGE', expiry_key, '-inf', NOW, 'BYSCORE', 'LIMIT', 0, BATCH)
+    if #expired == 0 then
+        return 0
+    end
+    local dropped = 0
+    for _, member in ipairs(expired) do
+        local separator = string.find(member, ':', 1, true)
+        local name = string.sub(member, 1, separator - 1)
+        local item = string.sub(member, separator + 1)
+        local queue_key = PREFIX .. ':queue:' .. name
+        if redis.call('ZREM', queue_key, item) == 1 then
+            dropped = dropped + 1
+            redis.call('HDEL', PREFIX .. ':cost:' .. name, item)
+            redis.call('HDEL', PREFIX .. ':data:' .. name, item)
+            if redis.call('EXISTS', queue_key) == 0 then
+                redis.call('ZREM', PREFIX .. ':names', name)
+            end
+        end
+    end
+    redis.call('ZREM', expiry_key, unpack(expired))
+    if dropped > 0 then
+        redis.call('DECRBY', PREFIX .. ':total', dropped)
+    end
+    return dropped
+end
+
+local function pop_highest(state, NAME)
+    --[[
+    Pops the highest priority item of NAME (like ZPOPMAX), dropping the expired items on the way (counted in
+    `state.expired`, the caller is responsible for updating the total counter). The expiry of the item is left as is.
+
+    Returns {ITEM, PRIORITY} (or an empty table if NAME has no items left).
+    ]]
+    local queue_key = state.prefix .. ':queue:' .. NAME
+    while true do
+        local highest_item = redis.call('ZPOPMAX', queue_key)
+        if #highest_item == 0 or not state.expiry_key then
+            return highest_item
+        end
+        local expires_at = redis.call('ZSCORE', state.expiry_key, NAME .. ':' .. highest_item[1])
+        if not expires_at or tonumber(expires_at) > state.now then
+            return highest_item
+        end
+        forget_item(state.prefix, NAME, highest_item[1])
+        state.expired = state.expired + 1
+    end
+end
+
+local function finish_pop(state, POPPED)
+    --[[
+    Updates the total counter for the POPPED items and the expired items dropped by `pop_highest`. If something was popped
+    and there are items left, the next blocked consumer is woken up.
+    ]]
+    local removed = POPPED + state.expired
+    if removed ~= 0 and redis.call('DECRBY', state.prefix .. ':total', removed) > 0 and POPPED ~= 0 then
+        wake_up(state.prefix)
+    end
+end
+
+local function next_due(PREFIX, RETRY)
+    --[[
+    Returns RETRY (milliseconds) or, if the first delayed item is due sooner, the milliseconds until then (at least 1).
+    Returns nothing if RETRY is not given and there are no delayed items.
+    ]]
+    local first = redis.call('ZRANGE', PREFIX .. ':delayed', 0, 0, 'WITHSCORES')
+    if #first == 0 then
+        return RETRY
+    end
+    local due = math.max(tonumber(first[2]) - now_ms(), 1)
+    return RETRY and math.min(RETRY, due) or due
+end
+
+local function current_window(WINDOW, RESOLUTION)
+    --[[
+    Returns the WINDOW as given or, if empty, the current window according to the server clock (the number of RESOLUTION
+    milliseconds periods since the epoch, modulo 60) and the milliseconds left until it ends.
+    ]]
+    if WINDOW ~= '' then
+        return WINDOW
+    end
+    local now = now_ms()
+    return tostring(math.floor(now / RESOLUTION) % 60), RESOLUTION - now % RESOLUTION
+end
+
+-- The usage scores of the names in a class start at CLASS * CLASS_SPAN (see `usage_score`).
+local CLASS_SPAN = 16777216
+
+local function open_window(PREFIX, WINDOW, LIMIT)
+    --[[
+    Loads (or creates) the state of the WINDOW. Creating a window is O(1), nothing gets copied.
+
+    Key structure (for every ITEM returned M is incremented by its cost, but only while M < limit):
+
+        PREFIX:window:WINDOW - hash of `stop` (names with a greater sequence were queued after the window started and
+                               have to wait for the next window), `last` (names up to this sequence were already
+                               considered in the window, in sequence order), `served` (count of items served in the
+                               window, used to break ties) and, once weights or classes are used, `shared` and the
+                               `weight:NAME` and `class:NAME` of every name seen in the window (see `name_share`)
+        PREFIX:usage:WINDOW - zset of (SCORE, NAME), only for the names already served in the window, SCORE being M
+                              divided by the weight of NAME, in the range of its class (see `usage_score`); names that
+                              ran empty are parked with a negated SCORE so they are not scanned again until they get
+                              refilled, names that reached their limit (or have a 0 limit) are parked with an `inf`
+                              score for the rest of the window
+        PREFIX:limits - hash of (NAME, limit), the names that have a different limit than LIMIT
+        PREFIX:weights - hash of (NAME, weight), the names that have a different weight than 1
+        PREFIX:classes - hash of (NAME, class), the names that have a different class than 0
+
+    As long as nothing was served in the window the `stop` is moved forward, thus new names are eligible right away.
+    The delayed items that are due are moved into their queues first (see `promote_due`), then some of the expired items
+    are dropped (see `purge_expired`).
+    ]]
+    local now = now_ms()
+    promote_due(PREFIX, now)
+    purge_expired(PREFIX, PURGE_BATCH, now)
+    local names_key = PREFIX .. ':names'
+    local window_key = PREFIX .. ':window:' .. WINDOW
+    local usage_key = PREFIX .. ':usage:' .. WINDOW
+    local state = redis.call('HMGET', window_key, 'last', 'stop', 'served', 'shared')
+    local last, stop, served = tonumber(state[1]), tonumber(state[2]), tonumber(state[3] or 0)
+    if not stop or served == 0 then
+        if not stop then
+            -- Names queued by older versions have a 0 score, give them a sequence number.
+            for _, name in ipairs(redis.call('ZRANGE', names_key, 0, 0, 'BYSCORE')) do
+                redis.call('ZADD', names_key, redis.call('INCR', PREFIX .. ':sequence'), name)
+            end
+        end
+        local sequence = tonumber(redis.call('GET', PREFIX .. ':sequence') or 0)
+        -- The names already parked in the usage key (paused, or waiting for the lower classes) are not considered again.
+        local considered = stop and redis.call('EXISTS', usage_key) == 1 and last or 0
+        if sequence ~= stop or considered ~= last then
+            last = considered
+            stop = sequence
+            redis.call('HSET', window_key, 'last', last, 'stop', stop)
+        end
+    end
+    return {
+        prefix = PREFIX,
+        name = WINDOW,
+        names_key = names_key,
+        window_key = window_key,
+        usage_key = usage_key,
+        last = last,
+        stop = stop,
+        served = served,
+        changed = false,
+        limit = LIMIT,
+        limits_key = redis.call('EXISTS', PREFIX .. ':limits') == 1 and PREFIX .. ':limits',
+        limits = {},
+        shared = state[4] or redis.call('EXISTS', PREFIX .. ':weights', PREFIX .. ':classes') > 0,
+        shares = {},
+        now = now,
+        expiry_key = redis.call('EXISTS', PREFIX .. ':expiry') == 1 and PREFIX .. ':expiry',
+        expired = 0,
+        scanned = 0,
+    }
+end
+
+local function close_window(window, TTL)
+    --[[
+    Saves the WINDOW state and sets the expiry of its keys: TTL milliseconds after the window was created (so that the
+    TTL can tell consumers when they can retry).
+
+    New windows are registered in PREFIX:windows (a zset of (EXPIRY, WINDOW), EXPIRY being in milliseconds) so that
+    RTQ_CLEANUP can find their keys. Expired windows are removed from it at the same time.
+    ]]
+    if window.changed then
+        redis.call('HSET', window.window_key, 'last', window.last, 'served', window.served)
+    end
+    if redis.call('PEXPIRE', window.window_key, TTL, 'NX') == 1 then
+        local now = now_ms()
+        local windows_key = window.prefix .. ':windows'
+        redis.call('ZREMRANGEBYSCORE', windows_key, '-inf', now)
+        redis.call('ZADD', windows_key, now + TTL, window.name)
+    end
+    redis.call('PEXPIRE', window.usage_key, redis.call('PTTL', window.window_key), 'NX')
+end
+
+local function name_limit(window, name)
+    --[[
+    Returns the limit of NAME (the PREFIX:limits hash is only read if it exists, and only once for every name).
+    ]]
+    local limit = window.limits[name]
+    if not limit then
+        limit = window.limits_key and tonumber(redis.call('HGET', window.limits_key, name)) or window.limit
+        window.limits[name] = limit
+    end
+    return limit
+end
+
+local function name_share(window, name)
+    --[[
+    Returns the weight and the class of NAME. They are read from PREFIX:weights and PREFIX:classes (only if any of them
+    exist) the first time NAME is seen in the WINDOW, and saved in the window hash: the usage scores depend on them, thus
+    they don't change until the window ends. Names already in the usage key before that keep the defaults.
+    ]]
+    local share = window.shares[name]
+    if not share then
+        share = { 1, 0 }
+        if window.shared then
+            local saved = redis.call('HMGET', window.window_key, 'weight:' .. name, 'class:' .. name)
+            if saved[1] then
+                share = { tonumber(saved[1]), tonumber(saved[2]) }
+            elseif window.usage_key and not redis.call('ZSCORE', window.usage_key, name) then
+                share = {
+                    tonumber(redis.call('HGET', window.prefix .. ':weights', name) or 1),
+                    tonumber(redis.call('HGET', window.prefix .. ':classes', name) or 0),
+                }
+                redis.call('HSET', window.window_key, 'shared', 1, 'weight:' .. name, share[1], 'class:' .. name, share[2])
+            end
+        end
+        window.shares[name] = share
+    end
+    return share[1], share[2]
+end
+
+local function usage_score(window, name, usage)
+    --[[
+    Returns the score of NAME in the usage key, for a USAGE (the sum of the costs of the items served in the window):
+
+        CLASS * CLASS_SPAN + (USAGE + TIE) / WEIGHT
+
+    thus names in a lower class always come first (strict priority) and, in the same class, the names that got the least
+    relative to their weight (weighted fair queueing: a name with weight 3 gets 3 items for every item of a name with
+    weight 1). TIE (less than 0.25) grows with every item served in the window, so names with the same usage are served
+    in the order they got there (instead of the names that sort first being always favored).
+    ]]
+    local weight, class = name_share(window, name)
+    return class * CLASS_SPAN + (usage + window.served % 65536 / 262144) / weight
+end
+
+local function score_usage(window, name, score)
+    --[[
+    Returns the USAGE of NAME from its SCORE in the usage key (the reverse of `usage_score`).
+    ]]
+    local weight, class = name_share(window, name)
+    return math.floor((score - class * CLASS_SPAN) * weight + 0.5)
+end
+
+local function take_item(window, name, usage)
+    --[[
+    Pops the highest priority item of NAME and charges its cost (1 unless given to RTQ_PUSH) in the window usage, USAGE
+    being what NAME used so far in the window.
+    Names that run empty are removed from the names key. Names that reach their limit are parked, and so are the names
+    whose next item costs more than what's left of their limit (the item waits for the next window, where it's popped
+    first). Items that cost more than the limit only fit when the name didn't use anything in the window. Expired items
+    are dropped before anything is charged (see `pop_highest`).
+
+    Returns ITEM, PRIORITY (or nothing if NAME was already empty or its next item didn't fit).
+    ]]
+    local queue_key = window.prefix .. ':queue:' .. name
+    local highest_item = pop_highest(window, name)
+    if #highest_item == 0 then
+        redis.call('ZREM', window.names_key, name)
+        if usage > 0 then
+            redis.call('ZADD', window.usage_key, -usage_score(window, name, usage), name)
+        else
+            redis.call('ZREM', window.usage_key, name)
+        end
+        return
+    end
+    local cost_key = window.prefix .. ':cost:' .. name
+    local cost = tonumber(redis.call('HGET', cost_key, highest_item[1]) or 1)
+    if usage > 0 and usage + cost > name_limit(window, name) then
+        redis.call('ZADD', queue_key, highest_item[2], highest_item[1])
+        redis.call('ZADD', window.usage_key, 'inf', name)
+        return
+    end
+    if cost ~= 1 then
+        redis.call('HDEL', cost_key, highest_item[1])
+    end
+    if window.expiry_key then
+        redis.call('ZREM', window.expiry_key, name .. ':' .. highest_item[1])
+    end
+    local value = take_body(window.prefix, name, highest_item[1])
+    usage = usage + cost
+    window.served = window.served + 1
+    window.changed = true
+    if redis.call('EXISTS', queue_key) == 0 then
+        redis.call('ZREM', window.names_key, name)
+        redis.call('ZADD', window.usage_key, -usage_score(window, name, usage), name)
+    elseif usage >= name_limit(window, name) then
+        redis.call('ZADD', window.usage_key, 'inf', name)
+    else
+        redis.call('ZADD', window.usage_key, usage_score(window, name, usage), name)
+    end
+    return value, highest_item[2]
+end
+
+local function pop_item(window, PAGE_SIZE)
+    --[[
+    Pops the highest priority item from the NAME with the lowest usage score (see `usage_score`) that is still under its
+    limit:
+
+    * first the names not served yet in the window (in the order they were queued, up to the `stop` of the window), the
+      names not in class 0 are only added in the usage key
+    * then the names queued after the window started are only looked up in the usage key: the ones that got refilled
+      after running empty in this window are put back in there
+    * then the names in the usage key (lowest score first)
+
+    Names are read PAGE_SIZE at a time, another page is only read if all the names in the current page were empty.
+
+    Returns NAME, ITEM, PRIORITY (or nothing). The caller is responsible for updating the total counter and closing the
+    window.
+    ]]
+    while window.last < window.stop do
+        local names = redis.call('ZRANGE', window.names_key, '(' .. window.last, window.stop, 'BYSCORE', 'LIMIT', 0, PAGE_SIZE, 'WITHSCORES')
+        if #names == 0 then
+            window.last = window.stop
+            window.changed = true
+            break
+        end
+        for i = 1, #names, 2 do
+            local name = names[i]
+            window.scanned = window.scanned + 1
+            window.last = tonumber(names[i + 1])
+            window.changed = true
+            local score = redis.call('ZSCORE', window.usage_key, name)
+            if score then
+                if tonumber(score) < 0 then
+                    redis.call('ZADD', window.usage_key, -score, name)
+                end
+            elseif name_limit(window, name) == 0 then
+                -- Paused, parked for the rest of the window.
+                redis.call('ZADD', window.usage_key, 'inf', name)
+            else
+                local _, class = name_share(window, name)
+                if class > 0 then
+                    -- Waits for the names in the lower classes.
+                    redis.call('ZADD', window.usage_key, usage_score(window, name, 0), name)
+                else
+                    local value, priority = take_item(window, name, 0)
+                    if value then
+                        return name, value, priority
+                    end
+                end
+            end
+        end
+    end
+
+    -- Until something is served the stop moves forward (see `open_window`), and nothing could have run empty yet.
+    while window.served > 0 do
+        local names = redis.call('ZRANGE', window.names_key, '(' .. window.last, '+inf', 'BYSCORE', 'LIMIT', 0, PAGE_SIZE, 'WITHSCORES')
+        if #names == 0 then
+            break
+        end
+        local page = {}
+        for i = 1, #names, 2 do
+            page[#page + 1] = names[i]
+        end
+        local scores = redis.call('ZMSCORE', window.usage_key, unpack(page))
+        for i = 1, #page do
+            window.scanned = window.scanned + 1
+            -- Got refilled after running empty in this window, put it back in the usage key.
+            if scores[i] and tonumber(scores[i]) < 0 then
+                redis.call('ZADD', window.usage_key, -scores[i], page[i])
+            end
+        end
+        window.last = tonumber(names[#names])
+        window.changed = true
+    end
+
+    while true do
+        -- Empty or exhausted names get parked (out of this range) so the next page starts from the beginning again.
+        local names = redis.call('ZRANGE', window.usage_key, '(0', '(inf', 'BYSCORE', 'LIMIT', 0, PAGE_SIZE, 'WITHSCORES')
+        if #names == 0 then
+            break
+        end
+        for i = 1, #names, 2 do
+            local name = names[i]
+            local usage = score_usage(window, name, tonumber(names[i + 1]))
+            window.scanned = window.scanned + 1
+            if usage >= name_limit(window, name) then
+                -- Only happens if the limit was lowered (or for usage keys from older versions).
+                redis.call('ZADD', window.usage_key, 'inf', name)
+            else
+                local value, priority = take_item(window, name, usage)
+                if value then
+                    return name, value, priority
+                end
+            end
+        end
+    end
+end
+
+local function gcra_open(PREFIX, LIMIT, RESOLUTION, BURST, PAGE_SIZE)
+    --[[
+    Loads the state used by the GCRA (generic cell rate algorithm) functions: every NAME gets an item every
+    RESOLUTION / limit seconds, with BURST items allowed at once after being idle. Pops are spread evenly thus there are
+    no bursts when windows change. Items with a cost count as that many items.
+
+    Key structure (times are in milliseconds, from the server clock):
+
+        PREFIX:schedule - zset of (ALLOWED_AT, NAME), for the names that have items
+        PREFIX:tat - zset of (TAT, NAME), the theoretical arrival time of the next item for the names served recently
+                     (names with a TAT in the past are removed)
+        PREFIX:gcra - hash of `last` (names up to this sequence in PREFIX:names were added in the schedule)
+
+    The delayed items that are due are moved into their queues first (see `promote_due`), some of the expired items are
+    dropped (see `purge_expired`), then the names added in PREFIX:names since the last call are added in the schedule.
+    ]]
+    local now = now_ms()
+    promote_due(PREFIX, now)
+    purge_expired(PREFIX, PURGE_BATCH, now)
+    local state = {
+        prefix = PREFIX,
+        names_key = PREFIX .. ':names',
+        schedule_key = PREFIX .. ':schedule',
+        tat_key = PREFIX .. ':tat',
+        now = now,
+        period = RESOLUTION * 1000,
+        burst = BURST,
+        limit = LIMIT,
+        limits_key = redis.call('EXISTS', PREFIX .. ':limits') == 1 and PREFIX .. ':limits',
+        limits = {},
+        expiry_key = redis.call('EXISTS', PREFIX .. ':expiry') == 1 and PREFIX .. ':expiry',
+        expired = 0,
+        scanned = 0,
+    }
+    redis.call('ZREMRANGEBYSCORE', state.tat_key, '-inf', state.now)
+
+    local gcra_key = PREFIX .. ':gcra'
+    local last = tonumber(redis.call('HGET', gcra_key, 'last') or 0)
+    local changed = false
+    while true do
+        local names = redis.call('ZRANGE', state.names_key, '(' .. last, '+inf', 'BYSCORE', 'LIMIT', 0, PAGE_SIZE, 'WITHSCORES')
+        if #names == 0 then
+            break
+        end
+        for i = 1, #names, 2 do
+            local name = names[i]
+            local allowed_at = 0
+            local tat = redis.call('ZSCORE', state.tat_key, name)
+            if tat then
+                local limit = name_limit(state, name)
+                allowed_at = limit > 0 and tat - (state.burst - 1) * state.period / limit or 0
+            end
+            redis.call('ZADD', state.schedule_key, 'NX', allowed_at, name)
+            last = names[i + 1]
+            changed = true
+        end
+    end
+    if changed then
+        redis.call('HSET', gcra_key, 'last', last)
+    end
+    return state
+end
+
+local function gcra_pop_item(state, PAGE_SIZE)
+    --[[
+    Pops the highest priority item from the NAME that is allowed since the longest time.
+
+    Returns NAME, ITEM, PRIORITY (or nothing). The caller is responsible for updating the total counter.
+    ]]
+    while true do
+        local names = redis.call('ZRANGE', state.schedule_key, '-inf', state.now, 'BYSCORE', 'LIMIT', 0, PAGE_SIZE)
+        if #names == 0 then
+            break
+        end
+        for _, name in ipairs(names) do
+            local limit = name_limit(state, name)
+            state.scanned = state.scanned + 1
+            local queue_key = state.prefix .. ':queue:' .. name
+            if limit <= 0 then
+                -- Check again later, the limit might change.
+                redis.call('ZADD', state.schedule_key, state.now + state.period, name)
+            else
+                local highest_item = pop_highest(state, name)
+                if #highest_item ~= 0 then
+                    local cost_key = state.prefix .. ':cost:' .. name
+                    local cost = tonumber(redis.call('HGET', cost_key, highest_item[1]) or 1)
+                    if cost ~= 1 then
+                        redis.call('HDEL', cost_key, highest_item[1])
+                    end
+                    if state.expiry_key then
+                        redis.call('ZREM', state.expiry_key, name .. ':' .. highest_item[1])
+                    end
+                    local interval = state.period / limit
+                    -- An item that costs N is charged as N items (the next item of NAME is delayed accordingly).
+                    local tat = math.max(tonumber(redis.call('ZSCORE', state.tat_key, name) or 0), state.now) + interval * cost
+                    redis.call('ZADD', state.tat_key, tat, name)
+                    if redis.call('EXISTS', queue_key) == 0 then
+                        redis.call('ZREM', state.schedule_key, name)
+                        redis.call('ZREM', state.names_key, name)
+                    else
+                        redis.call('ZADD', state.schedule_key, tat - (state.burst - 1) * interval, name)
+                    end
+                    return name, take_body(state.prefix, name, highest_item[1]), highest_item[2]
+                end
+                redis.call('ZREM', state.schedule_key, name)
+                redis.call('ZREM', state.names_key, name)
+            end
+        end
+    end
+end
+
+local function with_stats(STATS, reply, state)
+    --[[
+    Returns the REPLY as is or, if STATS was given, {REPLY, SCANNED}: SCANNED being how many names were looked at.
+    ]]
+    if STATS then
+        return { reply or false, state.scanned }
+    end
+    return reply
+end
+
+local function gcra_args(NAME, KEYS, ARGV, COUNT_ARGS)
+    --[[
+    Validates and unpacks the arguments of the RTQ_GCRA_* functions.
+    ]]
+    if #KEYS ~= 1 then
+        error(NAME .. ' expected 1 key argument (the prefix), but got ' .. #KEYS .. ' key arguments!')
+    end
+    if #ARGV ~= 4 + COUNT_ARGS and #ARGV ~= 5 + COUNT_ARGS then
+        error(NAME .. ' expected ' .. 4 + COUNT_ARGS .. ' arguments (or ' .. 5 + COUNT_ARGS .. ' with STATS), but got ' .. #ARGV .. ' arguments!')
+    end
+    local PAGE_SIZE = tonumber(ARGV[4])
+    return gcra_open(KEYS[1], tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), PAGE_SIZE), PAGE_SIZE, ARGV[5 + COUNT_ARGS]
+end
+
 redis.register_function('RTQ_PUSH', function(KEYS, ARGV)
     --[[
-    This script takes no KEYS arguments.
+    KEYS arguments:
+        PREFIX: Key prefix to use for any generated key. All the keys are derived from it, thus in a Redis Cluster it
+                must have a hash tag (e.g.: `{myqueue}`) so that they are all in the same slot.
 
     ARGV arguments:
-        PREFIX: Key prefix to use for any generated key.
         NAME: Name of the queue.
         PRIORITY: Priority of the item.
-        DATA: Item value.
+        DATA: Item value (or its content hash if BODY is given).
+        COST (optional): How much of the NAME's limit the item uses up when popped. Default: 1.
+        BODY (optional): The item value, to store out of line: the queue only holds DATA (thus items with the same hash
+                         are deduplicated) and the pop functions return BODY instead. Empty means the item is inline.
+        NOT_BEFORE (optional): Server time (milliseconds since the epoch) before which the item must not be popped. If
+                               it's in the future the item is delayed (see `delay_item`), it's queued when it's due.
+                               Empty means the item is queued right away.
+        EXPIRES_AT (optional): Server time (milliseconds since the epoch) after which the item is dropped instead of popped
+                               (see `set_expiry`). Nothing is pushed if the item would expire before it's due.
 
-    Typical key structure (for every ITEM returned M is incremented, but only while M < limit):
+    Typical key structure:
 
         PREFIX:queue:NAME - zset of ITEM
+        PREFIX:cost:NAME - hash of (ITEM, COST), only for the items that don't cost 1
+        PREFIX:data:NAME - hash of (ITEM, BODY), only for the items stored out of line
         PREFIX:total - int of total ITEM count
-        PREFIX:names - zset of NAME, also used as a template for `PREFIX:usage:WINDOW`
+        PREFIX:names - zset of (SEQUENCE, NAME)
+        PREFIX:sequence - int of the last SEQUENCE given to a NAME
+        PREFIX:wakeup - list used to wake up blocked consumers
+        PREFIX:delayed, PREFIX:delayed-items - the items that are not due yet (see `delay_item`)
+        PREFIX:expiry - zset of (EXPIRES_AT, NAME:ITEM), only for the items that expire
+
+    Returns 1 if the ITEM was added (or delayed) or 0 if it was already queued (only its priority gets raised, if higher),
+    already delayed or already expired.
     ]]
-    if #KEYS ~= 0 then
-        error('RTQ_PUSH takes no key arguments!')
+    if #KEYS ~= 1 then
+        error('RTQ_PUSH expected 1 key argument (the prefix), but got ' .. #KEYS .. ' key arguments!')
     end
-    if #ARGV ~= 4 then
-        error('RTQ_PUSH expected 4 arguments, but got ' .. #ARGV .. ' arguments!')
+    if #ARGV < 3 or #ARGV > 7 then
+        error('RTQ_PUSH expected 3 to 7 arguments (NAME, PRIORITY, DATA, COST, BODY, NOT_BEFORE, EXPIRES_AT), but got ' .. #ARGV .. ' arguments!')
     end
-    local PREFIX = ARGV[1]
-    local NAME = ARGV[2]
-    local PRIORITY = ARGV[3]
-    local DATA = ARGV[4]
+    local PREFIX = KEYS[1]
+    local NAME = ARGV[1]
+    local PRIORITY = ARGV[2]
+    local DATA = ARGV[3]
+    local COST = ARGV[4] or 1
+    local BODY = ARGV[5] or ''
+    local NOT_BEFORE = tonumber(ARGV[6])
+    local EXPIRES_AT = tonumber(ARGV[7])
 
-    local names_key = PREFIX .. ':names'
-    local queue_key = PREFIX .. ':queue:' .. NAME
+    if NOT_BEFORE or EXPIRES_AT then
+        local now = now_ms()
+        if EXPIRES_AT and EXPIRES_AT <= math.max(now, NOT_BEFORE or now) then
+            return 0
+        elseif NOT_BEFORE and NOT_BEFORE > now then
+            return delay_item(PREFIX, NAME, PRIORITY, DATA, COST, BODY, EXPIRES_AT, NOT_BEFORE)
+        end
+    end
     local total_key = PREFIX .. ':total'
-    local added = redis.call('ZADD', queue_key, 'GT', PRIORITY, DATA)
+    local added = add_item(PREFIX, NAME, PRIORITY, DATA, COST, BODY, EXPIRES_AT)
     if tonumber(added) > 0 then
         redis.call('INCR', total_key)
-        redis.call('ZADD', names_key, 'NX', 0, NAME)
+        add_name(PREFIX, NAME)
+        wake_up(PREFIX)
+    end
+    return added
+end)
+
+redis.register_function('RTQ_PUSH_MANY', function(KEYS, ARGV)
+    --[[
+    KEYS arguments:
+        PREFIX: Same as in RTQ_PUSH.
+
+    ARGV arguments:
+        NAME, PRIORITY, DATA, COST, BODY: Repeated for every item (same meaning as in RTQ_PUSH).
+
+    Same key structure as RTQ_PUSH. The total counter is only incremented once, with the count of items actually added.
+
+    Returns the count of items actually added (items already in the queue only get their priority raised).
+    ]]
+    if #KEYS ~= 1 then
+        error('RTQ_PUSH_MANY expected 1 key argument (the prefix), but got ' .. #KEYS .. ' key arguments!')
+    end
+    if #ARGV % 5 ~= 0 then
+        error('RTQ_PUSH_MANY expected 5 * N arguments, but got ' .. #ARGV .. ' arguments!')
+    end
+    local PREFIX = KEYS[1]
+
+    local total_key = PREFIX .. ':total'
+    local added = 0
+    local seen = {}
+    for i = 1, #ARGV, 5 do
+        local name = ARGV[i]
+        if tonumber(add_item(PREFIX, name, ARGV[i + 1], ARGV[i + 2], ARGV[i + 3], ARGV[i + 4])) > 0 then
+            added = added + 1
+            if not seen[name] then
+                seen[name] = true
+                add_name(PREFIX, name)
+            end
+        end
+    end
+    if added > 0 then
+        redis.call('INCRBY', total_key, added)
+        wake_up(PREFIX)
     end
+    return added
 end)
 
 redis.register_function('RTQ_POP', function(KEYS, ARGV)
     --[[
-    This script takes no KEYS arguments.
+    KEYS arguments:
+        PREFIX: Same as in RTQ_PUSH.
 
     ARGV arguments:
-        PREFIX: Key prefix to use for any generated key.
         WINDOW: The current window. Usually the current second or minute. Could in theory be a composite of the current minute and other data.
+                If empty, the window is derived from the server clock and RESOLUTION, and it expires exactly when it ends.
         LIMIT: The strict ITEM limit for the WINDOW. This script will not return anything if the limit would be reached.
+               Names in the PREFIX:limits hash use the limit from there instead.
         RESOLUTION: Seconds to use as WINDOW key expiry. If you want to have 1 minute windows use value '60'.
+                    Can have a fractional part (millisecond precision is used), e.g.: '0.2'.
+        PAGE_SIZE: How many names to read at a time when looking for an eligible name.
+        STATS (optional): If given, the reply is wrapped as {REPLY, SCANNED}, SCANNED being how many names were looked at.
 
-    Typical key structure (for every ITEM returned M is incremented, but only while M < limit):
+    Typical key structure (for every ITEM returned M is incremented by its cost, but only while M < limit):
 
-        PREFIX:usage:WINDOW - zlist of (M, NAME)
+        PREFIX:window:WINDOW - hash of the window state (see `open_window`)
+        PREFIX:usage:WINDOW - zset of (M, NAME), only for the names already served in the window
+        PREFIX:windows - zset of (EXPIRY, WINDOW), the windows that might still exist (see `close_window`)
+        PREFIX:limits - hash of (NAME, limit), for the names that don't use LIMIT
         PREFIX:queue:NAME - zset of ITEM
         PREFIX:total - int of total ITEM count
-        PREFIX:names - zset of NAME
+        PREFIX:names - zset of (SEQUENCE, NAME)
+        PREFIX:wakeup - list used to wake up blocked consumers (written if there are items left)
+        PREFIX:delayed, PREFIX:delayed-items - the delayed items, moved into their queues once due (see `promote_due`)
     ]]
-    if #KEYS ~= 0 then
-        error('RTQ_POP takes no key arguments!')
+    if #KEYS ~= 1 then
+        error('RTQ_POP expected 1 key argument (the prefix), but got ' .. #KEYS .. ' key arguments!')
     end
-    if #ARGV ~= 4 then
-        error('RTQ_POP expected 4 arguments, but got ' .. #ARGV .. ' arguments!')
+    if #ARGV ~= 4 and #ARGV ~= 5 then
+        error('RTQ_POP expected 4 arguments (or 5 with STATS), but got ' .. #ARGV .. ' arguments!')
     end
-    local PREFIX = ARGV[1]
-    local WINDOW = ARGV[2]
-    local LIMIT = tonumber(ARGV[3])
-    local RESOLUTION = ARGV[4]
+    local PREFIX = KEYS[1]
+    local LIMIT = tonumber(ARGV[2])
+    local RESOLUTION = math.floor(tonumber(ARGV[3]) * 1000 + 0.5)
+    local PAGE_SIZE = tonumber(ARGV[4])
+    local WINDOW, TTL = current_window(ARGV[1], RESOLUTION)
+    local STATS = ARGV[5]
 
-    local names_key = PREFIX .. ':names'
-    local total_key = PREFIX .. ':total'
-    local usage_key = PREFIX .. ':usage:' .. WINDOW
+    local window = open_window(PREFIX, WINDOW, LIMIT)
 
-    local usage_count = redis.call('ZCARD', usage_key)
-    if usage_count == 0 then
-        redis.call('COPY', names_key, usage_key, 'REPLACE')
+    local _, value = pop_item(window, PAGE_SIZE)
+    close_window(window, TTL or RESOLUTION)
+    finish_pop(window, value and 1 or 0)
+    return with_stats(STATS, value, window)
+end)
+
+local function window_miss(window)
+    --[[
+    Returns the RTQ_POP_EX reply for when nothing could be popped from the (closed) WINDOW: {2, PTTL} if there are items
+    left, otherwise {0} or {0, DUE}.
+    ]]
+    if tonumber(redis.call('GET', window.prefix .. ':total') or 0) > 0 then
+        return { 2, next_due(window.prefix, math.max(redis.call('PTTL', window.window_key), 1)) }
     end
-    redis.call('EXPIRE', usage_key, RESOLUTION)
+    return { 0, next_due(window.prefix) }
+end
+
+local function window_pop_many(NAME, KEYS, ARGV)
+    --[[
+    Validates the arguments of RTQ_POP_MANY (or RTQ_POP_MANY_EX) and pops up to COUNT items.
+
+    Returns the flat list of NAME, ITEM pairs, the (closed) window and STATS.
+    ]]
+    if #KEYS ~= 1 then
+        error(NAME .. ' expected 1 key argument (the prefix), but got ' .. #KEYS .. ' key arguments!')
+    end
+    if #ARGV ~= 5 and #ARGV ~= 6 then
+        error(NAME .. ' expected 5 arguments (or 6 with STATS), but got ' .. #ARGV .. ' arguments!')
+    end
+    local PREFIX = KEYS[1]
+    local LIMIT = tonumber(ARGV[2])
+    local RESOLUTION = math.floor(tonumber(ARGV[3]) * 1000 + 0.5)
+    local PAGE_SIZE = tonumber(ARGV[4])
+    local WINDOW, TTL = current_window(ARGV[1], RESOLUTION)
+    local COUNT = tonumber(ARGV[5])
+
+    local window = open_window(PREFIX, WINDOW, LIMIT)
+
+    local result = {}
+    for _ = 1, COUNT do
+        local name, value = pop_item(window, PAGE_SIZE)
+        if not value then
+            break
+        end
+        result[#result + 1] = name
+        result[#result + 1] = value
+    end
+    close_window(window, TTL or RESOLUTION)
+    finish_pop(window, #result / 2)
+    return result, window, ARGV[6]
+end
+
+redis.register_function('RTQ_POP_EX', function(KEYS, ARGV)
+    --[[
+    KEYS arguments:
+        PREFIX: Same as in RTQ_PUSH.
+
+    ARGV arguments:
+        WINDOW, LIMIT, RESOLUTION, PAGE_SIZE, STATS: Same as in RTQ_POP.
 
-    local names = redis.call('ZRANGE', usage_key, 0, '(' .. LIMIT, 'BYSCORE')
-    for _, name in ipairs(names) do
+    Same key structure as RTQ_POP.
+
+    Returns one of:
+        {1, NAME, ITEM, PRIORITY} - an item was popped
+        {0} - nothing was popped because the queue is empty
+        {0, DUE} - same, but there are delayed items: DUE being the milliseconds until the first one is due
+        {2, PTTL} - nothing was popped because of throttling, PTTL being the milliseconds left until the WINDOW expires (or
+                    until the first delayed item is due, if sooner)
+    ]]
+    if #KEYS ~= 1 then
+        error('RTQ_POP_EX expected 1 key argument (the prefix), but got ' .. #KEYS .. ' key arguments!')
+    end
+    if #ARGV ~= 4 and #ARGV ~= 5 then
+        error('RTQ_POP_EX expected 4 arguments (or 5 with STATS), but got ' .. #ARGV .. ' arguments!')
+    end
+    local PREFIX = KEYS[1]
+    local LIMIT = tonumber(ARGV[2])
+    local RESOLUTION = math.floor(tonumber(ARGV[3]) * 1000 + 0.5)
+    local PAGE_SIZE = tonumber(ARGV[4])
+    local WINDOW, TTL = current_window(ARGV[1], RESOLUTION)
+    local STATS = ARGV[5]
+
+    local window = open_window(PREFIX, WINDOW, LIMIT)
+
+    local name, value, priority = pop_item(window, PAGE_SIZE)
+    close_window(window, TTL or RESOLUTION)
+    finish_pop(window, value and 1 or 0)
+    if value then
+        return with_stats(STATS, { 1, name, value, priority }, window)
+    end
+    return with_stats(STATS, window_miss(window), window)
+end)
+
+redis.register_function('RTQ_POP_MANY', function(KEYS, ARGV)
+    --[[
+    KEYS arguments:
+        PREFIX: Same as in RTQ_PUSH.
+
+    ARGV arguments:
+        WINDOW, LIMIT, RESOLUTION, PAGE_SIZE: Same as in RTQ_POP.
+        COUNT: Maximum number of items to return.
+        STATS (optional): Same as in RTQ_POP.
+
+    Same key structure as RTQ_POP. Items are taken in the same order as COUNT successive RTQ_POP calls would take them.
+
+    Returns a flat list of NAME, ITEM pairs (empty if nothing is available).
+    ]]
+    local result, window, STATS = window_pop_many('RTQ_POP_MANY', KEYS, ARGV)
+    return with_stats(STATS, result, window)
+end)
+
+redis.register_function('RTQ_POP_MANY_EX', function(KEYS, ARGV)
+    --[[
+    KEYS arguments:
+        PREFIX: Same as in RTQ_PUSH.
+
+    ARGV arguments:
+        WINDOW, LIMIT, RESOLUTION, PAGE_SIZE, COUNT, STATS: Same as in RTQ_POP_MANY.
+
+    Same as RTQ_POP_MANY, but also tells why less than COUNT items were popped (saves an RTQ_POP_EX call to find out).
+
+    Returns {PAIRS, MISS}: PAIRS being the flat list of NAME, ITEM pairs and MISS being nil if COUNT items were popped,
+    otherwise the same as RTQ_POP_EX returns when nothing was popped.
+    ]]
+    local result, window, STATS = window_pop_many('RTQ_POP_MANY_EX', KEYS, ARGV)
+    local miss = false
+    if #result / 2 < tonumber(ARGV[5]) then
+        miss = window_miss(window)
+    end
+    return with_stats(STATS, { result, miss }, window)
+end)
+
+redis.register_function('RTQ_GCRA_POP', function(KEYS, ARGV)
+    --[[
+    KEYS arguments:
+        PREFIX: Same as in RTQ_PUSH.
+
+    ARGV arguments:
+        LIMIT: How many items a NAME gets every RESOLUTION (names in the PREFIX:limits hash use the limit from there).
+        RESOLUTION: Seconds.
+        BURST: How many items a NAME can get at once (after being idle).
+        PAGE_SIZE: How many names to read at a time.
+        STATS (optional): Same as in RTQ_POP.
+
+    Key structure: see `gcra_open`. Do not mix with the RTQ_POP* functions on the same PREFIX.
+    ]]
+    local state, PAGE_SIZE, STATS = gcra_args('RTQ_GCRA_POP', KEYS, ARGV, 0)
+
+    local _, value = gcra_pop_item(state, PAGE_SIZE)
+    finish_pop(state, value and 1 or 0)
+    return with_stats(STATS, value, state)
+end)
+
+local function gcra_miss(state)
+    --[[
+    Returns the RTQ_GCRA_POP_EX reply for when nothing could be popped: {2, MILLISECONDS} until the next NAME is allowed,
+    otherwise {0} or {0, DUE}.
+    ]]
+    local next = redis.call('ZRANGE', state.schedule_key, 0, 0, 'WITHSCORES')
+    if #next ~= 0 then
+        return { 2, next_due(state.prefix, math.max(math.ceil(next[2] - state.now), 1)) }
+    end
+    return { 0, next_due(state.prefix) }
+end
+
+local function gcra_pop_many(state, PAGE_SIZE, COUNT)
+    --[[
+    Pops up to COUNT items. Returns the flat list of NAME, ITEM pairs.
+    ]]
+    local result = {}
+    for _ = 1, COUNT do
+        local name, value = gcra_pop_item(state, PAGE_SIZE)
+        if not value then
+            break
+        end
+        result[#result + 1] = name
+        result[#result + 1] = value
+    end
+    finish_pop(state, #result / 2)
+    return result
+end
+
+redis.register_function('RTQ_GCRA_POP_EX', function(KEYS, ARGV)
+    --[[
+    KEYS arguments:
+        PREFIX: Same as in RTQ_PUSH.
+
+    ARGV arguments:
+        LIMIT, RESOLUTION, BURST, PAGE_SIZE, STATS: Same as in RTQ_GCRA_POP.
+
+    Returns the same as RTQ_POP_EX (for throttling, the milliseconds until the next NAME is allowed).
+    ]]
+    local state, PAGE_SIZE, STATS = gcra_args('RTQ_GCRA_POP_EX', KEYS, ARGV, 0)
+
+    local name, value, priority = gcra_pop_item(state, PAGE_SIZE)
+    finish_pop(state, value and 1 or 0)
+    if value then
+        return with_stats(STATS, { 1, name, value, priority }, state)
+    end
+    return with_stats(STATS, gcra_miss(state), state)
+end)
+
+redis.register_function('RTQ_GCRA_POP_MANY', function(KEYS, ARGV)
+    --[[
+    KEYS arguments:
+        PREFIX: Same as in RTQ_PUSH.
+
+    ARGV arguments:
+        LIMIT, RESOLUTION, BURST, PAGE_SIZE: Same as in RTQ_GCRA_POP.
+        COUNT: Maximum number of items to return.
+        STATS (optional): Same as in RTQ_POP.
+
+    Returns a flat list of NAME, ITEM pairs (empty if nothing is available).
+    ]]
+    local state, PAGE_SIZE, STATS = gcra_args('RTQ_GCRA_POP_MANY', KEYS, ARGV, 1)
+
+    local result = gcra_pop_many(state, PAGE_SIZE, tonumber(ARGV[5]))
+    return with_stats(STATS, result, state)
+end)
+
+redis.register_function('RTQ_GCRA_POP_MANY_EX', function(KEYS, ARGV)
+    --[[
+    KEYS arguments:
+        PREFIX: Same as in RTQ_PUSH.
+
+    ARGV arguments:
+        LIMIT, RESOLUTION, BURST, PAGE_SIZE, COUNT, STATS: Same as in RTQ_GCRA_POP_MANY.
+
+    Returns the same as RTQ_POP_MANY_EX.
+    ]]
+    local state, PAGE_SIZE, STATS = gcra_args('RTQ_GCRA_POP_MANY_EX', KEYS, ARGV, 1)
+    local COUNT = tonumber(ARGV[5])
+
+    local result = gcra_pop_many(state, PAGE_SIZE, COUNT)
+    local miss = false
+    if #result / 2 < COUNT then
+        miss = gcra_miss(state)
+    end
+    return with_stats(STATS, { result, miss }, state)
+end)
+
+local function top_pairs(pairs, TOP)
+    --[[
+    Sorts the {NAME, COUNT} PAIRS by COUNT (descending) and returns the first TOP as a flat list of NAME, COUNT.
+    ]]
+    table.sort(pairs, function(a, b)
+        return a[2] > b[2]
+    end)
+    local result = {}
+    for i = 1, math.min(TOP, #pairs) do
+        result[#result + 1] = pairs[i][1]
+        result[#result + 1] = pairs[i][2]
+    end
+    return result
+end
+
+redis.register_function{
+    function_name = 'RTQ_STATS',
+    flags = { 'no-writes' },
+    callback = function(KEYS, ARGV)
+        --[[
+        KEYS arguments:
+            PREFIX: Same as in RTQ_PUSH.
+
+        ARGV arguments:
+            WINDOW, LIMIT, RESOLUTION: Same as in RTQ_POP (used to read the usage of the current window).
+            TOP: How many names to return for each ranking.
+            PAGE_SIZE: How many names to look at (in PREFIX:names and in the usage of the WINDOW).
+            NAMES_CURSOR: Empty to start, afterwards the cursor returned by the previous call.
+            USAGE_CURSOR: Same as above, for the usage.
+
+        This is read-only (registered with the `no-writes` flag, thus it can be called with FCALL_RO, e.g.: on replicas). The
+        windows are not created or changed.
+
+        Returns {TOTAL, NAMES, NEXT_NAMES_CURSOR, NEXT_USAGE_CURSOR, BY_DEPTH, BY_USAGE}:
+            TOTAL - the total ITEM count
+            NAMES - the count of names that have items
+            NEXT_NAMES_CURSOR, NEXT_USAGE_CURSOR - the cursors for the next call (empty if there's nothing left)
+            BY_DEPTH - flat list of NAME, ITEM_COUNT, for the TOP names with most items in this page
+            BY_USAGE - flat list of NAME, USAGE, for the TOP most used names in this page
+        ]]
+        if #KEYS ~= 1 then
+            error('RTQ_STATS expected 1 key argument (the prefix), but got ' .. #KEYS .. ' key arguments!')
+        end
+        if #ARGV ~= 7 then
+            error('RTQ_STATS expected 7 arguments, but got ' .. #ARGV .. ' arguments!')
+        end
+        local PREFIX = KEYS[1]
+        local LIMIT = tonumber(ARGV[2])
+        local RESOLUTION = math.floor(tonumber(ARGV[3]) * 1000 + 0.5)
+        local WINDOW = current_window(ARGV[1], RESOLUTION)
+        local TOP = tonumber(ARGV[4])
+        local PAGE_SIZE = tonumber(ARGV[5])
+        local NAMES_CURSOR = ARGV[6]
+        local USAGE_CURSOR = ARGV[7]
+        local names_key = PREFIX .. ':names'
+        local window_key = PREFIX .. ':window:' .. WINDOW
+        local state = {
+            prefix = PREFIX,
+            window_key = window_key,
+            served = 0,
+            limit = LIMIT,
+            limits_key = redis.call('EXISTS', PREFIX .. ':limits') == 1 and PREFIX .. ':limits',
+            limits = {},
+            shared = redis.call('HGET', window_key, 'shared'),
+            shares = {},
+        }
+
+        local depths = {}
+        local next_names_cursor = ''
+        if NAMES_CURSOR ~= '' or USAGE_CURSOR == '' then
+            local start = NAMES_CURSOR == '' and '-inf' or '(' .. NAMES_CURSOR
+            local names = redis.call('ZRANGE', names_key, start, '+inf', 'BYSCORE', 'LIMIT', 0, PAGE_SIZE, 'WITHSCORES')
+            for i = 1, #names, 2 do
+                depths[#depths + 1] = { names[i], redis.call('ZCARD', PREFIX .. ':queue:' .. names[i]) }
+            end
+            if #names == PAGE_SIZE * 2 then
+                next_names_cursor = names[#names]
+            end
+        end
+
+        local usages = {}
+        local next_usage_cursor = ''
+        if USAGE_CURSOR ~= '' or NAMES_CURSOR == '' then
+            local offset = tonumber(USAGE_CURSOR) or 0
+            local usage = redis.call('ZRANGE', PREFIX .. ':usage:' .. WINDOW, offset, offset + PAGE_SIZE - 1, 'WITHSCORES')
+            for i = 1, #usage, 2 do
+                local count = tonumber(usage[i + 1])
+                if count == math.huge then
+                    -- Parked because it reached the limit.
+                    count = name_limit(state, usage[i])
+                else
+                    -- Negative if parked because it ran empty.
+                    count = score_usage(state, usage[i], math.abs(count))
+                end
+                if count > 0 then
+                    usages[#usages + 1] = { usage[i], count }
+                end
+            end
+            if #usage == PAGE_SIZE * 2 then
+                next_usage_cursor = tostring(offset + PAGE_SIZE)
+            end
+        end
+
+        return {
+            tonumber(redis.call('GET', PREFIX .. ':total') or 0),
+            redis.call('ZCARD', names_key),
+            next_names_cursor,
+            next_usage_cursor,
+            top_pairs(depths, TOP),
+            top_pairs(usages, TOP),
+        }
+    end,
+}
+
+redis.register_function('RTQ_EXTRACT', function(KEYS, ARGV)
+    --[[
+    KEYS arguments:
+        PREFIX: Same as in RTQ_PUSH.
+
+    ARGV arguments:
+        NAME: Repeated for every name to remove.
+
+    Removes the NAMEs with all their items (the usage in the current windows is left as is). Used to move names to another
+    queue. Expired items are dropped instead of returned.
+
+    Returns a flat list of NAME, ITEM, PRIORITY, COST (for every name the items are in priority order, the items stored out
+    of line are returned with their body).
+    ]]
+    if #KEYS ~= 1 then
+        error('RTQ_EXTRACT expected 1 key argument (the prefix), but got ' .. #KEYS .. ' key arguments!')
+    end
+    local PREFIX = KEYS[1]
+
+    local names_key = PREFIX .. ':names'
+    local expiry_key = redis.call('EXISTS', PREFIX .. ':expiry') == 1 and PREFIX .. ':expiry'
+    local now = expiry_key and now_ms()
+    local removed = 0
+    local result = {}
+    for _, name in ipairs(ARGV) do
         local queue_key = PREFIX .. ':queue:' .. name
-        local highest_item = redis.call('ZPOPMAX', queue_key)
-        if #highest_item ~= 0 then
-            local value = highest_item[1]
-            redis.call('ZINCRBY', usage_key, 1, name)
-            redis.call('DECR', total_key)
-            return value
-        else
-            redis.call('ZREM', names_key, name)
+        local cost_key = PREFIX .. ':cost:' .. name
+        local data_key = PREFIX .. ':data:' .. name
+        local items = redis.call('ZRANGE', queue_key, 0, -1, 'REV', 'WITHSCORES')
+        local costs = {}
+        local flat_costs = redis.call('HGETALL', cost_key)
+        for i = 1, #flat_costs, 2 do
+            costs[flat_costs[i]] = flat_costs[i + 1]
         end
+        local bodies = {}
+        local flat_bodies = redis.call('HGETALL', data_key)
+        for i = 1, #flat_bodies, 2 do
+            bodies[flat_bodies[i]] = flat_bodies[i + 1]
+        end
+        for i = 1, #items, 2 do
+            local expires_at
+            if expiry_key then
+                expires_at = redis.call('ZSCORE', expiry_key, name .. ':' .. items[i])
+                if expires_at then
+                    redis.call('ZREM', expiry_key, name .. ':' .. items[i])
+                end
+            end
+            if not expires_at or tonumber(expires_at) > now then
+                result[#result + 1] = name
+                result[#result + 1] = bodies[items[i]] or items[i]
+                result[#result + 1] = items[i + 1]
+                result[#result + 1] = costs[items[i]] or 1
+            end
+        end
+        removed = removed + #items / 2
+        redis.call('DEL', queue_key, cost_key, data_key)
+        redis.call('ZREM', names_key, name)
+    end
+    if removed ~= 0 then
+        redis.call('DECRBY', PREFIX .. ':total', removed)
     end
+    return result
 end)
 
-redis.register_function('RTQ_CLEANUP', function(KEYS, ARGV)
+redis.register_function('RTQ_PURGE_EXPIRED', function(KEYS, ARGV)
     --[[
-    This script takes no KEYS arguments.
+    KEYS arguments:
+        PREFIX: Same as in RTQ_PUSH.
 
     ARGV arguments:
-        PREFIX: Key prefix to cleanup.
+        BATCH: Maximum number of expired items to drop.
 
-    This will remove all keys matching PREFIX:*
+    Drops the items that expired (see `purge_expired`) without popping anything. The pops already drop some of them (and
+    skip the rest), this is for queues that are not popped often.
+
+    Returns how many items were dropped (call again until it's less than BATCH).
     ]]
-    if #KEYS ~= 0 then
-        error('RTQ_CLEANUP takes no key arguments!')
+    if #KEYS ~= 1 then
+        error('RTQ_PURGE_EXPIRED expected 1 key argument (the prefix), but got ' .. #KEYS .. ' key arguments!')
     end
     if #ARGV ~= 1 then
-        error('RTQ_CLEANUP expected 1 arguments, but got ' .. #ARGV .. ' arguments!')
+        error('RTQ_PURGE_EXPIRED expected 1 argument (the batch), but got ' .. #ARGV .. ' arguments!')
+    end
+    return purge_expired(KEYS[1], tonumber(ARGV[1]), now_ms())
+end)
+
+local function unlink_keys(keys)
+    --[[
+    Unlinks the KEYS in chunks (unpack has a limited stack). Returns how many keys existed.
+    ]]
+    local unlinked = 0
+    for i = 1, #keys, 1000 do
+        unlinked = unlinked + redis.call('UNLINK', unpack(keys, i, math.min(i + 999, #keys)))
     end
-    local PREFIX = ARGV[1]
-    local pattern = PREFIX .. ':*'
+    return unlinked
+end
+
+redis.register_function('RTQ_CLEANUP', function(KEYS, ARGV)
+    --[[
+    KEYS arguments:
+        PREFIX: Key prefix to cleanup.
+
+    ARGV arguments (optional):
+        BATCH: Only remove the keys of up to BATCH names or windows.
 
-    local cursor = '0'
-    repeat
-        local result = redis.call('SCAN', cursor, 'MATCH', pattern, 'COUNT', 1000)
-        local keys = result[2]
-        if #keys ~= 0 then
-            redis.call('DEL', unpack(keys))
+    This will remove the queue (and cost, data) keys of all the names in PREFIX:names, the keys of all the windows in
+    PREFIX:windows and the other keys of the queue (once there are no names and windows left). No keyspace scan is needed,
+    thus it can run in a Redis Cluster. The keys are removed with UNLINK (the memory is reclaimed in the background).
+
+    Returns nothing, or if BATCH was given: {UNLINKED, REMAINING}, UNLINKED being the count of keys removed and REMAINING the
+    count of names and windows left (call again until it's 0).
+    ]]
+    if #KEYS ~= 1 then
+        error('RTQ_CLEANUP expected 1 key argument (the prefix), but got ' .. #KEYS .. ' key arguments!')
+    end
+    if #ARGV > 1 then
+        error('RTQ_CLEANUP expected at most 1 argument, but got ' .. #ARGV .. ' arguments!')
+    end
+    local PREFIX = KEYS[1]
+    local BATCH = tonumber(ARGV[1])
+    local names_key = PREFIX .. ':names'
+    local windows_key = PREFIX .. ':windows'
+    local total_key = PREFIX .. ':total'
+
+    local keys = {}
+    local names, windows
+    if BATCH then
+        names = redis.call('ZPOPMIN', names_key, BATCH)
+        windows = #names / 2 < BATCH and redis.call('ZPOPMIN', windows_key, BATCH - #names / 2) or {}
+    else
+        names = redis.call('ZRANGE', names_key, 0, -1, 'WITHSCORES')
+        windows = redis.call('ZRANGE', windows_key, 0, -1, 'WITHSCORES')
+    end
+    for i = 1, #names, 2 do
+        local queue_key = PREFIX .. ':queue:' .. names[i]
+        if BATCH then
+            -- the queue stays consistent while it's being cleaned up
+            local count = redis.call('ZCARD', queue_key)
+            if count ~= 0 then
+                redis.call('DECRBY', total_key, count)
+            end
+        end
+        keys[#keys + 1] = queue_key
+        keys[#keys + 1] = PREFIX .. ':cost:' .. names[i]
+        keys[#keys + 1] = PREFIX .. ':data:' .. names[i]
+    end
+    for i = 1, #windows, 2 do
+        keys[#keys + 1] = PREFIX .. ':window:' .. windows[i]
+        keys[#keys + 1] = PREFIX .. ':usage:' .. windows[i]
+    end
+
+    local remaining = 0
+    if BATCH then
+        remaining = redis.call('ZCARD', names_key) + redis.call('ZCARD', windows_key)
+    end
+    if remaining == 0 then
+        for _, suffix in ipairs({ 'total', 'names', 'sequence', 'wakeup', 'windows', 'limits', 'weights', 'classes', 'schedule', 'tat', 'gcra', 'delayed', 'delayed-items', 'expiry' }) do
+            keys[#keys + 1] = PREFIX .. ':' .. suffix
         end
-        cursor = result[1]
-    until cursor == '0'
+    end
+    local unlinked = unlink_keys(keys)
+    if BATCH then
+        return { unlinked, remaining }
+    end
 end)
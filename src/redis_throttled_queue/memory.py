@@ -0,0 +1,1179 @@
+import asyncio
+import heapq
+import threading
+from bisect import bisect_right
+from math import ceil
+from math import floor
+from math import inf
+from time import monotonic
+from time import time
+from typing import Optional
+from typing import Union
+
+from redis.exceptions import ResponseError
+
+# Same as in the library (see ``usage_score``).
+CLASS_SPAN = 16777216
+# Same as in the library (see ``promote_due``).
+PROMOTE_BATCH = 100
+# Same as in the library (see ``purge_expired``).
+PURGE_BATCH = 100
+# The functions registered with the ``no-writes`` flag in the library (the only ones ``fcall_ro`` can call).
+_READ_ONLY = ('RTQ_STATS',)
+# The hashes that can be read and written with the hash commands.
+_HASHES = ('limits', 'weights', 'classes')
+
+
+class _Reversed:
+    """
+    Wraps a member so that a heap pops the greatest one first (like ``ZPOPMAX`` does for members with the same score).
+    """
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return self.value > other.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+class _Items:
+    """
+    The items of a name (what ``PREFIX:queue:NAME`` holds), popped in priority order, the costs of the items that don't
+    cost 1 (what ``PREFIX:cost:NAME`` holds) and the bodies of the items stored out of line (what ``PREFIX:data:NAME``
+    holds). Items that get their priority raised leave stale entries in the heap, these are skipped when popping.
+    """
+
+    def __init__(self):
+        self.scores = {}
+        self.costs = {}
+        self.bodies = {}
+        self._heap = []
+
+    def __len__(self):
+        return len(self.scores)
+
+    def add(self, item, score: float) -> bool:
+        """
+        Same as ``ZADD GT``: adds the item or raises its score. Returns ``True`` if the item was added.
+        """
+        current = self.scores.get(item)
+        if current is None or score > current:
+            self.scores[item] = score
+            if len(self._heap) > 2 * len(self.scores) + 16:
+                self._heap = [(-score, _Reversed(item)) for item, score in self.scores.items()]
+                heapq.heapify(self._heap)
+            else:
+                heapq.heappush(self._heap, (-score, _Reversed(item)))
+        return current is None
+
+    def remove(self, item) -> bool:
+        """
+        Same as ``ZREM``: returns ``True`` if the item was there (its cost and body are forgotten too).
+        """
+        self.costs.pop(item, None)
+        self.bodies.pop(item, None)
+        return self.scores.pop(item, None) is not None
+
+    def pop(self) -> Optional[tuple]:
+        """
+        Same as ``ZPOPMAX``: returns the ``(item, score)`` with the highest score, or ``None``.
+        """
+        while self._heap:
+            score, item = heapq.heappop(self._heap)
+            item = item.value
+            if self.scores.get(item) == -score:
+                del self.scores[item]
+                return item, -score
+
+    def by_priority(self) -> list:
+        """
+        Returns all the ``(item, score)`` pairs, in the order they would be popped.
+        """
+        return sorted(self.scores.items(), key=lambda pair: (pair[1], pair[0]), reverse=True)
+
+
+class _Names:
+    """
+    The names that have items (what ``PREFIX:names`` holds), in the order they were added. Every name gets a sequence
+    number when it's added.
+    """
+
+    def __init__(self):
+        self.sequences = {}
+        self.last_sequence = 0
+        self._names = {}
+        self._order = []
+
+    def __len__(self):
+        return len(self.sequences)
+
+    def __iter__(self):
+        return (name for name, _ in self.after(0))
+
+    def add(self, name):
+        if name not in self.sequences:
+            if len(self._order) > 2 * len(self.sequences) + 16:
+                self._order = sorted(self._names)
+            self.last_sequence += 1
+            self.sequences[name] = self.last_sequence
+            self._names[self.last_sequence] = name
+            self._order.append(self.last_sequence)
+
+    def remove(self, name):
+        sequence = self.sequences.pop(name, None)
+        if sequence is not None:
+            del self._names[sequence]
+
+    def pop_first(self, count: int) -> list:
+        """
+        Removes and returns the `count` names with the lowest sequence (like ``ZPOPMIN``).
+        """
+        names = []
+        index = 0
+        while len(names) < count and index < len(self._order):
+            name = self._names.pop(self._order[index], None)
+            index += 1
+            if name is not None:
+                del self.sequences[name]
+                names.append(name)
+        del self._order[:index]
+        return names
+
+    def after(self, sequence: int):
+        """
+        Yields the ``(name, sequence)`` pairs with a greater sequence, in order. Names can be removed while iterating.
+        """
+        index = bisect_right(self._order, sequence)
+        while index < len(self._order):
+            sequence = self._order[index]
+            index += 1
+            name = self._names.get(sequence)
+            if name is not None:
+                yield name, sequence
+
+
+class _ScoreIndex:
+    """
+    A score for some names, with a heap for going through the names with the lowest score first (stale entries are
+    skipped).
+    """
+
+    def __init__(self):
+        self.scores = {}
+        self._heap = []
+
+    def __len__(self):
+        return len(self.scores)
+
+    def set(self, name, score: float, indexed: bool = True):
+        self.scores[name] = score
+        if indexed:
+            heapq.heappush(self._heap, (score, name))
+
+    def remove(self, name):
+        self.scores.pop(name, None)
+
+    def first(self) -> Optional[tuple]:
+        """
+        Returns the ``(score, name)`` with the lowest score (and name), or ``None``.
+        """
+        heap = self._heap
+        while heap:
+            score, name = heap[0]
+            if self.scores.get(name) == score:
+                return score, name
+            heapq.heappop(heap)
+
+    def discard_first(self):
+        heapq.heappop(self._heap)
+
+
+class _Window:
+    """
+    The state of a window (what ``PREFIX:window:WINDOW`` and ``PREFIX:usage:WINDOW`` hold). The usage scores are indexed
+    only for the names that can still get items in the window (the ones that are not parked).
+    """
+
+    __slots__ = ('name', 'last', 'stop', 'served', 'shared', 'shares', 'usage', 'expires_at')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.last = None
+        self.stop = None
+        self.served = 0
+        self.shared = False
+        self.shares = {}
+        self.usage = _ScoreIndex()
+        self.expires_at = None
+
+    def set_usage(self, name, score: float):
+        self.usage.set(name, score, 0 < score < inf)
+
+
+class _Queue:
+    """
+    All the data of a prefix.
+    """
+
+    def __init__(self):
+        self.total = 0
+        self.names = _Names()
+        self.items = {}
+        self.windows = {}
+        self.window_expiry = _ScoreIndex()
+        self.limits = {}
+        self.weights = {}
+        self.classes = {}
+        self.wakeup = False
+        self.schedule = _ScoreIndex()
+        self.tat = _ScoreIndex()
+        self.gcra_last = 0
+        self.delayed = _ScoreIndex()
+        self.delayed_items = {}
+        self.expiry = _ScoreIndex()
+
+    def limit(self, name, default) -> float:
+        limit = self.limits.get(name)
+        return default if limit is None else float(limit)
+
+    def take(self, name) -> Optional[tuple]:
+        """
+        Pops the highest priority item of `name`. Returns ``(item, priority, cost)`` or ``None``.
+        """
+        items = self.items.get(name)
+        popped = items.pop() if items is not None else None
+        if popped is not None:
+            item, priority = popped
+            return item, priority, items.costs.pop(item, 1)
+
+    def take_body(self, name, item):
+        """
+        Returns the body of `item` if it was stored out of line (and forgets it), or the `item` itself.
+        """
+        items = self.items.get(name)
+        return item if items is None else items.bodies.pop(item, item)
+
+    def put_back(self, name, item, priority: float, cost: float):
+        items = self.items[name]
+        items.add(item, priority)
+        if cost != 1:
+            items.costs[item] = cost
+
+    def remove_if_empty(self, name) -> bool:
+        """
+        Removes `name` if it has no items left. Returns ``True`` if it was removed.
+        """
+        if self.items.get(name):
+            return False
+        self.items.pop(name, None)
+        self.names.remove(name)
+        return True
+
+
+class _Pop:
+    """
+    Arguments and state of a pop function call.
+    """
+
+    __slots__ = ('queue', 'limit', 'stats', 'scanned', 'expired', 'shares', 'window', 'ttl', 'now', 'period', 'burst')
+
+    def __init__(self, queue: _Queue, limit, stats: bool):
+        self.queue = queue
+        self.limit = float(limit)
+        self.stats = stats
+        self.scanned = 0
+        self.expired = 0
+        self.shares = {}
+        self.now = int(time() * 1000)
+
+    def reply(self, reply):
+        return [reply, self.scanned] if self.stats else reply
+
+
+class MemoryRedis:
+    """
+    In-process stand-in for the redis client, to use with :class:`~redis_throttled_queue.ThrottledQueue` where there's no
+    need for Redis (e.g.: single process jobs and tests)::
+
+        queue = ThrottledQueue(MemoryRedis(decode_responses=True), 'myqueue')
+
+    The redis functions of the library are implemented in Python, with the same behavior (item priorities, per-name
+    limits, windows and the order the names are served in). Only the few other commands the queues use are available.
+
+    The data is only visible to the queues that use the same client. It is thread-safe: every call holds a lock, just
+    like Redis runs one command at a time.
+    """
+
+    def __init__(self, *, decode_responses: bool = False):
+        """
+        :param decode_responses:
+            Same as for the redis client: return ``str`` instead of ``bytes``.
+        """
+        self.decode_responses = decode_responses
+        self._queues = {}
+        self._lock = threading.RLock()
+        self._wakeup = threading.Condition(self._lock)
+        self._async_waiters = []
+        self._functions = {
+            'RTQ_PUSH': self._push,
+            'RTQ_PUSH_MANY': self._push_many,
+            'RTQ_POP': self._pop,
+            'RTQ_POP_EX': self._pop_ex,
+            'RTQ_POP_MANY': self._pop_many,
+            'RTQ_POP_MANY_EX': self._pop_many_ex,
+            'RTQ_GCRA_POP': self._gcra_pop,
+            'RTQ_GCRA_POP_EX': self._gcra_pop_ex,
+            'RTQ_GCRA_POP_MANY': self._gcra_pop_many,
+            'RTQ_GCRA_POP_MANY_EX': self._gcra_pop_many_ex,
+            'RTQ_EXTRACT': self._extract,
+            'RTQ_PURGE_EXPIRED': self._purge,
+            'RTQ_STATS': self._stats,
+            'RTQ_CLEANUP': self._cleanup,
+        }
+
+    def _encode(self, value) -> Union[str, bytes]:
+        """
+        Converts a value the same way it would make a round trip through Redis.
+        """
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            data = bytes(value)
+        elif isinstance(value, str):
+            data = value.encode()
+        else:
+            data = str(value).encode()
+        return data.decode() if self.decode_responses else data
+
+    def _score(self, score: float) -> Union[str, bytes]:
+        if score in (inf, -inf):
+            return self._encode('inf' if score > 0 else '-inf')
+        elif score.is_integer() and abs(score) < 1e17:
+            return self._encode(int(score))
+        else:
+            return self._encode(repr(score))
+
+    def _split(self, key: str) -> tuple:
+        prefix, _, suffix = key.rpartition(':')
+        return self._queues.get(prefix), suffix
+
+    def _queue(self, prefix: str) -> _Queue:
+        queue = self._queues.get(prefix)
+        if queue is None:
+            queue = self._queues[prefix] = _Queue()
+        return queue
+
+    def fcall(self, function: str, numkeys: int, *keys_and_args):
+        implementation = self._functions.get(function)
+        if implementation is None:
+            raise ResponseError('Function not found')
+        if numkeys != 1:
+            raise ResponseError(f'{function} expected 1 key argument (the prefix), but got {numkeys} key arguments!')
+        prefix, *args = keys_and_args
+        if isinstance(prefix, bytes):
+            prefix = prefix.decode()
+        with self._lock:
+            return implementation(prefix, args)
+
+    def fcall_ro(self, function: str, numkeys: int, *keys_and_args):
+        if function in self._functions and function not in _READ_ONLY:
+            raise ResponseError('Can not execute a script with write flag using *_ro command.')
+        return self.fcall(function, numkeys, *keys_and_args)
+
+    def _wake_up(self, queue: _Queue):
+        if not queue.wakeup:
+            queue.wakeup = True
+            self._wakeup.notify_all()
+            for loop, future in self._async_waiters:
+                loop.call_soon_threadsafe(_resolve, future)
+            self._async_waiters.clear()
+
+    def _push(self, prefix: str, args: list):
+        if not 3 <= len(args) <= 7:
+            raise ResponseError(
+                f'RTQ_PUSH expected 3 to 7 arguments (NAME, PRIORITY, DATA, COST, BODY, NOT_BEFORE, EXPIRES_AT), but got {len(args)} arguments!'
+            )
+        queue = self._queue(prefix)
+        not_before, expires_at = (None if value in ('', b'') else float(value) for value in (*args[5:], '', '')[:2])
+        if not_before is not None or expires_at is not None:
+            now = int(time() * 1000)
+            if expires_at is not None and expires_at <= max(now, now if not_before is None else not_before):
+                return 0
+            elif not_before is not None and not_before > now:
+                return self._delay_item(queue, *args[:5], expires_at, not_before)
+        added = self._push_item(queue, *args[:5], expires_at=expires_at)
+        if added:
+            queue.total += 1
+            self._wake_up(queue)
+        return added
+
+    def _push_many(self, prefix: str, args: list):
+        if len(args) % 5:
+            raise ResponseError(f'RTQ_PUSH_MANY expected 5 * N arguments, but got {len(args)} arguments!')
+        queue = self._queue(prefix)
+        added = sum(self._push_item(queue, *args[i : i + 5]) for i in range(0, len(args), 5))
+        if added:
+            queue.total += added
+            self._wake_up(queue)
+        return added
+
+    def _push_item(self, queue: _Queue, name, priority, data, cost=1, body='', expires_at=None) -> int:
+        name = self._encode(name)
+        data = self._encode(data)
+        cost = float(cost)
+        items = queue.items.get(name)
+        if items is None:
+            items = queue.items[name] = _Items()
+        if cost != 1:
+            items.costs[data] = cost
+        else:
+            items.costs.pop(data, None)
+        added = items.add(data, float(priority))
+        if expires_at is not None:
+            queue.expiry.set(name + self._encode(':') + data, expires_at)
+        elif not added:
+            queue.expiry.remove(name + self._encode(':') + data)
+        if added:
+            if body != '' and body != b'':
+                items.bodies[data] = self._encode(body)
+            queue.names.add(name)
+            return 1
+        return 0
+
+    def _delay_item(self, queue: _Queue, name, priority, data, cost, body, expires_at, due) -> int:
+        """
+        Same as ``delay_item`` in the library: keeps the item aside until it's due (the items are keyed by ``NAME:DATA``).
+        """
+        member = self._encode(name) + self._encode(':') + self._encode(data)
+        due = float(due)
+        priority = float(priority)
+        saved = queue.delayed_items.get(member)
+        if saved is None or due < queue.delayed.scores[member]:
+            queue.delayed.set(member, due)
+        if saved is not None:
+            priority = max(priority, saved[0])
+        queue.delayed_items[member] = priority, float(cost), body, expires_at
+        return int(saved is None)
+
+    def _promote_due(self, queue: _Queue, now: int):
+        """
+        Same as ``promote_due`` in the library: moves up to ``PROMOTE_BATCH`` due items into their queues (dropping the
+        expired ones).
+        """
+        delayed = queue.delayed
+        added = 0
+        for _ in range(PROMOTE_BATCH):
+            first = delayed.first()
+            if first is None or first[0] > now:
+                break
+            delayed.discard_first()
+            member = first[1]
+            delayed.remove(member)
+            priority, cost, body, expires_at = queue.delayed_items.pop(member)
+            if expires_at is None or expires_at > now:
+                name, _, data = member.partition(self._encode(':'))
+                added += self._push_item(queue, name, priority, data, cost, body, expires_at)
+        if added:
+            queue.total += added
+            self._wake_up(queue)
+
+    def _purge_expired(self, queue: _Queue, batch: int, now: int) -> int:
+        """
+        Same as ``purge_expired`` in the library: drops up to `batch` expired items from their queues.
+        """
+        expiry = queue.expiry
+        dropped = 0
+        for _ in range(batch):
+            first = expiry.first()
+            if first is None or first[0] > now:
+                break
+            expiry.discard_first()
+            member = first[1]
+            expiry.remove(member)
+            name, _, item = member.partition(self._encode(':'))
+            items = queue.items.get(name)
+            if items is not None and items.remove(item):
+                dropped += 1
+                queue.remove_if_empty(name)
+        queue.total -= dropped
+        return dropped
+
+    def _next_due(self, queue: _Queue, retry: Optional[int] = None) -> Optional[int]:
+        """
+        Same as ``next_due`` in the library.
+        """
+        first = queue.delayed.first()
+        if first is None:
+            return retry
+        due = max(int(first[0]) - int(time() * 1000), 1)
+        return due if retry is None else min(retry, due)
+
+    def _open_window(self, prefix: str, args: list, count_args: int, function: str) -> _Pop:
+        """
+        Same as ``current_window`` and ``open_window`` in the library.
+        """
+        if len(args) not in (4 + count_args, 5 + count_args):
+            raise ResponseError(
+                f'{function} expected {4 + count_args} arguments (or {5 + count_args} with STATS), but got {len(args)} arguments!'
+            )
+        queue = self._queue(prefix)
+        pop = _Pop(queue, args[1], len(args) == 5 + count_args)
+        self._promote_due(queue, pop.now)
+        self._purge_expired(queue, PURGE_BATCH, pop.now)
+        resolution = floor(float(args[2]) * 1000 + 0.5)
+        name = args[0].decode() if isinstance(args[0], bytes) else str(args[0])
+        now = time()
+        pop.ttl = resolution
+        if name == '':
+            now_ms = int(now * 1000)
+            name = str(now_ms // resolution % 60)
+            pop.ttl = resolution - now_ms % resolution
+
+        window = queue.windows.get(name)
+        if window is None or window.expires_at is not None and window.expires_at <= now:
+            expiry = queue.window_expiry
+            while True:
+                first = expiry.first()
+                if first is None or first[0] > now:
+                    break
+                expiry.discard_first()
+                expiry.remove(first[1])
+                del queue.windows[first[1]]
+            window = queue.windows[name] = _Window(name)
+        if window.stop is None or not window.served:
+            if window.stop is None or not window.usage:
+                window.last = 0
+            window.stop = queue.names.last_sequence
+        pop.window = window
+        return pop
+
+    def _close_window(self, pop: _Pop):
+        window = pop.window
+        if window.expires_at is None:
+            window.expires_at = time() + pop.ttl / 1000
+            pop.queue.window_expiry.set(window.name, window.expires_at)
+
+    def _share(self, pop: _Pop, name) -> tuple:
+        """
+        Same as ``name_share`` in the library: returns the weight and the class of `name`, saved in the window the first time
+        the name is seen (once weights or classes are used).
+        """
+        share = pop.shares.get(name)
+        if share is None:
+            queue = pop.queue
+            window = pop.window
+            share = window.shares.get(name)
+            if share is None:
+                share = 1.0, 0.0
+                if (window.shared or queue.weights or queue.classes) and name not in window.usage.scores:
+                    share = float(queue.weights.get(name, 1)), float(queue.classes.get(name, 0))
+                    window.shares[name] = share
+                    window.shared = True
+            pop.shares[name] = share
+        return share
+
+    def _usage_score(self, pop: _Pop, name, used: float) -> float:
+        weight, cls = self._share(pop, name)
+        return cls * CLASS_SPAN + (used + pop.window.served % 65536 / 262144) / weight
+
+    def _score_usage(self, pop: _Pop, name, score: float) -> float:
+        weight, cls = self._share(pop, name)
+        return floor((score - cls * CLASS_SPAN) * weight + 0.5)
+
+    def _pop_item(self, pop: _Pop) -> Optional[tuple]:
+        """
+        Same as ``pop_item`` in the library: the names not served yet in the window (in the order they were queued, up
+        to the window's ``stop``) come first, then the names with the lowest usage score. The names queued after the
+        window started are only checked for a refill.
+        """
+        queue = pop.queue
+        window = pop.window
+        usage = window.usage
+        if window.last < window.stop:
+            for name, sequence in queue.names.after(window.last):
+                if sequence > window.stop:
+                    break
+                pop.scanned += 1
+                window.last = sequence
+                score = usage.scores.get(name)
+                if score is not None:
+                    if score < 0:
+                        window.set_usage(name, -score)
+                elif not queue.limit(name, pop.limit):
+                    # Paused, parked for the rest of the window.
+                    window.set_usage(name, inf)
+                elif self._share(pop, name)[1] > 0:
+                    # Waits for the names in the lower classes.
+                    window.set_usage(name, self._usage_score(pop, name, 0))
+                else:
+                    item = self._take_item(pop, name, 0)
+                    if item:
+                        return (name, *item)
+            window.last = max(window.last, window.stop)
+
+        # Until something is served the stop moves forward, and nothing could have run empty yet.
+        for name, sequence in queue.names.after(window.last) if window.served else ():
+            pop.scanned += 1
+            window.last = sequence
+            score = usage.scores.get(name)
+            if score is not None and score < 0:
+                # Got refilled after running empty in this window.
+                window.set_usage(name, -score)
+
+        while True:
+            first = usage.first()
+            if first is None:
+                return
+            score, name = first
+            usage.discard_first()
+            pop.scanned += 1
+            used = self._score_usage(pop, name, score)
+            if used >= queue.limit(name, pop.limit):
+                window.set_usage(name, inf)
+            else:
+                item = self._take_item(pop, name, used)
+                if item:
+                    return (name, *item)
+
+    def _take(self, pop: _Pop, name) -> Optional[tuple]:
+        """
+        Same as ``pop_highest`` in the library: pops the highest priority item of `name` (``(item, priority, cost)`` or
+        ``None``), dropping the expired items on the way.
+        """
+        queue = pop.queue
+        while True:
+            taken = queue.take(name)
+            if taken is None or not queue.expiry:
+                return taken
+            member = name + self._encode(':') + taken[0]
+            expires_at = queue.expiry.scores.get(member)
+            if expires_at is None or expires_at > pop.now:
+                return taken
+            queue.items[name].remove(taken[0])
+            queue.expiry.remove(member)
+            pop.expired += 1
+
+    def _take_item(self, pop: _Pop, name, used: float) -> Optional[tuple]:
+        """
+        Same as ``take_item`` in the library: the item is only taken if its cost fits in what's left of the limit (or if
+        the name didn't use anything in the window).
+        """
+        queue = pop.queue
+        window = pop.window
+        taken = self._take(pop, name)
+        if taken is None:
+            queue.remove_if_empty(name)
+            if used > 0:
+                window.set_usage(name, -self._usage_score(pop, name, used))
+            else:
+                window.usage.remove(name)
+            return
+        item, priority, cost = taken
+        if used > 0 and used + cost > queue.limit(name, pop.limit):
+            queue.put_back(name, item, priority, cost)
+            window.set_usage(name, inf)
+            return
+        queue.expiry.remove(name + self._encode(':') + item)
+        item = queue.take_body(name, item)
+        used += cost
+        window.served += 1
+        if queue.remove_if_empty(name):
+            window.set_usage(name, -self._usage_score(pop, name, used))
+        elif used >= queue.limit(name, pop.limit):
+            window.set_usage(name, inf)
+        else:
+            window.set_usage(name, self._usage_score(pop, name, used))
+        return item, priority
+
+    def _finish_pop(self, pop: _Pop, popped: int):
+        """
+        Same as ``finish_pop`` in the library.
+        """
+        queue = pop.queue
+        queue.total -= popped + pop.expired
+        if popped and queue.total > 0:
+            self._wake_up(queue)
+
+    def _pop(self, prefix: str, args: list):
+        pop = self._open_window(prefix, args, 0, 'RTQ_POP')
+        popped = self._pop_item(pop)
+        self._close_window(pop)
+        self._finish_pop(pop, 1 if popped else 0)
+        if popped:
+            return pop.reply(popped[1])
+        return pop.reply(None)
+
+    def _pop_ex(self, prefix: str, args: list):
+        pop = self._open_window(prefix, args, 0, 'RTQ_POP_EX')
+        popped = self._pop_item(pop)
+        self._close_window(pop)
+        self._finish_pop(pop, 1 if popped else 0)
+        if popped:
+            name, item, priority = popped
+            return pop.reply([1, name, item, self._score(priority)])
+        return pop.reply(self._window_miss(pop))
+
+    def _window_miss(self, pop: _Pop) -> list:
+        """
+        Same as ``window_miss`` in the library.
+        """
+        if pop.queue.total > 0:
+            return [2, self._next_due(pop.queue, max(ceil((pop.window.expires_at - time()) * 1000), 1))]
+        due = self._next_due(pop.queue)
+        return [0] if due is None else [0, due]
+
+    def _window_pop_many(self, prefix: str, args: list, function: str) -> tuple:
+        """
+        Same as ``window_pop_many`` in the library: returns the flat list of name, item pairs and the pop state.
+        """
+        pop = self._open_window(prefix, args, 1, function)
+        result = []
+        for _ in range(int(args[4])):
+            popped = self._pop_item(pop)
+            if not popped:
+                break
+            result += popped[:2]
+        self._close_window(pop)
+        self._finish_pop(pop, len(result) // 2)
+        return result, pop
+
+    def _pop_many(self, prefix: str, args: list):
+        result, pop = self._window_pop_many(prefix, args, 'RTQ_POP_MANY')
+        return pop.reply(result)
+
+    def _pop_many_ex(self, prefix: str, args: list):
+        result, pop = self._window_pop_many(prefix, args, 'RTQ_POP_MANY_EX')
+        return pop.reply([result, self._window_miss(pop) if len(result) // 2 < int(args[4]) else None])
+
+    def _gcra_open(self, prefix: str, args: list, count_args: int, function: str) -> _Pop:
+        """
+        Same as ``gcra_open`` in the library.
+        """
+        if len(args) not in (4 + count_args, 5 + count_args):
+            raise ResponseError(
+                f'{function} expected {4 + count_args} arguments (or {5 + count_args} with STATS), but got {len(args)} arguments!'
+            )
+        queue = self._queue(prefix)
+        pop = _Pop(queue, args[0], len(args) == 5 + count_args)
+        self._promote_due(queue, pop.now)
+        self._purge_expired(queue, PURGE_BATCH, pop.now)
+        pop.period = float(args[1]) * 1000
+        pop.burst = int(args[2])
+
+        tat = queue.tat
+        while True:
+            first = tat.first()
+            if first is None or first[0] > pop.now:
+                break
+            tat.discard_first()
+            tat.remove(first[1])
+
+        for name, sequence in queue.names.after(queue.gcra_last):
+            allowed_at = 0
+            name_tat = tat.scores.get(name)
+            if name_tat is not None:
+                limit = queue.limit(name, pop.limit)
+                allowed_at = name_tat - (pop.burst - 1) * pop.period / limit if limit > 0 else 0
+            if name not in queue.schedule.scores:
+                queue.schedule.set(name, allowed_at)
+            queue.gcra_last = sequence
+        return pop
+
+    def _gcra_pop_item(self, pop: _Pop) -> Optional[tuple]:
+        """
+        Same as ``gcra_pop_item`` in the library.
+        """
+        queue = pop.queue
+        schedule = queue.schedule
+        while True:
+            first = schedule.first()
+            if first is None or first[0] > pop.now:
+                return
+            _, name = first
+            schedule.discard_first()
+            pop.scanned += 1
+            limit = queue.limit(name, pop.limit)
+            if limit <= 0:
+                # Check again later, the limit might change.
+                schedule.set(name, pop.now + pop.period)
+                continue
+            taken = self._take(pop, name)
+            if taken:
+                item, priority, cost = taken
+                queue.expiry.remove(name + self._encode(':') + item)
+                item = queue.take_body(name, item)
+                interval = pop.period / limit
+                tat = max(queue.tat.scores.get(name, 0), pop.now) + interval * cost
+                queue.tat.set(name, tat)
+                if queue.remove_if_empty(name):
+                    schedule.remove(name)
+                else:
+                    schedule.set(name, tat - (pop.burst - 1) * interval)
+                return name, item, priority
+            queue.remove_if_empty(name)
+            schedule.remove(name)
+
+    def _gcra_pop(self, prefix: str, args: list):
+        pop = self._gcra_open(prefix, args, 0, 'RTQ_GCRA_POP')
+        popped = self._gcra_pop_item(pop)
+        self._finish_pop(pop, 1 if popped else 0)
+        if popped:
+            return pop.reply(popped[1])
+        return pop.reply(None)
+
+    def _gcra_pop_ex(self, prefix: str, args: list):
+        pop = self._gcra_open(prefix, args, 0, 'RTQ_GCRA_POP_EX')
+        popped = self._gcra_pop_item(pop)
+        self._finish_pop(pop, 1 if popped else 0)
+        if popped:
+            name, item, priority = popped
+            return pop.reply([1, name, item, self._score(priority)])
+        return pop.reply(self._gcra_miss(pop))
+
+    def _gcra_miss(self, pop: _Pop) -> list:
+        """
+        Same as ``gcra_miss`` in the library.
+        """
+        first = pop.queue.schedule.first()
+        if first is not None:
+            return [2, self._next_due(pop.queue, max(ceil(first[0] - pop.now), 1))]
+        due = self._next_due(pop.queue)
+        return [0] if due is None else [0, due]
+
+    def _gcra_pop_items(self, pop: _Pop, count: int) -> list:
+        """
+        Same as ``gcra_pop_many`` in the library.
+        """
+        result = []
+        for _ in range(count):
+            popped = self._gcra_pop_item(pop)
+            if not popped:
+                break
+            result += popped[:2]
+        self._finish_pop(pop, len(result) // 2)
+        return result
+
+    def _gcra_pop_many(self, prefix: str, args: list):
+        pop = self._gcra_open(prefix, args, 1, 'RTQ_GCRA_POP_MANY')
+        return pop.reply(self._gcra_pop_items(pop, int(args[4])))
+
+    def _gcra_pop_many_ex(self, prefix: str, args: list):
+        pop = self._gcra_open(prefix, args, 1, 'RTQ_GCRA_POP_MANY_EX')
+        result = self._gcra_pop_items(pop, int(args[4]))
+        return pop.reply([result, self._gcra_miss(pop) if len(result) // 2 < int(args[4]) else None])
+
+    def _extract(self, prefix: str, args: list):
+        queue = self._queue(prefix)
+        now = int(time() * 1000)
+        result = []
+        for name in map(self._encode, args):
+            items = queue.items.pop(name, None)
+            if items is not None:
+                for item, score in items.by_priority():
+                    member = name + self._encode(':') + item
+                    expires_at = queue.expiry.scores.get(member)
+                    queue.expiry.remove(member)
+                    if expires_at is None or expires_at > now:
+                        result += name, items.bodies.get(item, item), self._score(score), self._score(items.costs.get(item, 1.0))
+                queue.total -= len(items)
+            queue.names.remove(name)
+        return result
+
+    def _purge(self, prefix: str, args: list):
+        if len(args) != 1:
+            raise ResponseError(f'RTQ_PURGE_EXPIRED expected 1 argument (the batch), but got {len(args)} arguments!')
+        return self._purge_expired(self._queue(prefix), int(args[0]), int(time() * 1000))
+
+    def _stats(self, prefix: str, args: list):
+        """
+        Same as ``RTQ_STATS`` in the library, except that everything is returned in the first page.
+        """
+        if len(args) != 7:
+            raise ResponseError(f'RTQ_STATS expected 7 arguments, but got {len(args)} arguments!')
+        queue = self._queue(prefix)
+        limit = float(args[1])
+        top = int(args[3])
+        name = args[0].decode() if isinstance(args[0], bytes) else str(args[0])
+        if name == '':
+            resolution = floor(float(args[2]) * 1000 + 0.5)
+            name = str(int(time() * 1000) // resolution % 60)
+        window = queue.windows.get(name)
+        usage = []
+        if window is not None and (window.expires_at is None or window.expires_at > time()):
+            for name, score in window.usage.scores.items():
+                if score == inf:
+                    used = queue.limit(name, limit)
+                else:
+                    weight, cls = window.shares.get(name, (1.0, 0.0))
+                    used = floor((abs(score) - cls * CLASS_SPAN) * weight + 0.5)
+                if used > 0:
+                    usage.append((name, int(used)))
+        depth = [(name, len(items)) for name, items in queue.items.items()]
+        return [
+            queue.total,
+            len(queue.names),
+            self._encode(''),
+            self._encode(''),
+            [value for pair in heapq.nlargest(top, depth, key=lambda pair: pair[1]) for value in pair],
+            [value for pair in heapq.nlargest(top, usage, key=lambda pair: pair[1]) for value in pair],
+        ]
+
+    def _cleanup(self, prefix: str, args: list):
+        if len(args) > 1:
+            raise ResponseError(f'RTQ_CLEANUP expected at most 1 argument, but got {len(args)} arguments!')
+        queue = self._queues.get(prefix)
+        if not args:
+            self._queues.pop(prefix, None)
+            return
+        if queue is None:
+            return [0, 0]
+        batch = int(args[0])
+        unlinked = 0
+        names = queue.names.pop_first(batch)
+        for name in names:
+            items = queue.items.pop(name, None)
+            if items is not None:
+                queue.total -= len(items)
+                unlinked += 1 + bool(items.costs) + bool(items.bodies)
+        expiry = queue.window_expiry
+        for _ in range(batch - len(names)):
+            first = expiry.first()
+            if first is None:
+                break
+            expires_at, name = first
+            expiry.discard_first()
+            expiry.remove(name)
+            window = queue.windows.pop(name)
+            if expires_at > time():
+                unlinked += 1 + bool(window.usage)
+        remaining = len(queue.names) + len(expiry)
+        if not remaining:
+            unlinked += (queue.names.last_sequence > 0) * 2 + queue.wakeup + bool(queue.limits) + bool(queue.weights) + bool(queue.classes)
+            unlinked += bool(queue.schedule) + bool(queue.tat) + (queue.gcra_last > 0) + bool(queue.delayed) * 2 + bool(queue.expiry)
+            del self._queues[prefix]
+        return [unlinked, remaining]
+
+    def get(self, key: str):
+        queue, suffix = self._split(key)
+        if queue is not None and suffix == 'total':
+            return self._encode(queue.total)
+
+    def zrange(self, key: str, start: int, end: int):
+        queue, suffix = self._split(key)
+        if queue is None or suffix != 'names':
+            return []
+        with self._lock:
+            names = list(queue.names)
+        return names[start : None if end == -1 else end + 1]
+
+    def hgetall(self, key: str) -> dict:
+        queue, suffix = self._split(key)
+        if queue is None or suffix not in _HASHES:
+            return {}
+        with self._lock:
+            return dict(getattr(queue, suffix))
+
+    def hset(self, key: str, *, mapping: dict):
+        prefix, _, suffix = key.rpartition(':')
+        if suffix not in _HASHES:
+            raise ResponseError(f'Unsupported key: {key!r}')
+        with self._lock:
+            values = getattr(self._queue(prefix), suffix)
+            for name, value in mapping.items():
+                values[self._encode(name)] = self._encode(value)
+        return len(mapping)
+
+    def hdel(self, key: str, *names):
+        queue, suffix = self._split(key)
+        if queue is None or suffix not in _HASHES:
+            return 0
+        with self._lock:
+            values = getattr(queue, suffix)
+            return sum(values.pop(self._encode(name), None) is not None for name in names)
+
+    def pipeline(self, transaction: bool = True) -> '_Pipeline':
+        return _Pipeline(self)
+
+    def _take_wakeup(self, key: str) -> Optional[tuple]:
+        queue, _ = self._split(key)
+        if queue is not None and queue.wakeup:
+            queue.wakeup = False
+            return self._encode(key), self._encode(1)
+
+    def blpop(self, keys: Union[str, list], timeout: float = 0) -> Optional[tuple]:
+        key = keys if isinstance(keys, str) else keys[0]
+        deadline = monotonic() + timeout if timeout else None
+        with self._wakeup:
+            while True:
+                result = self._take_wakeup(key)
+                if result:
+                    return result
+                remaining = None if deadline is None else deadline - monotonic()
+                if remaining is not None and remaining <= 0:
+                    return
+                self._wakeup.wait(remaining)
+
+    async def _async_blpop(self, keys: Union[str, list], timeout: float = 0) -> Optional[tuple]:
+        key = keys if isinstance(keys, str) else keys[0]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout if timeout else None
+        while True:
+            with self._lock:
+                result = self._take_wakeup(key)
+                if result:
+                    return result
+                future = loop.create_future()
+                waiter = loop, future
+                self._async_waiters.append(waiter)
+            remaining = None if deadline is None else deadline - loop.time()
+            if remaining is not None and remaining <= 0:
+                done = False
+            else:
+                done, _ = await asyncio.wait({future}, timeout=remaining)
+            if not done:
+                with self._lock:
+                    if waiter in self._async_waiters:
+                        self._async_waiters.remove(waiter)
+                    return self._take_wakeup(key)
+
+    def info(self, section: Optional[str] = None) -> dict:
+        return {'redis_version': '7.2.0'}
+
+    def function_list(self, library: str = '*') -> list:
+        return [{'library_name': 'RTQ', 'engine': 'memory'}]
+
+    def function_load(self, code: str, replace: bool = False) -> str:
+        return 'RTQ'
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+class _Pipeline:
+    """
+    Runs the queued commands at once (in the same lock).
+    """
+
+    def __init__(self, client: MemoryRedis):
+        self._client = client
+        self._commands = []
+
+    def hset(self, *args, **kwargs):
+        self._commands.append((self._client.hset, args, kwargs))
+        return self
+
+    def hdel(self, *args, **kwargs):
+        self._commands.append((self._client.hdel, args, kwargs))
+        return self
+
+    def fcall(self, *args):
+        self._commands.append((self._client.fcall, args, {}))
+        return self
+
+    def execute(self, raise_on_error: bool = True) -> list:
+        with self._client._lock:
+            try:
+                results = []
+                for command, args, kwargs in self._commands:
+                    try:
+                        results.append(command(*args, **kwargs))
+                    except ResponseError as exc:
+                        if raise_on_error:
+                            raise
+                        results.append(exc)
+                return results
+            finally:
+                self._commands = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._commands = []
+
+
+class _AsyncPipeline(_Pipeline):
+    async def execute(self, raise_on_error: bool = True) -> list:
+        return super().execute(raise_on_error)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._commands = []
+
+
+class AsyncMemoryRedis:
+    """
+    Asyncio variant of :class:`MemoryRedis`, to use with :class:`~redis_throttled_queue.AsyncThrottledQueue`.
+    """
+
+    def __init__(self, *, decode_responses: bool = False, client: Optional[MemoryRedis] = None):
+        """
+        :param client:
+            A :class:`MemoryRedis` to share the data with (e.g.: sync producers and async consumers in the same process).
+        """
+        self.sync = MemoryRedis(decode_responses=decode_responses) if client is None else client
+
+    @property
+    def decode_responses(self) -> bool:
+        return self.sync.decode_responses
+
+    async def fcall(self, *args):
+        return self.sync.fcall(*args)
+
+    async def fcall_ro(self, *args):
+        return self.sync.fcall_ro(*args)
+
+    async def get(self, key: str):
+        return self.sync.get(key)
+
+    async def zrange(self, key: str, start: int, end: int):
+        return self.sync.zrange(key, start, end)
+
+    async def hgetall(self, key: str) -> dict:
+        return self.sync.hgetall(key)
+
+    async def hset(self, key: str, *, mapping: dict):
+        return self.sync.hset(key, mapping=mapping)
+
+    async def hdel(self, key: str, *names):
+        return self.sync.hdel(key, *names)
+
+    def pipeline(self, transaction: bool = True) -> _AsyncPipeline:
+        return _AsyncPipeline(self.sync)
+
+    async def blpop(self, keys: Union[str, list], timeout: float = 0) -> Optional[tuple]:
+        return await self.sync._async_blpop(keys, timeout)
+
+    async def info(self, section: Optional[str] = None) -> dict:
+        return self.sync.info(section)
+
+    async def function_list(self, library: str = '*') -> list:
+        return self.sync.function_list(library)
+
+    async def function_load(self, code: str, replace: bool = False) -> str:
+        return self.sync.function_load(code, replace)
+
+    async def aclose(self):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
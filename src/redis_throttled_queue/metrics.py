@@ -0,0 +1,122 @@
+import threading
+from bisect import bisect_left
+from collections import Counter
+from typing import Optional
+from typing import Sequence
+
+
+class Histogram:
+    """
+    Latency histogram with fixed buckets.
+    """
+
+    def __init__(self, buckets: Sequence[float]):
+        """
+        :param buckets:
+            Upper bounds of the buckets (in seconds), in ascending order. Values over the last bound are counted in an
+            extra ``inf`` bucket.
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def quantile(self, q: float) -> float:
+        """
+        Returns the upper bound of the bucket that has the `q` quantile (e.g.: ``0.99``), or the maximum if it's in the
+        ``inf`` bucket.
+        """
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen and seen >= rank:
+                return bound
+        return self.max
+
+    def __repr__(self):
+        return f'<Histogram count={self.count} mean={self.mean:.6f} max={self.max:.6f}>'
+
+
+class Metrics:
+    """
+    Counters and latency histograms for a queue::
+
+        metrics = Metrics()
+        queue = ThrottledQueue(redis_client, 'myqueue', metrics=metrics)
+        ...
+        metrics.snapshot()
+
+    Counters (``operation.event`` named):
+
+    * ``push.added``, ``push.deduplicated`` - for ``push``, ``push_many`` and the buffered producers (items that were already
+      queued only get their priority raised)
+    * ``pop.item``, ``pop.miss`` - for ``pop`` (the queue was either empty or throttled)
+    * ``pop_ex.item``, ``pop_ex.empty``, ``pop_ex.throttled`` - for ``pop_ex`` (also used by ``pop`` with a timeout)
+    * ``pop_many.calls``, ``pop_many.items``
+    * ``pop.scanned``, ``pop_ex.scanned``, ``pop_many.scanned`` - names looked at by the redis functions while looking for
+      an eligible name (more than the items returned means time spent on empty or exhausted names)
+    * ``cleanup.unlinked`` - keys removed by a ``cleanup(batch=...)``
+    * ``purge_expired.dropped`` - expired items dropped by ``purge_expired``
+
+    Latencies (of the redis calls, in seconds) are tracked for: ``push``, ``push_many``, ``push_pipeline`` (the flushes of
+    a :class:`~redis_throttled_queue.producer.BufferedProducer`), ``pop``, ``pop_ex``, ``pop_many``,
+    ``purge_expired`` and ``cleanup``.
+
+    Subclass and override ``count`` and ``timing`` to forward the data elsewhere (e.g.: statsd or Prometheus).
+    """
+
+    buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+    def __init__(self, buckets: Optional[Sequence[float]] = None):
+        if buckets is not None:
+            self.buckets = tuple(buckets)
+        self.counters = Counter()
+        self.latencies = {}
+        self._lock = threading.Lock()
+
+    def count(self, name: str, value: int = 1):
+        with self._lock:
+            self.counters[name] += value
+
+    def timing(self, operation: str, seconds: float):
+        with self._lock:
+            histogram = self.latencies.get(operation)
+            if histogram is None:
+                histogram = self.latencies[operation] = Histogram(self.buckets)
+            histogram.add(seconds)
+
+    def snapshot(self) -> dict:
+        """
+        Returns the counters and a summary of the latencies (count, mean, p50, p99 and max).
+        """
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'latencies': {
+                    operation: {
+                        'count': histogram.count,
+                        'mean': histogram.mean,
+                        'p50': histogram.quantile(0.5),
+                        'p99': histogram.quantile(0.99),
+                        'max': histogram.max,
+                    }
+                    for operation, histogram in self.latencies.items()
+                },
+            }
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.latencies.clear()
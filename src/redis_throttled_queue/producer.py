@@ -0,0 +1,323 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+from time import monotonic
+from typing import Optional
+from typing import Union
+
+from . import AsyncThrottledQueue
+from . import ThrottledQueue
+
+
+def _check_options(max_items: int, max_delay: float, max_pending: int):
+    if not isinstance(max_items, int) or max_items < 1:
+        raise ValueError(f'Incorrect value for `max_items`. Must be a positive integer, not {max_items!r}.')
+    if max_delay < 0:
+        raise ValueError(f'Incorrect value for `max_delay`. Must be a non-negative number, not {max_delay!r}.')
+    if not isinstance(max_pending, int) or max_pending < max_items:
+        raise ValueError(f'Incorrect value for `max_pending`. Must be an integer not less than `max_items`, not {max_pending!r}.')
+
+
+def _resolve(futures: list, results: Union[list, BaseException]):
+    """
+    Sets the result of every future (or the exception, if the flush failed or the push failed).
+    """
+    for index, future in enumerate(futures):
+        result = results if isinstance(results, BaseException) else results[index]
+        if future.done():
+            continue
+        if isinstance(result, BaseException):
+            future.set_exception(result)
+        else:
+            future.set_result(result)
+
+
+async def _wait_event(event: asyncio.Event, timeout: Optional[float]) -> bool:
+    """
+    Waits for the `event` up to `timeout` seconds (forever if ``None``). Returns ``False`` if it timed out.
+    """
+    if timeout is None:
+        await event.wait()
+        return True
+    try:
+        await asyncio.wait_for(event.wait(), timeout)
+    except asyncio.TimeoutError:
+        return False
+    return True
+
+
+class BufferedProducer:
+    """
+    Collects the pushes made from any number of threads and sends them in batches (one pipeline of ``RTQ_PUSH`` calls, thus
+    one round trip, for up to `max_items` items)::
+
+        with BufferedProducer(queue) as producer:
+            future = producer.push('name', 'data')
+            ...
+            future.result()  # 1 if the item was added, 0 if it was already queued
+
+    A batch is sent once it has `max_items` items or `max_delay` seconds after its first item was pushed, from a
+    background thread. Pushes block while there are `max_pending` items waiting to be sent. Closing the producer (or
+    leaving the ``with`` block) sends everything that was pushed before returning.
+    """
+
+    def __init__(self, queue: ThrottledQueue, *, max_items: int = 100, max_delay: float = 0.005, max_pending: int = 10000):
+        """
+        :param queue:
+            The queue to push to.
+        :param max_items:
+            How many items to send at most in a batch.
+        :param max_delay:
+            How long (in seconds) an item can wait for the batch to fill up.
+        :param max_pending:
+            How many items can wait to be sent before ``push`` blocks.
+        """
+        _check_options(max_items, max_delay, max_pending)
+        self.queue = queue
+        self.max_items = max_items
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.closed = False
+        self._pending = []  # (args, future, pushed_at) tuples
+        self._flushing = 0
+        self._force = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name=f'BufferedProducer({queue._prefix})', daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def push(
+        self,
+        name: str,
+        data: Union[str, bytes],
+        *,
+        priority: int = 0,
+        cost: int = 1,
+        not_before: Optional[float] = None,
+        expires_at: Optional[float] = None,
+        timeout: Optional[float] = None,
+    ) -> Future:
+        """
+        Queue an item for the next batch (the arguments are the same as for ``ThrottledQueue.push`` and are checked right
+        away).
+
+        :param timeout:
+            How long to wait (in seconds) if there are `max_pending` items waiting to be sent. Raises :exc:`TimeoutError`
+            if there's still no room after that. By default it waits as long as needed.
+        :return: A :class:`~concurrent.futures.Future` that gets the result of the push (``1`` if the item was added,
+            ``0`` if it was already queued or expired) once the batch was sent.
+        """
+        args = self.queue._push_args(name, data, priority, cost, not_before, expires_at)
+        future = Future()
+        with self._condition:
+            if not self._condition.wait_for(lambda: self.closed or len(self._pending) < self.max_pending, timeout):
+                raise TimeoutError(f'There are still {len(self._pending)} items waiting to be sent.')
+            if self.closed:
+                raise RuntimeError('The producer is closed.')
+            self._pending.append((args, future, monotonic()))
+            if len(self._pending) == 1 or len(self._pending) == self.max_items:
+                self._condition.notify_all()
+        return future
+
+    def flush(self):
+        """
+        Send everything that was pushed so far, and wait until it's done.
+        """
+        with self._condition:
+            self._force = True
+            self._condition.notify_all()
+            self._condition.wait_for(lambda: not self._pending and not self._flushing)
+            self._force = False
+
+    def close(self):
+        """
+        Send everything that was pushed so far and stop the background thread. Pushing afterwards is an error.
+        """
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def _next_batch(self) -> Optional[list]:
+        """
+        Waits until a batch is due. Returns ``None`` if the producer was closed and there's nothing left to send.
+        """
+        with self._condition:
+            while True:
+                if self._pending:
+                    # The items left after a batch keep the time they were pushed at.
+                    delay = self._pending[0][2] + self.max_delay - monotonic()
+                    if self.closed or self._force or delay <= 0 or len(self._pending) >= self.max_items:
+                        batch = self._pending[: self.max_items]
+                        del self._pending[: self.max_items]
+                        self._flushing += 1
+                        self._condition.notify_all()
+                        return batch
+                    self._condition.wait(delay)
+                elif self.closed:
+                    return None
+                else:
+                    self._condition.wait()
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                results = self.queue._push_each([args for args, _, _ in batch])
+            except Exception as exc:
+                results = exc
+            _resolve([future for _, future, _ in batch], results)
+            with self._condition:
+                self._flushing -= 1
+                self._condition.notify_all()
+
+
+class AsyncBufferedProducer:
+    """
+    Asyncio variant of :class:`BufferedProducer` (takes an :class:`~redis_throttled_queue.AsyncThrottledQueue`). The
+    batches are sent from a task that is started by the first push::
+
+        async with AsyncBufferedProducer(queue) as producer:
+            future = await producer.push('name', 'data')
+            ...
+            await future  # 1 if the item was added, 0 if it was already queued
+
+    If that task gets cancelled the producer is closed and the futures of the items that were not sent are cancelled.
+    """
+
+    def __init__(self, queue: AsyncThrottledQueue, *, max_items: int = 100, max_delay: float = 0.005, max_pending: int = 10000):
+        """
+        Same arguments as for :class:`BufferedProducer`.
+        """
+        _check_options(max_items, max_delay, max_pending)
+        self.queue = queue
+        self.max_items = max_items
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.closed = False
+        self._pending = []  # (args, future, pushed_at) tuples
+        self._force = False
+        self._sending = False
+        self._task = None
+        self._changed = None  # set on the first push into an empty buffer, when a batch is full, on flush and on close
+        self._sent = None  # set every time a batch was sent
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    def _start(self):
+        if self._task is None:
+            self._changed = asyncio.Event()
+            self._sent = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def push(
+        self,
+        name: str,
+        data: Union[str, bytes],
+        *,
+        priority: int = 0,
+        cost: int = 1,
+        not_before: Optional[float] = None,
+        expires_at: Optional[float] = None,
+        timeout: Optional[float] = None,
+    ) -> asyncio.Future:
+        """
+        Asyncio variant for ``push``: waits while there are `max_pending` items waiting to be sent and returns an
+        :class:`asyncio.Future` (awaiting it is optional).
+        """
+        args = self.queue._push_args(name, data, priority, cost, not_before, expires_at)
+        self._start()
+        deadline = None if timeout is None else monotonic() + timeout
+        while True:
+            if self.closed:
+                raise RuntimeError('The producer is closed.')
+            if len(self._pending) < self.max_pending:
+                break
+            # Checked again after every wait (other pushes woken by the same batch might have filled the buffer first).
+            self._sent.clear()
+            remaining = None if deadline is None else deadline - monotonic()
+            if remaining is not None and remaining <= 0 or not await _wait_event(self._sent, remaining):
+                raise TimeoutError(f'There are still {len(self._pending)} items waiting to be sent.')
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((args, future, monotonic()))
+        if len(self._pending) == 1 or len(self._pending) == self.max_items:
+            self._changed.set()
+        return future
+
+    async def flush(self):
+        """
+        Asyncio variant for ``flush``.
+        """
+        if self._task is None:
+            return
+        self._force = True
+        self._changed.set()
+        try:
+            while (self._pending or self._sending) and not self._task.done():
+                self._sent.clear()
+                await self._sent.wait()
+        finally:
+            self._force = False
+
+    async def aclose(self):
+        """
+        Asyncio variant for ``close``.
+        """
+        self.closed = True
+        if self._task is not None:
+            self._changed.set()
+            await self._task
+
+    async def _next_batch(self) -> Optional[list]:
+        while True:
+            if self._pending:
+                delay = self._pending[0][2] + self.max_delay - monotonic()
+                if self.closed or self._force or delay <= 0 or len(self._pending) >= self.max_items:
+                    batch = self._pending[: self.max_items]
+                    del self._pending[: self.max_items]
+                    return batch
+                self._changed.clear()
+                await _wait_event(self._changed, delay)
+            elif self.closed:
+                return None
+            else:
+                self._changed.clear()
+                await self._changed.wait()
+
+    async def _run(self):
+        batch = []
+        try:
+            while True:
+                batch = await self._next_batch()
+                if batch is None:
+                    return
+                self._sending = True
+                try:
+                    results = await self.queue._push_each([args for args, _, _ in batch])
+                except Exception as exc:
+                    results = exc
+                finally:
+                    self._sending = False
+                _resolve([future for _, future, _ in batch], results)
+                self._sent.set()
+        except BaseException:
+            # Cancelled (or worse): nothing else gets sent, thus nothing is left waiting for it.
+            self.closed = True
+            for _, future, _ in batch + self._pending:
+                future.cancel()
+            self._pending.clear()
+            raise
+        finally:
+            self._sent.set()
@@ -0,0 +1,516 @@
+import asyncio
+import hashlib
+from bisect import bisect
+from collections.abc import Mapping
+from itertools import chain
+from time import sleep
+from time import time
+from typing import AsyncIterator
+from typing import Awaitable
+from typing import Iterable
+from typing import Optional
+from typing import Sequence
+from typing import Union
+
+from . import PopResult
+from . import PopStatus
+from . import PushItems
+from . import ThrottledQueue
+from . import _check_batch
+from . import _push_many_args
+
+Shards = Union[Mapping, Sequence[ThrottledQueue]]
+
+
+def _hash(key: Union[str, bytes]) -> int:
+    if isinstance(key, str):
+        key = key.encode()
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """
+    Consistent hash ring: every shard gets `replicas` points on the ring and a name belongs to the shard of the first point
+    after the hash of the name. Adding or removing a shard only moves the names of the points it gains or loses.
+    """
+
+    def __init__(self, shard_ids: Iterable[str], replicas: int = 100):
+        points = sorted((_hash(f'{shard_id}#{index}'), shard_id) for shard_id in shard_ids for index in range(replicas))
+        self._hashes = [point for point, _ in points]
+        self._shard_ids = [shard_id for _, shard_id in points]
+
+    def get(self, name: Union[str, bytes]) -> str:
+        """
+        Get the id of the shard that owns `name`.
+        """
+        return self._shard_ids[bisect(self._hashes, _hash(name)) % len(self._hashes)]
+
+
+def _split(count: int, parts: int) -> list:
+    """
+    Splits `count` in `parts` that differ by at most 1 (larger parts first).
+    """
+    size, extra = divmod(count, parts)
+    return [size + 1 if index < extra else size for index in range(parts)]
+
+
+def _group_items(items: PushItems, shard_for) -> dict:
+    """
+    Groups the `items` given to ``push_many`` by shard. Returns a dict of shard id to ``(name, data, priority, cost)`` tuples.
+    """
+    args = _push_many_args(items)
+    groups = {}
+    for i in range(0, len(args), 5):
+        name, priority, data, cost, _ = args[i : i + 5]
+        groups.setdefault(shard_for(name), []).append((name, data, priority, cost))
+    return groups
+
+
+def _group_limits(limits: Mapping, shard_for) -> dict:
+    """
+    Groups the `limits` given to ``set_limits`` by shard.
+    """
+    groups = {}
+    for name, limit in limits.items():
+        groups.setdefault(shard_for(name), {})[name] = limit
+    return groups
+
+
+# The per-name settings (getter, setter) that are moved along with the names when resharding.
+_SETTINGS = (('limits', 'set_limits'), ('weights', 'set_weights'), ('classes', 'set_classes'))
+
+
+def _combine_misses(results: list) -> PopResult:
+    """
+    Combines the ``pop_ex`` results of the shards that had nothing to pop.
+    """
+    status = PopStatus.THROTTLED if any(result.status is PopStatus.THROTTLED for result in results) else PopStatus.EMPTY
+    return PopResult(status, retry_after=min((result.retry_after for result in results if result.retry_after is not None), default=None))
+
+
+class ShardedThrottledQueue:
+    """
+    Spreads names over multiple queues (on different servers, or just different prefixes so they get in different cluster
+    slots) using consistent hashing.
+
+    A name always lives on one shard, thus the limits are exact. Pops go through the shards in rotation, starting with a
+    different shard every time.
+    """
+
+    shards: dict
+    replicas: int
+    poll_interval: float
+    _ring: HashRing
+
+    def __init__(self, shards: Shards, *, replicas: int = 100, poll_interval: float = 0.1):
+        """
+        :param shards:
+            A mapping of shard id to :class:`~redis_throttled_queue.ThrottledQueue`, or a sequence of queues (the shard ids
+            being their index). The ids decide what names each shard gets, thus they need to be stable.
+        :param replicas:
+            How many points every shard gets on the hash ring. More points give a more even spread.
+        :param poll_interval:
+            How often the shards are polled by a blocked ``pop`` (there's no way to wait for a push on multiple servers).
+        """
+        self.replicas = replicas
+        self.poll_interval = poll_interval
+        self._rotation = 0
+        self._set_shards(shards)
+
+    def _set_shards(self, shards: Shards):
+        if not isinstance(shards, Mapping):
+            shards = {str(index): shard for index, shard in enumerate(shards)}
+        if not shards:
+            raise ValueError('Incorrect value for `shards`. Cannot be empty.')
+        self.shards = dict(shards)
+        self._ring = HashRing(self.shards, self.replicas)
+
+    def shard_for(self, name: Union[str, bytes]) -> ThrottledQueue:
+        """
+        Get the queue that owns `name`.
+        """
+        return self.shards[self._ring.get(name)]
+
+    def _rotate(self) -> list:
+        """
+        Get the shards in the order they should be tried, starting with a different one every time.
+        """
+        shards = list(self.shards.values())
+        start = self._rotation % len(shards)
+        self._rotation = start + 1
+        return shards[start:] + shards[:start]
+
+    def _get_wait(self, retry_after: Optional[float], deadline: Optional[float]) -> Optional[float]:
+        """
+        Computes how long a blocked ``pop`` should sleep before polling the shards again (``None`` to give up).
+        """
+        wait = min(retry_after, self.poll_interval) if retry_after else self.poll_interval
+        if deadline is not None:
+            remaining = deadline - time()
+            if remaining <= 0:
+                return None
+            wait = min(wait, remaining)
+        return wait
+
+    def __len__(self):
+        """
+        Get queue length (sum of all the shards).
+        """
+        return sum(len(shard) for shard in self.shards.values())
+
+    def push(
+        self,
+        name: str,
+        data: Union[str, bytes],
+        *,
+        priority: int = 0,
+        cost: int = 1,
+        not_before: Optional[float] = None,
+        expires_at: Optional[float] = None,
+    ):
+        """
+        Push an item (to the shard that owns `name`).
+        """
+        return self.shard_for(name).push(name, data, priority=priority, cost=cost, not_before=not_before, expires_at=expires_at)
+
+    def push_many(self, items: PushItems) -> int:
+        """
+        Push multiple items, with a single call for every shard that gets items.
+        """
+        return sum(self.shards[shard_id].push_many(group) for shard_id, group in _group_items(items, self._ring.get).items())
+
+    def set_limit(self, name: str, limit: Optional[int]):
+        """
+        Set the throttling limit of a name (on the shard that owns `name`).
+        """
+        return self.shard_for(name).set_limit(name, limit)
+
+    def set_limits(self, limits: Mapping):
+        """
+        Set the throttling limits of multiple names, with a single call for every shard that gets limits.
+        """
+        for shard_id, group in _group_limits(limits, self._ring.get).items():
+            self.shards[shard_id].set_limits(group)
+
+    def limits(self) -> dict:
+        """
+        Get the names that have their own throttling limit (from all the shards).
+        """
+        return {name: limit for shard in self.shards.values() for name, limit in shard.limits().items()}
+
+    def set_weights(self, weights: Mapping):
+        """
+        Set the scheduling weights of multiple names (on the shards that own them).
+        """
+        for shard_id, group in _group_limits(weights, self._ring.get).items():
+            self.shards[shard_id].set_weights(group)
+
+    def weights(self) -> dict:
+        """
+        Get the names that have their own scheduling weight (from all the shards).
+        """
+        return {name: weight for shard in self.shards.values() for name, weight in shard.weights().items()}
+
+    def set_classes(self, classes: Mapping):
+        """
+        Set the scheduling classes of multiple names (on the shards that own them).
+        """
+        for shard_id, group in _group_limits(classes, self._ring.get).items():
+            self.shards[shard_id].set_classes(group)
+
+    def classes(self) -> dict:
+        """
+        Get the names that have their own scheduling class (from all the shards).
+        """
+        return {name: cls for shard in self.shards.values() for name, cls in shard.classes().items()}
+
+    def pop(self, window: Union[str, bytes, int] = Ellipsis, *, timeout: Optional[float] = None) -> Union[str, bytes, None]:
+        """
+        Pop an item, if any available on any shard.
+
+        :param timeout:
+            If given, wait up to this many seconds for an item to become available (use ``0`` to wait indefinitely). The
+            shards are polled every ``poll_interval`` seconds.
+        """
+        if timeout is None:
+            for shard in self._rotate():
+                value = shard.pop(window)
+                if value is not None:
+                    return value
+            return
+
+        deadline = None if not timeout else time() + timeout
+        while True:
+            result = self.pop_ex(window)
+            if result.status is PopStatus.ITEM:
+                return result.value
+            wait = self._get_wait(result.retry_after, deadline)
+            if wait is None:
+                return
+            sleep(wait)
+
+    def pop_ex(self, window: Union[str, bytes, int] = Ellipsis) -> PopResult:
+        """
+        Pop an item, if any available, and tell why if there isn't. If any shard is throttled the result is throttled, the
+        `retry_after` is the shortest one (of the throttled shards and of the shards that have delayed items).
+        """
+        misses = []
+        for shard in self._rotate():
+            result = shard.pop_ex(window)
+            if result.status is PopStatus.ITEM:
+                return result
+            misses.append(result)
+        return _combine_misses(misses)
+
+    def pop_many(self, count: int, window: Union[str, bytes, int] = Ellipsis, *, with_names: bool = False) -> list:
+        """
+        Pop up to `count` items. The count is split evenly over the shards, and what some shards could not give is asked
+        again from the other shards (the shards that gave less than they were asked for are not asked again).
+        """
+        items = []
+        shards = self._rotate()
+        while shards and len(items) < count:
+            remaining = []
+            for shard, wanted in zip(shards, _split(count - len(items), len(shards))):
+                if wanted:
+                    result = shard.pop_many(wanted, window, with_names=with_names)
+                    items.extend(result)
+                    if len(result) < wanted:
+                        continue
+                remaining.append(shard)
+            shards = remaining
+        return items
+
+    def reshard(self, shards: Shards, *, batch: int = 100) -> int:
+        """
+        Replace the shards. The names that belong to a different shard now are moved with all their items (in batches of
+        `batch` names, with one ``extract`` and one ``push_many`` call for every batch) and their limits, weights and
+        classes. New pushes go to the new shards right away.
+
+        The items of a batch are lost if the process dies after they were extracted and before they were pushed. The
+        usage of the moved names in the current window is not moved. Delayed items are not moved either: they get queued
+        in their old shard once due (the pops still reach it, if it's kept). Expired items are dropped, the other moved items
+        lose their expiry.
+
+        :return: The count of items moved.
+        """
+        old_shards = self.shards
+        self._set_shards(shards)
+        moved = 0
+        for shard_id, shard in old_shards.items():
+            names = [name for name in shard.names() if self._ring.get(name) != shard_id]
+            for i in range(0, len(names), batch):
+                items = shard.extract(names[i : i + batch])
+                moved += len(items)
+                for target_id, group in _group_items(items, self._ring.get).items():
+                    self.shards[target_id].push_many(group)
+            for getter, setter in _SETTINGS:
+                values = {name: value for name, value in getattr(shard, getter)().items() if self._ring.get(name) != shard_id}
+                for target_id, group in _group_limits(values, self._ring.get).items():
+                    getattr(self.shards[target_id], setter)(group)
+                getattr(shard, setter)(dict.fromkeys(values))
+        return moved
+
+    def purge_expired(self, batch: int = 1000) -> int:
+        """
+        Drop up to `batch` expired items from every shard. Returns how many items were dropped.
+        """
+        return sum(shard.purge_expired(batch) for shard in self.shards.values())
+
+    def cleanup(self, batch: Optional[int] = None):
+        """
+        Cleanup all the shards. If `batch` is given an iterator is returned (see
+        :meth:`~redis_throttled_queue.ThrottledQueue.cleanup`) that goes through the shards one after the other.
+        """
+        if batch is None:
+            for shard in self.shards.values():
+                shard.cleanup()
+        else:
+            _check_batch(batch)
+            return chain.from_iterable(shard.cleanup(batch) for shard in self.shards.values())
+
+
+class AsyncShardedThrottledQueue(ShardedThrottledQueue):
+    """
+    Asyncio variant of the sharded queue (takes :class:`~redis_throttled_queue.AsyncThrottledQueue` shards). The shards are
+    called concurrently where possible.
+    """
+
+    async def size(self):
+        """
+        Asyncio variant for ``__len__``.
+        """
+        return sum(await asyncio.gather(*(shard.size() for shard in self.shards.values())))
+
+    async def push(
+        self,
+        name: str,
+        data: Union[str, bytes],
+        *,
+        priority: int = 0,
+        cost: int = 1,
+        not_before: Optional[float] = None,
+        expires_at: Optional[float] = None,
+    ):
+        """
+        Asyncio variant for ``push``.
+        """
+        return await self.shard_for(name).push(name, data, priority=priority, cost=cost, not_before=not_before, expires_at=expires_at)
+
+    async def push_many(self, items: PushItems) -> int:
+        """
+        Asyncio variant for ``push_many``.
+        """
+        groups = _group_items(items, self._ring.get)
+        return sum(await asyncio.gather(*(self.shards[shard_id].push_many(group) for shard_id, group in groups.items())))
+
+    async def set_limit(self, name: str, limit: Optional[int]):
+        """
+        Asyncio variant for ``set_limit``.
+        """
+        return await self.shard_for(name).set_limit(name, limit)
+
+    async def set_limits(self, limits: Mapping):
+        """
+        Asyncio variant for ``set_limits``.
+        """
+        groups = _group_limits(limits, self._ring.get)
+        await asyncio.gather(*(self.shards[shard_id].set_limits(group) for shard_id, group in groups.items()))
+
+    async def limits(self) -> dict:
+        """
+        Asyncio variant for ``limits``.
+        """
+        return {
+            name: limit
+            for limits in await asyncio.gather(*(shard.limits() for shard in self.shards.values()))
+            for name, limit in limits.items()
+        }
+
+    async def set_weights(self, weights: Mapping):
+        """
+        Asyncio variant for ``set_weights``.
+        """
+        groups = _group_limits(weights, self._ring.get)
+        await asyncio.gather(*(self.shards[shard_id].set_weights(group) for shard_id, group in groups.items()))
+
+    async def weights(self) -> dict:
+        """
+        Asyncio variant for ``weights``.
+        """
+        return {
+            name: weight
+            for weights in await asyncio.gather(*(shard.weights() for shard in self.shards.values()))
+            for name, weight in weights.items()
+        }
+
+    async def set_classes(self, classes: Mapping):
+        """
+        Asyncio variant for ``set_classes``.
+        """
+        groups = _group_limits(classes, self._ring.get)
+        await asyncio.gather(*(self.shards[shard_id].set_classes(group) for shard_id, group in groups.items()))
+
+    async def classes(self) -> dict:
+        """
+        Asyncio variant for ``classes``.
+        """
+        return {
+            name: cls
+            for classes in await asyncio.gather(*(shard.classes() for shard in self.shards.values()))
+            for name, cls in classes.items()
+        }
+
+    async def pop(self, window: Union[str, bytes, int] = Ellipsis, *, timeout: Optional[float] = None) -> Union[str, bytes, None]:
+        """
+        Asyncio variant for ``pop``.
+        """
+        if timeout is None:
+            for shard in self._rotate():
+                value = await shard.pop(window)
+                if value is not None:
+                    return value
+            return
+
+        deadline = None if not timeout else time() + timeout
+        while True:
+            result = await self.pop_ex(window)
+            if result.status is PopStatus.ITEM:
+                return result.value
+            wait = self._get_wait(result.retry_after, deadline)
+            if wait is None:
+                return
+            await asyncio.sleep(wait)
+
+    async def pop_ex(self, window: Union[str, bytes, int] = Ellipsis) -> PopResult:
+        """
+        Asyncio variant for ``pop_ex``.
+        """
+        misses = []
+        for shard in self._rotate():
+            result = await shard.pop_ex(window)
+            if result.status is PopStatus.ITEM:
+                return result
+            misses.append(result)
+        return _combine_misses(misses)
+
+    async def pop_many(self, count: int, window: Union[str, bytes, int] = Ellipsis, *, with_names: bool = False) -> list:
+        """
+        Asyncio variant for ``pop_many`` (the shards are asked concurrently).
+        """
+        items = []
+        shards = self._rotate()
+        while shards and len(items) < count:
+            wanted = _split(count - len(items), len(shards))
+            asked = [(shard, size) for shard, size in zip(shards, wanted) if size]
+            results = await asyncio.gather(*(shard.pop_many(size, window, with_names=with_names) for shard, size in asked))
+            shards = shards[len(asked) :]  # the shards that were not asked this time
+            for (shard, size), result in zip(asked, results):
+                items.extend(result)
+                if len(result) == size:
+                    shards.append(shard)
+        return items
+
+    async def reshard(self, shards: Shards, *, batch: int = 100) -> int:
+        """
+        Asyncio variant for ``reshard``.
+        """
+        old_shards = self.shards
+        self._set_shards(shards)
+        moved = 0
+        for shard_id, shard in old_shards.items():
+            names = [name for name in await shard.names() if self._ring.get(name) != shard_id]
+            for i in range(0, len(names), batch):
+                items = await shard.extract(names[i : i + batch])
+                moved += len(items)
+                groups = _group_items(items, self._ring.get)
+                await asyncio.gather(*(self.shards[target_id].push_many(group) for target_id, group in groups.items()))
+            for getter, setter in _SETTINGS:
+                values = {name: value for name, value in (await getattr(shard, getter)()).items() if self._ring.get(name) != shard_id}
+                groups = _group_limits(values, self._ring.get)
+                await asyncio.gather(*(getattr(self.shards[target_id], setter)(group) for target_id, group in groups.items()))
+                await getattr(shard, setter)(dict.fromkeys(values))
+        return moved
+
+    async def purge_expired(self, batch: int = 1000) -> int:
+        """
+        Asyncio variant for ``purge_expired``.
+        """
+        return sum(await asyncio.gather(*(shard.purge_expired(batch) for shard in self.shards.values())))
+
+    def cleanup(self, batch: Optional[int] = None) -> Union[Awaitable, AsyncIterator[int]]:
+        """
+        Asyncio variant for ``cleanup``. Returns an awaitable, or an async iterator if `batch` is given.
+        """
+        if batch is None:
+            return self._cleanup()
+        _check_batch(batch)
+        return self._cleanup_steps(batch)
+
+    async def _cleanup(self):
+        await asyncio.gather(*(shard.cleanup() for shard in self.shards.values()))
+
+    async def _cleanup_steps(self, batch: int) -> AsyncIterator[int]:
+        for shard in self.shards.values():
+            async for unlinked in shard.cleanup(batch):
+                yield unlinked
@@ -0,0 +1,245 @@
+import multiprocessing
+import signal
+import threading
+from importlib import import_module
+from logging import getLogger
+from time import time
+from typing import Callable
+from typing import Optional
+from typing import Union
+
+from redis.client import StrictRedis
+from redis.cluster import RedisCluster
+
+from . import Resolution
+from . import Strategy
+from . import ThrottledQueue
+
+logger = getLogger(__name__)
+
+
+def resolve_handler(handler: Union[str, Callable]) -> Callable:
+    """
+    Imports a handler given as a ``'module:callable'`` string (the callable can be a dotted path). Callables are returned as is.
+    """
+    if callable(handler):
+        return handler
+    module, _, name = handler.partition(':')
+    if not module or not name:
+        raise ValueError(f'Incorrect value for `handler`. Must be in the "module:callable" format, not {handler!r}.')
+    obj = import_module(module)
+    for attr in name.split('.'):
+        obj = getattr(obj, attr)
+    if not callable(obj):
+        raise TypeError(f'Incorrect value for `handler`. {handler!r} is not callable.')
+    return obj
+
+
+class WorkerStats:
+    """
+    Counters for a worker thread.
+    """
+
+    handled: int = 0
+    errors: int = 0
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time()
+
+    @property
+    def throughput(self) -> float:
+        """
+        Items handled per second, since the worker started.
+        """
+        elapsed = time() - self.started
+        return self.handled / elapsed if elapsed else 0.0
+
+    def __repr__(self):
+        return f'<WorkerStats {self.name}: handled={self.handled} errors={self.errors} throughput={self.throughput:.1f}/s>'
+
+
+class Runner:
+    """
+    Runs a handler for every item in a :class:`~redis_throttled_queue.ThrottledQueue`, in a pool of threads and, optionally,
+    in a pool of processes (each with its own pool of threads and its own connection pool)::
+
+        Runner('redis://localhost', 'myqueue', 'mymodule:handle_item', threads=4, processes=8).run()
+
+    Exceptions raised by the handler are logged and counted, the worker moves on to the next item.
+    """
+
+    def __init__(
+        self,
+        redis_url: str,
+        prefix: str,
+        handler: Union[str, Callable],
+        *,
+        threads: int = 1,
+        processes: int = 0,
+        batch: int = 10,
+        limit: int = 10,
+        resolution=Resolution.SECOND,
+        page_size: int = 10,
+        strategy: Strategy = Strategy.FIXED_WINDOW,
+        burst: int = 1,
+        window: Union[str, bytes, int] = Ellipsis,
+        server_time: bool = False,
+        redis_options: Optional[dict] = None,
+        cluster: bool = False,
+        poll_interval: float = 1.0,
+        report_interval: float = 60.0,
+    ):
+        """
+        :param redis_url:
+            Passed to :meth:`~StrictRedis.from_url`, together with the `redis_options`.
+        :param cluster:
+            Connect with :class:`~redis.cluster.RedisCluster` instead.
+        :param handler:
+            A callable taking an item, or a ``'module:callable'`` string. With `processes` it must be picklable, thus
+            prefer the string form.
+        :param threads:
+            Worker threads in every process.
+        :param processes:
+            Worker processes. If ``0`` the threads run in the current process.
+        :param batch:
+            How many items a worker thread fetches at a time (with ``pop_many``). The items in a batch are handled in
+            sequence by the same thread, so large batches with slow handlers will leave other threads idle.
+        :param poll_interval:
+            Maximum time a worker blocks while waiting for items (when the queue is empty or throttled), this is how
+            long a shutdown might wait for idle workers.
+        :param report_interval:
+            How often (in seconds) to log the throughput of every worker thread.
+        """
+        if threads < 1:
+            raise ValueError('Incorrect value for `threads`. Must be at least 1.')
+        if processes < 0:
+            raise ValueError('Incorrect value for `processes`. Cannot be negative.')
+        if batch < 1:
+            raise ValueError('Incorrect value for `batch`. Must be at least 1.')
+        self._options = {
+            'redis_url': redis_url,
+            'prefix': prefix,
+            'handler': handler,
+            'threads': threads,
+            'batch': batch,
+            'limit': limit,
+            'resolution': resolution,
+            'page_size': page_size,
+            'strategy': strategy,
+            'burst': burst,
+            'window': window,
+            'server_time': server_time,
+            'redis_options': redis_options,
+            'cluster': cluster,
+            'poll_interval': poll_interval,
+            'report_interval': report_interval,
+        }
+        self.processes = processes
+        self.stats = []
+        self._stopping = threading.Event()
+        self._children = []
+
+    def stop(self):
+        """
+        Stops the workers. The items already fetched are still handled.
+        """
+        self._stopping.set()
+        for process in self._children:
+            if process.is_alive():
+                process.terminate()
+
+    def run(self):
+        """
+        Runs the workers until ``stop()`` is called. If called from the main thread, ``SIGTERM`` and ``SIGINT`` call ``stop()``.
+        """
+        self._stopping.clear()
+        handlers = {}
+        if threading.current_thread() is threading.main_thread():
+            for signum in signal.SIGTERM, signal.SIGINT:
+                handlers[signum] = signal.signal(signum, self._handle_signal)
+        try:
+            if self.processes:
+                self._run_processes()
+            else:
+                self._run_threads()
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+
+    def _handle_signal(self, signum, frame):
+        logger.info('Got signal %s, stopping.', signal.Signals(signum).name)
+        self.stop()
+
+    def _run_processes(self):
+        self._children = [
+            multiprocessing.Process(target=_run_process, args=(self._options,), name=f'rtq-worker-{index}')
+            for index in range(self.processes)
+        ]
+        for process in self._children:
+            process.start()
+        if self._stopping.is_set():  # got a signal while starting the processes
+            self.stop()
+        try:
+            for process in self._children:
+                process.join()
+        finally:
+            self._children = []
+
+    def _run_threads(self):
+        options = self._options
+        handler = resolve_handler(options['handler'])
+        client_class = RedisCluster if options['cluster'] else StrictRedis
+        client = client_class.from_url(options['redis_url'], **(options['redis_options'] or {}))
+        queue = ThrottledQueue(
+            client,
+            options['prefix'],
+            limit=options['limit'],
+            resolution=options['resolution'],
+            page_size=options['page_size'],
+            strategy=options['strategy'],
+            burst=options['burst'],
+            server_time=options['server_time'],
+        )
+        self.stats = [WorkerStats(f'{multiprocessing.current_process().name}/thread-{index}') for index in range(options['threads'])]
+        threads = [threading.Thread(target=self._work, args=(queue, handler, stats), name=stats.name) for stats in self.stats]
+        for thread in threads:
+            thread.start()
+        try:
+            while not self._stopping.wait(options['report_interval']):
+                self._report()
+        finally:
+            self._stopping.set()
+            for thread in threads:
+                thread.join()
+            self._report()
+            client.close()
+
+    def _work(self, queue: ThrottledQueue, handler: Callable, stats: WorkerStats):
+        batch = self._options['batch']
+        window = self._options['window']
+        poll_interval = self._options['poll_interval']
+        while not self._stopping.is_set():
+            items = queue.pop_many(batch, window) if batch > 1 else []
+            if not items:
+                # Waits for a push, or for the current window to end if everything is throttled.
+                item = queue.pop(window, timeout=poll_interval)
+                if item is None:
+                    continue
+                items = [item]
+            for item in items:
+                try:
+                    handler(item)
+                except Exception:
+                    stats.errors += 1
+                    logger.exception('Handler failed for item %r.', item)
+                else:
+                    stats.handled += 1
+
+    def _report(self):
+        for stats in self.stats:
+            logger.info('%s: %s handled, %s errors, %.1f items/s', stats.name, stats.handled, stats.errors, stats.throughput)
+
+
+def _run_process(options: dict):
+    Runner(**options).run()
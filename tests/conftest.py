@@ -53,6 +53,49 @@ def redis_slowlog(redis_server):
         print(f'{item["duration"]:5}ms: {indent(command, "         ").strip()}')
 
 
+class RedisStats:
+    """
+    Collects numbers from the Redis side of a benchmark: ``INFO commandstats``, ``SLOWLOG`` and memory usage. They are saved
+    in the ``extra_info`` of the benchmark, thus in the saved runs (``--benchmark-autosave``).
+    """
+
+    def __init__(self, client: StrictRedis):
+        self.client = client
+        self.baseline_memory = client.info('memory')['used_memory']
+
+    def reset(self):
+        """
+        Call after the setup, so that only the benchmarked calls are counted.
+        """
+        self.client.config_resetstat()
+        self.client.slowlog_reset()
+
+    def save(self, benchmark, *keys):
+        """
+        Saves the stats (and the ``MEMORY USAGE`` of the given `keys`) in the `benchmark`.
+        """
+        benchmark.extra_info['commandstats'] = {
+            name[len('cmdstat_') :]: {'calls': stats['calls'], 'usec_per_call': stats['usec_per_call']}
+            for name, stats in self.client.info('commandstats').items()
+        }
+        slowlog = self.client.slowlog_get(128)
+        benchmark.extra_info['slowlog'] = {
+            'count': self.client.slowlog_len(),
+            'max_usec': max((item['duration'] for item in slowlog), default=0),
+        }
+        benchmark.extra_info['memory'] = {
+            'used_memory': self.client.info('memory')['used_memory'] - self.baseline_memory,
+            **{key: self.client.memory_usage(key, samples=0) for key in keys},
+        }
+
+
+@pytest.fixture
+def redis_stats(redis_server):
+    client = StrictRedis(unix_socket_path=redis_server, decode_responses=True)
+    yield RedisStats(client)
+    client.close()
+
+
 @pytest.fixture
 def redis_conn(redis_server):
     ThrottledQueue._library_missing = True
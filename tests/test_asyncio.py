@@ -1,12 +1,17 @@
 import asyncio
 from time import sleep
+from time import time
 from types import SimpleNamespace
 
 import pytest
 from redis.asyncio import StrictRedis
 
 from redis_throttled_queue import AsyncThrottledQueue as ThrottledQueue
+from redis_throttled_queue import PopStatus
 from redis_throttled_queue import Resolution
+from redis_throttled_queue import Strategy
+from redis_throttled_queue.metrics import Metrics
+from redis_throttled_queue.sharded import AsyncShardedThrottledQueue
 
 pytest_plugins = ('pytester',)
 
@@ -98,6 +103,271 @@ async def test_dupes(redis_conn: StrictRedis, redis_monitor):
     assert await queue.size() == 0
 
 
+async def test_push_many(redis_conn: StrictRedis, redis_monitor):
+    queue = ThrottledQueue(redis_conn, 'test', limit=5, resolution=Resolution.SECOND)
+    assert await queue.push_many([]) == 0
+    assert await queue.push_many([('aaaaaa', f'a{item}', 10 - item) for item in range(10)]) == 10
+    assert await queue.push_many({'bbbbbb': [(f'b{item}', 10 - item) for item in range(10)]}) == 10
+    assert await queue.push_many([('aaaaaa', 'a0', 20), ('aaaaaa', 'a9'), ('bbbbbb', 'b0', 20)]) == 0
+    assert await queue.push_many({'cccccc': ['c0', 'c0']}) == 1
+
+    assert await queue.size() == 21
+    items = ','.join([await queue.pop() for _ in range(11)])
+    assert items == 'a0,b0,c0,a1,b1,a2,b2,a3,b3,a4,b4'
+    assert await queue.size() == 10
+    with pytest.raises(ValueError):
+        await queue.push_many([('a:b', 'x')])
+    assert await queue.size() == 10
+
+
+async def test_pop_many(redis_conn: StrictRedis, redis_monitor):
+    queue = ThrottledQueue(redis_conn, 'test', limit=5, resolution=Resolution.SECOND)
+    assert await queue.pop_many(10) == []
+    for item in range(10):
+        await queue.push('aaaaaa', f'a{item}', priority=10 - item)
+    for item in range(10):
+        await queue.push('bbbbbb', f'b{item}', priority=10 - item)
+    await queue.push('cccccc', 'c0')
+
+    assert await queue.size() == 21
+    assert await queue.pop_many(4) == ['a0', 'b0', 'c0', 'a1']
+    assert await queue.pop_many(3, with_names=True) == [('bbbbbb', 'b1'), ('aaaaaa', 'a2'), ('bbbbbb', 'b2')]
+    assert await queue.size() == 14
+    assert await queue.pop_many(100) == ['a3', 'b3', 'a4', 'b4']
+    assert await queue.pop_many(100) == []
+    assert await queue.size() == 10
+
+    await asyncio.sleep(1)
+
+    assert await queue.pop_many(100) == ['a5', 'b5', 'a6', 'b6', 'a7', 'b7', 'a8', 'b8', 'a9', 'b9']
+    assert await queue.size() == 0
+
+
+async def test_sharded(redis_conn: StrictRedis, redis_monitor):
+    shards = {f'shard{index}': ThrottledQueue(redis_conn, f'shard{index}', limit=100) for index in range(4)}
+    queue = AsyncShardedThrottledQueue({shard_id: shards[shard_id] for shard_id in ('shard0', 'shard1')})
+    assert await queue.push_many((f'name{index % 7}', f'item{index}') for index in range(50)) == 50
+    assert await queue.size() == 50
+
+    assert await queue.reshard({shard_id: shards[shard_id] for shard_id in ('shard2', 'shard3')}) == 50
+    assert await shards['shard0'].size() == await shards['shard1'].size() == 0
+    items = await queue.pop_many(45, 'X')
+    assert len(items) == 45
+    items += await queue.pop_many(45, 'X')
+    assert sorted(items) == sorted(f'item{index}' for index in range(50))
+    assert (await queue.pop_ex()).status is PopStatus.EMPTY
+    assert await queue.pop(timeout=0.1) is None
+
+    await queue.push('name1', 'one')
+    await queue.cleanup()
+    assert await queue.size() == 0
+
+
+async def test_limits(redis_conn: StrictRedis, redis_monitor):
+    queue = ThrottledQueue(redis_conn, 'test', limit=2, resolution=Resolution.SECOND)
+    await queue.set_limits({'aaaaaa': 4, 'bbbbbb': 1, 'cccccc': 0})
+    await queue.set_limit('dddddd', 3)
+    await queue.set_limit('dddddd', None)
+    assert await queue.limits() == {'aaaaaa': 4, 'bbbbbb': 1, 'cccccc': 0}
+    with pytest.raises(ValueError):
+        await queue.set_limit('dddddd', -1)
+    for name in 'abcd':
+        for item in range(5):
+            await queue.push(name * 6, f'{name}{item}', priority=-item)
+
+    assert await queue.pop_many(100, 'X') == ['a0', 'b0', 'd0', 'a1', 'd1', 'a2', 'a3']
+    assert await redis_conn.zrange('test:usage:X', 0, -1, withscores=True) == [
+        ('aaaaaa', float('inf')),
+        ('bbbbbb', float('inf')),
+        ('cccccc', float('inf')),
+        ('dddddd', float('inf')),
+    ]
+    assert await queue.pop('X') is None
+
+    await queue.set_limits({'aaaaaa': None, 'cccccc': None, 'dddddd': 1})
+    assert await queue.pop_many(100, 'Y') == ['a4', 'b1', 'c0', 'd2', 'c1']
+    assert await queue.pop('Y') is None
+
+
+async def test_out_of_line(redis_conn: StrictRedis, redis_monitor):
+    queue = ThrottledQueue(redis_conn, 'test', limit=10, resolution=Resolution.MINUTE, payload_threshold=100)
+    await queue.push('aaaaaa', 'x' * 1000)
+    await queue.push_many([('aaaaaa', 'x' * 1000, 1), ('bbbbbb', 'y' * 100)])
+    assert await queue.size() == 2
+    assert await redis_conn.hlen('test:data:aaaaaa') == 1
+    assert await queue.pop_many(10, 'X') == ['x' * 1000, 'y' * 100]
+
+
+async def test_delayed(redis_conn: StrictRedis, redis_monitor):
+    queue = ThrottledQueue(redis_conn, 'test', limit=10, resolution=Resolution.MINUTE)
+    assert await queue.push('aaaaaa', 'a0', not_before=time() + 0.2) == 1
+    assert await queue.size() == 0
+    assert await redis_conn.zcard('test:delayed') == 1
+    start = time()
+    assert await queue.pop('X', timeout=1) == 'a0'
+    assert time() - start == pytest.approx(0.2, abs=0.1)
+    assert await redis_conn.exists('test:delayed', 'test:delayed-items') == 0
+    await queue.push('aaaaaa', 'a1', not_before=time() + 60)
+    await queue.cleanup()
+    assert await redis_conn.keys('test:*') == []
+
+
+async def test_expiry(redis_conn: StrictRedis, redis_monitor):
+    queue = ThrottledQueue(redis_conn, 'test', limit=1, resolution=Resolution.MINUTE)
+    await queue.push('aaaaaa', 'a0', priority=1, expires_at=time() + 0.05)
+    await queue.push('aaaaaa', 'a1', expires_at=time() + 60)
+    await queue.push('bbbbbb', 'b0', expires_at=time() + 0.05)
+    assert await queue.size() == 3
+    await asyncio.sleep(0.1)
+    assert await queue.purge_expired() == 2
+    assert await queue.size() == 1
+    assert await queue.pop('X') == 'a1'
+    assert await redis_conn.exists('test:expiry') == 0
+    await queue.push('aaaaaa', 'a2', expires_at=time() + 60)
+    await queue.cleanup()
+    assert await redis_conn.keys('test:*') == []
+
+
+async def test_weights_and_classes(redis_conn: StrictRedis, redis_monitor):
+    queue = ThrottledQueue(redis_conn, 'test', limit=100, resolution=Resolution.MINUTE)
+    await queue.set_weights({'aaaaaa': 3})
+    await queue.set_classes({'cccccc': 1})
+    assert await queue.weights() == {'aaaaaa': 3}
+    assert await queue.classes() == {'cccccc': 1}
+    for name in 'abc':
+        for item in range(4):
+            await queue.push(name * 6, f'{name}{item}', priority=-item)
+
+    assert await queue.pop_many(12, 'X') == ['a0', 'b0', 'a1', 'a2', 'a3', 'b1', 'b2', 'b3', 'c0', 'c1', 'c2', 'c3']
+
+
+async def test_stats(redis_conn: StrictRedis, redis_monitor):
+    queue = ThrottledQueue(redis_conn, 'test', limit=2, resolution=Resolution.MINUTE)
+    assert await queue.stats() == (0, 0, [], [])
+    await queue.push_many((f'name{index}', f'item{item}') for index in range(5) for item in range(index + 1))
+    assert len(await queue.pop_many(7)) == 7
+    total, active_names, by_depth, by_usage = await queue.stats(3, page_size=2)
+    assert (total, active_names) == (8, 3)
+    assert by_depth == [('name4', 4), ('name3', 3), ('name2', 1)]
+    assert sorted(by_usage[:2]) == [('name1', 2), ('name2', 2)]
+    assert sorted((await queue.stats(10)).by_usage) == [('name0', 1), ('name1', 2), ('name2', 2), ('name3', 1), ('name4', 1)]
+
+
+async def test_cost(redis_conn: StrictRedis, redis_monitor):
+    queue = ThrottledQueue(redis_conn, 'test', limit=5, resolution=Resolution.MINUTE)
+    with pytest.raises(ValueError):
+        await queue.push('aaaaaa', 'a0', cost=0)
+    await queue.push('aaaaaa', 'big', priority=2, cost=4)
+    await queue.push('aaaaaa', 'small', priority=1)
+    await queue.push('aaaaaa', 'huge', cost=10)
+    await queue.push_many([('bbbbbb', 'b0'), ('bbbbbb', 'b1'), ('bbbbbb', 'b2')])
+    assert await queue.pop_many(10, 'X') == ['big', 'b2', 'b1', 'b0', 'small']
+    assert await queue.pop_many(10, 'Y') == ['huge']
+
+    await queue.push_many([('aaaaaa', 'a0', 1, 3), ('aaaaaa', 'a1', 0, 3), ('bbbbbb', 'b0')])
+    assert await queue.pop_many(10, 'Z') == ['a0', 'b0']
+    assert (await queue.pop_ex('Z')).status is PopStatus.THROTTLED
+    assert await queue.extract(['aaaaaa']) == [('aaaaaa', 'a1', 0, 3)]
+
+
+async def test_gcra(redis_conn: StrictRedis, redis_monitor):
+    queue = ThrottledQueue(redis_conn, 'test', limit=5, resolution=Resolution.SECOND, strategy=Strategy.GCRA)
+    assert await queue.pop_ex() == (PopStatus.EMPTY, None, None, None, None)
+    for item in range(6):
+        await queue.push('aaaaaa', f'a{item}', priority=10 - item)
+    await queue.push('bbbbbb', 'b0')
+    assert await queue.pop() == 'a0'
+    assert await queue.pop() == 'b0'
+    assert await queue.pop() is None
+    status, value, name, priority, retry_after = await queue.pop_ex()
+    assert status is PopStatus.THROTTLED
+    assert retry_after == pytest.approx(0.2, abs=0.05)
+
+    start = time()
+    assert [await queue.pop(timeout=1) for _ in range(4)] == ['a1', 'a2', 'a3', 'a4']
+    assert time() - start == pytest.approx(0.8, abs=0.1)
+
+    await queue.set_limit('aaaaaa', 10)
+    await queue.push('bbbbbb', 'b1')
+    start = time()
+    assert await queue.pop_many(10, with_names=True) == [('bbbbbb', 'b1')]
+    assert await queue.pop(timeout=1) == 'a5'
+    assert time() - start == pytest.approx(0.2, abs=0.05)
+    assert await queue.size() == 0
+    await queue.cleanup()
+    assert await redis_conn.keys('*') == []
+
+
+@pytest.mark.parametrize('server_time', [False, True])
+async def test_subsecond_resolution(redis_conn: StrictRedis, redis_monitor, server_time):
+    queue = ThrottledQueue(redis_conn, 'test', limit=3, resolution=0.2, server_time=server_time)
+    for item in range(7):
+        await queue.push('aaaaaa', f'a{item}', priority=10 - item)
+    await asyncio.sleep(0.2 - time() % 0.2)  # so the pops below don't straddle two windows
+    assert await queue.pop_many(10) == ['a0', 'a1', 'a2']
+    status, value, name, priority, retry_after = await queue.pop_ex()
+    assert status is PopStatus.THROTTLED
+    assert 0 < retry_after <= 0.2
+    assert all([0 < await redis_conn.pttl(key) <= 200 for key in await redis_conn.keys('test:window:*')])
+
+    start = time()
+    assert [await queue.pop(timeout=1) for _ in range(4)] == ['a3', 'a4', 'a5', 'a6']
+    assert time() - start <= 0.45
+    await queue.cleanup()
+    assert await redis_conn.keys('*') == []
+
+
+async def test_gcra_burst(redis_conn: StrictRedis, redis_monitor):
+    queue = ThrottledQueue(redis_conn, 'test', limit=10, resolution=Resolution.SECOND, strategy=Strategy.GCRA, burst=3)
+    for item in range(5):
+        await queue.push('aaaaaa', f'a{item}', priority=10 - item)
+    assert await queue.pop_many(10) == ['a0', 'a1', 'a2']
+    assert await queue.pop_many(10) == []
+    await asyncio.sleep(0.1)
+    assert await queue.pop_many(10) == ['a3']
+    await asyncio.sleep(0.3)
+    assert await queue.pop_many(10) == ['a4']
+
+
+async def test_pop_timeout(redis_conn: StrictRedis, redis_monitor):
+    queue = ThrottledQueue(redis_conn, 'test', limit=1, resolution=Resolution.SECOND)
+    start = time()
+    assert await queue.pop('X', timeout=0.2) is None
+    assert time() - start == pytest.approx(0.2, abs=0.1)
+
+    async def push_later():
+        await asyncio.sleep(0.2)
+        await queue.push('aaaaaa', 'a0')
+
+    pusher = asyncio.create_task(push_later())
+    start = time()
+    assert await queue.pop('X', timeout=5) == 'a0'
+    assert time() - start == pytest.approx(0.2, abs=0.1)
+    await pusher
+
+    await queue.push('aaaaaa', 'a1')
+    await queue.push('aaaaaa', 'a2')
+    assert await queue.pop() == 'a2'
+    start = time()
+    assert await queue.pop(timeout=5) == 'a1'
+    assert time() - start <= 1
+    assert await queue.size() == 0
+
+
+async def test_pop_ex(redis_conn: StrictRedis, redis_monitor):
+    queue = ThrottledQueue(redis_conn, 'test', limit=1, resolution=Resolution.MINUTE)
+    assert await queue.pop_ex() == (PopStatus.EMPTY, None, None, None, None)
+    await queue.push('aaaaaa', 'a0', priority=5)
+    await queue.push('aaaaaa', 'a1', priority=4)
+
+    assert await queue.pop_ex('X') == (PopStatus.ITEM, 'a0', 'aaaaaa', 5, None)
+    status, value, name, priority, retry_after = await queue.pop_ex('X')
+    assert status is PopStatus.THROTTLED
+    assert retry_after == pytest.approx(60, abs=0.5)
+    assert await queue.pop_ex('Y') == (PopStatus.ITEM, 'a1', 'aaaaaa', 4, None)
+    assert await queue.pop_ex('Y') == (PopStatus.EMPTY, None, None, None, None)
+
+
 async def test_cleanup(redis_conn: StrictRedis, redis_monitor):
     queue = ThrottledQueue(redis_conn, 'test', limit=5, resolution=Resolution.SECOND)
     for item in range(10):
@@ -116,6 +386,7 @@ async def test_cleanup(redis_conn: StrictRedis, redis_monitor):
     await asyncio.sleep(1)
 
     await queue.cleanup()
+    assert await redis_conn.keys('*') == []
     assert await queue.size() == 0
     assert await queue.pop() is None
     assert await get_ttl(redis_conn) == {}
@@ -130,10 +401,67 @@ async def test_cleanup_directly(redis_conn: StrictRedis, redis_monitor):
 
     assert await queue.size() == 20
     await queue.cleanup()
+    assert await redis_conn.keys('*') == []
     assert await queue.size() == 0
     assert await queue.pop() is None
 
 
+async def test_cleanup_batch(redis_conn: StrictRedis, redis_monitor):
+    await redis_conn.set('other', 'stuff')
+    queue = ThrottledQueue(redis_conn, 'test', limit=1, resolution=Resolution.SECOND)
+    await queue.push_many((f'name{index}', f'item{index}-{item}') for index in range(5) for item in range(2))
+    assert len(await queue.pop_many(10)) == 5
+    pytest.raises(ValueError, queue.cleanup, 0)
+
+    assert [unlinked async for unlinked in queue.cleanup(batch=2)] == [2, 2, 1 + 2 + 3]
+    assert await redis_conn.keys('*') == ['other']
+    assert await queue.size() == 0
+    assert [unlinked async for unlinked in queue.cleanup(batch=2)] == [0]
+
+
+async def test_metrics(redis_conn: StrictRedis, redis_monitor):
+    metrics = Metrics()
+    queue = ThrottledQueue(redis_conn, 'test', limit=1, resolution=Resolution.MINUTE, strategy=Strategy.GCRA, metrics=metrics)
+    assert await queue.push('aaaaaa', 'a0') == 1
+    assert await queue.push_many([('aaaaaa', 'a0'), ('aaaaaa', 'a1', -1)]) == 1
+    assert await queue.pop() == 'a0'
+    assert await queue.pop_many(10) == []
+    assert (await queue.pop_ex()).status is PopStatus.THROTTLED
+    await queue.cleanup()
+
+    snapshot = metrics.snapshot()
+    assert snapshot['counters'] == {
+        'push.added': 2,
+        'push.deduplicated': 1,
+        'pop.item': 1,
+        'pop.scanned': 1,
+        'pop_ex.throttled': 1,
+        'pop_ex.scanned': 0,
+        'pop_many.calls': 1,
+        'pop_many.items': 0,
+        'pop_many.scanned': 0,
+    }
+    assert sorted(snapshot['latencies']) == ['cleanup', 'pop', 'pop_ex', 'pop_many', 'push', 'push_many']
+
+
+async def test_cluster_prefix(redis_conn: StrictRedis, redis_monitor):
+    queue = ThrottledQueue(redis_conn, 'test', limit=5, resolution=Resolution.SECOND, cluster=True)
+    await queue.push('aaaaaa', 'a0')
+    await queue.push_many([('bbbbbb', 'b0', 1), ('bbbbbb', 'b1')])
+    assert await queue.size() == 3
+    assert await queue.pop() == 'a0'
+    assert await queue.pop_many(2) == ['b0', 'b1']
+    assert await queue.size() == 0
+    assert await redis_conn.keys('*')
+    assert all(key.startswith('{test}:') for key in await redis_conn.keys('*'))
+    await queue.cleanup()
+    assert await redis_conn.keys('*') == []
+
+    assert ThrottledQueue(redis_conn, 'te{st}', cluster=True)._prefix == 'te{st}'
+    assert ThrottledQueue(redis_conn, 'te{}st', cluster=True)._prefix == '{te{}st}'
+    assert ThrottledQueue(redis_conn, 'test')._prefix == 'test'
+
+
 async def test_cleanup_nothing(redis_conn: StrictRedis, redis_monitor):
     queue = ThrottledQueue(redis_conn, 'test', limit=5, resolution=Resolution.SECOND)
     assert await queue.size() == 0
@@ -236,3 +564,114 @@ async def test_validation():
     pytest.raises(TypeError, ThrottledQueue, conn, 123)
     with pytest.raises(ValueError):
         await ThrottledQueue(conn, 'foo').push(':', None)
+
+
+async def test_consume(redis_conn: StrictRedis, redis_monitor):
+    queue = ThrottledQueue(redis_conn, 'test', limit=5, resolution=Resolution.SECOND)
+    for item in range(5):
+        await queue.push('aaaaaa', f'a{item}', priority=10 - item)
+        await queue.push('bbbbbb', f'b{item}', priority=10 - item)
+
+    items = []
+    async with queue.consume(concurrency=4) as consumer:
+        async for item in consumer:
+            items.append(item)
+            if len(items) == 10:
+                consumer.stop()
+    assert ','.join(items) == 'a0,b0,a1,b1,a2,b2,a3,b3,a4,b4'
+    assert await queue.size() == 0
+
+
+async def test_consume_handler(redis_conn: StrictRedis, redis_monitor):
+    queue = ThrottledQueue(redis_conn, 'test', limit=10, resolution=Resolution.SECOND)
+    for item in range(9):
+        await queue.push('aaaaaa', f'a{item}')
+    running = []
+    max_running = 0
+
+    async def handler(item):
+        nonlocal max_running
+        running.append(item)
+        max_running = max(max_running, len(running))
+        await asyncio.sleep(0.1)
+        running.remove(item)
+        return item.upper()
+
+    results = []
+    start = time()
+    async with queue.consume(handler, concurrency=3) as consumer:
+        async for result in consumer:
+            results.append(result)
+            if len(results) == 9:
+                consumer.stop()
+    assert time() - start == pytest.approx(0.3, abs=0.1)
+    assert max_running == 3
+    assert sorted(results) == [f'A{item}' for item in range(9)]
+
+
+async def test_consume_wait(redis_conn: StrictRedis, redis_monitor):
+    queue = ThrottledQueue(redis_conn, 'test', limit=1, resolution=Resolution.SECOND)
+
+    async def push_later():
+        await asyncio.sleep(0.2)
+        await queue.push('aaaaaa', 'a0')
+
+    async with queue.consume(concurrency=2) as consumer:
+        pusher = asyncio.create_task(push_later())
+        start = time()
+        assert await consumer.__anext__() == 'a0'
+        assert time() - start == pytest.approx(0.2, abs=0.1)
+        await pusher
+
+        await queue.push('aaaaaa', 'a1', priority=1)
+        await queue.push('aaaaaa', 'a2')
+        start = time()
+        assert await consumer.__anext__() == 'a1'
+        assert time() - start <= 1
+        start = time()
+        assert await consumer.__anext__() == 'a2'
+        assert time() - start <= 1.1
+
+
+async def test_consume_single_call(redis_conn: StrictRedis, redis_monitor):
+    metrics = Metrics()
+    queue = ThrottledQueue(redis_conn, 'test', limit=1, resolution=Resolution.MINUTE, metrics=metrics)
+    for item in range(3):
+        await queue.push('aaaaaa', f'a{item}', priority=-item)
+    async with queue.consume(concurrency=4) as consumer:
+        assert await consumer.__anext__() == 'a0'
+        consumer.stop()
+    # The short batch tells it's throttled, without an extra pop_ex call.
+    assert metrics.snapshot()['latencies'].keys() == {'push', 'pop_many'}
+    assert metrics.snapshot()['latencies']['pop_many']['count'] == 1
+    items, miss = await queue._pop_many_ex(3, 'X')
+    assert items == ['a1']
+    assert miss.status is PopStatus.THROTTLED
+    assert miss.retry_after == pytest.approx(60, abs=0.5)
+    assert await queue._pop_many_ex(3, 'Y') == (['a2'], (PopStatus.EMPTY, None, None, None, None))
+    await queue.push('aaaaaa', 'a3')
+    assert await queue._pop_many_ex(1, 'Z') == (['a3'], None)
+
+
+async def test_consume_cancel(redis_conn: StrictRedis, redis_monitor):
+    queue = ThrottledQueue(redis_conn, 'test', limit=5, resolution=Resolution.SECOND)
+    await queue.push('aaaaaa', 'a0')
+    await queue.push('aaaaaa', 'a1')
+    started = asyncio.Event()
+    cancelled = []
+
+    async def handler(item):
+        try:
+            started.set()
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(item)
+            raise
+
+    consumer = queue.consume(handler, concurrency=5)
+    iteration = asyncio.ensure_future(consumer.__anext__())
+    await started.wait()
+    await consumer.aclose()
+    iteration.cancel()
+    assert sorted(cancelled) == ['a0', 'a1']
+    pytest.raises(ValueError, queue.consume, concurrency=0)
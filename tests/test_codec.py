@@ -0,0 +1,96 @@
+import pytest
+from redis.client import StrictRedis
+
+from redis_throttled_queue import AsyncThrottledQueue
+from redis_throttled_queue import PopStatus
+from redis_throttled_queue import ThrottledQueue
+from redis_throttled_queue.codec import ChainCodec
+from redis_throttled_queue.codec import Codec
+from redis_throttled_queue.codec import JSONCodec
+from redis_throttled_queue.codec import LzmaCodec
+from redis_throttled_queue.codec import MsgpackCodec
+from redis_throttled_queue.codec import ZlibCodec
+from redis_throttled_queue.codec import ZstdCodec
+from redis_throttled_queue.memory import AsyncMemoryRedis
+from redis_throttled_queue.memory import MemoryRedis
+
+DOCUMENT = {'id': 1, 'tags': ['a', 'b'], 'body': 'lorem ipsum ' * 200}
+
+
+@pytest.fixture(params=['redis', 'memory'])
+def client(request):
+    """
+    Returns a client that doesn't decode the responses, for each backend.
+    """
+    if request.param == 'redis':
+        ThrottledQueue._library_missing = True
+        return StrictRedis(unix_socket_path=request.getfixturevalue('redis_server'))
+    else:
+        return MemoryRedis()
+
+
+@pytest.mark.parametrize('codec', [ZlibCodec(), LzmaCodec(), ZlibCodec(level=1)], ids=repr)
+def test_compression(client, codec):
+    queue = ThrottledQueue(client, 'test', limit=10, codec=codec)
+    payload = b'x' * 10000
+    assert queue.push('name', payload) == 1
+    assert queue.push('name', memoryview(payload)) == 0
+    queue.push('name', bytearray(b'y' * 100), priority=1)
+    queue.push('name', 'text')
+    assert len(codec.encode(payload)) < 100
+    assert queue.pop_many(2, 'w') == [b'y' * 100, payload]
+    assert queue.pop('w') == b'text'
+    assert queue.pop('w') is None
+
+
+def test_serializer(client):
+    queue = ThrottledQueue(client, 'test', limit=10, codec=JSONCodec(sort_keys=True) | ZlibCodec())
+    assert queue.push('name', DOCUMENT) == 1
+    assert queue.push('name', dict(reversed(DOCUMENT.items()))) == 0
+    queue.push('name', [1, 'two'], priority=1)
+    queue.push('other', None)
+    assert queue.extract(['other']) == [(b'other', None, 0)]
+    result = queue.pop_ex('w')
+    assert (result.status, result.value, result.name) == (PopStatus.ITEM, [1, 'two'], b'name')
+    assert queue.pop_many(10, 'w', with_names=True) == [(b'name', DOCUMENT)]
+
+
+def test_chain():
+    codec = JSONCodec() | ZlibCodec() | LzmaCodec(preset=1)
+    assert isinstance(codec, ChainCodec)
+    assert repr(codec) == 'JSONCodec() | ZlibCodec(level=6) | LzmaCodec(preset=1)'
+    assert codec.decode(codec.encode(DOCUMENT)) == DOCUMENT
+
+
+def test_incomplete_codec():
+    class EncodeOnly(Codec):
+        def encode(self, data) -> bytes:
+            return data
+
+    pytest.raises(TypeError, Codec)
+    pytest.raises(TypeError, EncodeOnly)
+
+
+def test_optional_codecs(client):
+    pytest.importorskip('zstandard')
+    pytest.importorskip('msgpack')
+    queue = ThrottledQueue(client, 'test', limit=10, codec=MsgpackCodec() | ZstdCodec())
+    queue.push('name', DOCUMENT)
+    queue.push('name', {'binary': b'\x00\xff'}, priority=1)
+    assert queue.pop_many(10, 'w') == [{'binary': b'\x00\xff'}, DOCUMENT]
+
+
+def test_decode_responses(redis_conn: StrictRedis):
+    with pytest.raises(ValueError):
+        ThrottledQueue(redis_conn, 'test', codec=ZlibCodec())
+    with pytest.raises(ValueError):
+        ThrottledQueue(MemoryRedis(decode_responses=True), 'test', codec=ZlibCodec())
+
+
+async def test_asyncio():
+    queue = AsyncThrottledQueue(AsyncMemoryRedis(), 'test', limit=10, codec=JSONCodec() | ZlibCodec())
+    assert await queue.push('name', DOCUMENT) == 1
+    assert await queue.push_many([('name', [1], 1), ('name', DOCUMENT)]) == 1
+    assert await queue.pop('w') == [1]
+    assert await queue.pop_many(10, 'w') == [DOCUMENT]
+    assert await queue.pop('w') is None
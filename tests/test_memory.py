@@ -0,0 +1,389 @@
+import asyncio
+import random
+from threading import Timer
+from time import sleep
+from time import time
+
+import pytest
+from redis.client import StrictRedis
+from redis.exceptions import ResponseError
+
+from redis_throttled_queue import AsyncThrottledQueue
+from redis_throttled_queue import PopStatus
+from redis_throttled_queue import Resolution
+from redis_throttled_queue import Strategy
+from redis_throttled_queue import ThrottledQueue
+from redis_throttled_queue.memory import AsyncMemoryRedis
+from redis_throttled_queue.memory import MemoryRedis
+from redis_throttled_queue.metrics import Metrics
+
+
+@pytest.fixture(params=['redis', 'memory'])
+def client(request):
+    """
+    Returns a client for each backend, the tests using it must pass with both.
+    """
+    if request.param == 'redis':
+        return request.getfixturevalue('redis_conn')
+    else:
+        return MemoryRedis(decode_responses=True)
+
+
+def test_simple(client):
+    queue = ThrottledQueue(client, 'test', limit=5, resolution=Resolution.SECOND)
+    for item in range(10):
+        queue.push('aaaaaa', f'a{item}', priority=10 - item)
+    for item in range(10):
+        queue.push('bbbbbb', f'b{item}', priority=10 - item)
+
+    assert len(queue) == 20
+    assert ','.join(queue.pop('w') for _ in range(10)) == 'a0,b0,a1,b1,a2,b2,a3,b3,a4,b4'
+    assert queue.pop('w') is None
+    assert len(queue) == 10
+    assert ','.join(queue.pop('x') for _ in range(10)) == 'a5,b5,a6,b6,a7,b7,a8,b8,a9,b9'
+    assert queue.pop('x') is None
+    assert len(queue) == 0
+
+
+def test_dedupe_and_priority(client):
+    queue = ThrottledQueue(client, 'test', limit=10)
+    assert queue.push('name', 'a', priority=1) == 1
+    assert queue.push('name', 'b', priority=2) == 1
+    assert queue.push('name', 'a', priority=3) == 0
+    assert queue.push('name', 'b', priority=0) == 0
+    assert queue.push_many([('name', 'c', 2), ('name', 'a', 1)]) == 1
+    assert len(queue) == 3
+    assert queue.pop_many(10, 'w') == ['a', 'c', 'b']
+
+
+def test_limits(client):
+    queue = ThrottledQueue(client, 'test', limit=1, resolution=Resolution.MINUTE)
+    queue.push_many((name, f'{name}{item}') for name in ('a', 'b', 'c') for item in range(3))
+    queue.set_limits({'a': 2, 'c': 0})
+    assert queue.limits() == {'a': 2, 'c': 0}
+    assert queue.pop_many(10, 'w', with_names=True) == [('a', 'a2'), ('b', 'b2'), ('a', 'a1')]
+    assert queue.pop_ex('w')[:4] == (PopStatus.THROTTLED, None, None, None)
+    queue.set_limit('c', None)
+    # Names with a 0 limit are skipped for the rest of the window.
+    assert queue.pop_many(10, 'w') == []
+    assert queue.names() == ['a', 'b', 'c']
+    assert queue.extract(['b']) == [('b', 'b1', 0), ('b', 'b0', 0)]
+    assert len(queue) == 4
+    assert queue.pop_many(10, 'x') == ['a0', 'c2']
+
+
+def test_refill_in_window(client):
+    queue = ThrottledQueue(client, 'test', limit=3, resolution=Resolution.MINUTE)
+    queue.push('a', 'a0')
+    queue.push('b', 'b0')
+    assert queue.pop_many(10, 'w') == ['a0', 'b0']
+    assert queue.pop_ex('w').status is PopStatus.EMPTY
+    queue.push('c', 'c0')
+    queue.push('b', 'b1')
+    queue.push('a', 'a1')
+    # Names queued after the window started have to wait for the next window.
+    assert queue.pop_many(10, 'w') == ['a1', 'b1']
+    assert queue.pop_many(10, 'w') == []
+    assert queue.pop_many(10, 'x') == ['c0']
+
+
+def test_paused_names(client):
+    metrics = Metrics()
+    queue = ThrottledQueue(client, 'test', limit=2, resolution=Resolution.MINUTE, metrics=metrics)
+    queue.set_limits({f'name{index:02}': 0 for index in range(50)})
+    queue.push_many((f'name{index:02}', 'item') for index in range(50))
+    assert queue.pop('w') is None
+    assert metrics.snapshot()['counters']['pop.scanned'] == 50
+    # Paused names are parked for the rest of the window, thus not scanned again.
+    assert queue.pop('w') is None
+    assert queue.pop_ex('w').status is PopStatus.THROTTLED
+    assert metrics.snapshot()['counters']['pop.scanned'] == 50
+    # Nothing was served in the window yet, thus new names are eligible right away.
+    queue.push('other', 'other')
+    assert queue.pop('w') == 'other'
+    assert metrics.snapshot()['counters']['pop.scanned'] == 51
+    assert queue.pop('x') is None
+    assert metrics.snapshot()['counters']['pop.scanned'] == 101
+
+
+def test_gcra(client):
+    queue = ThrottledQueue(client, 'test', limit=5, resolution=Resolution.SECOND, strategy=Strategy.GCRA)
+    assert queue.pop_ex() == (PopStatus.EMPTY, None, None, None, None)
+    for item in range(3):
+        queue.push('aaaaaa', f'a{item}', priority=10 - item)
+    queue.push('bbbbbb', 'b0')
+    assert queue.pop() == 'a0'
+    assert queue.pop() == 'b0'
+    status, value, name, priority, retry_after = queue.pop_ex()
+    assert status is PopStatus.THROTTLED
+    assert retry_after == pytest.approx(0.2, abs=0.05)
+    assert queue.pop(timeout=1) == 'a1'
+
+
+def test_pop_ex_ttl(client):
+    queue = ThrottledQueue(client, 'test', limit=1, resolution=0.5, server_time=True)
+    sleep(0.5 - time() % 0.5)
+    queue.push('name', 'a')
+    queue.push('name', 'b')
+    assert queue.pop() == 'b'
+    status, value, name, priority, retry_after = queue.pop_ex()
+    assert status is PopStatus.THROTTLED
+    assert 0 < retry_after <= 0.5
+    assert queue.pop(timeout=1) == 'a'
+
+
+def test_pop_ex_throttled_at_window_end():
+    queue = ThrottledQueue(MemoryRedis(), 'test', limit=1)
+    # A window that ends right now still waits a bit, it doesn't turn into waiting for a push.
+    assert queue._pop_ex_result([2, 0], 'w').retry_after == 0.001
+    assert queue._get_wait(0.0, None) == 0.001
+    assert queue._get_wait(None, None) == 0
+    assert queue._get_wait(None, time() + 10) == pytest.approx(10, abs=0.1)
+    assert queue._get_wait(0.5, time() - 1) is None
+
+
+def test_stats_and_cleanup(client):
+    queue = ThrottledQueue(client, 'test', limit=2, resolution=Resolution.MINUTE)
+    queue.push_many((f'name{index}', f'item{item}') for index in range(3) for item in range(index + 1))
+    assert queue.pop_many(2, 'w') == ['item0', 'item1']
+    assert queue.stats(2, 'w') == (4, 2, [('name2', 3), ('name1', 1)], [('name0', 1), ('name1', 1)])
+    assert sum(queue.cleanup(batch=2)) > 0
+    assert len(queue) == 0
+    assert queue.pop('w') is None
+    queue.push('name', 'item')
+    queue.cleanup()
+    assert len(queue) == 0
+    assert queue.names() == []
+
+
+def test_cleanup_batches(client):
+    queue = ThrottledQueue(client, 'test', limit=2, resolution=Resolution.MINUTE)
+    for name in 'abc':
+        queue.push(name, f'{name}0', cost=2)
+    assert queue.pop('w') == 'a0'
+    assert queue.pop('x') == 'b0'
+    steps = list(queue.cleanup(batch=2))
+    # The batch counts names and windows (not keys): the queue and cost keys of c and the keys of a window, then the rest.
+    assert steps[0] == 4
+    assert len(steps) == 2
+    assert len(queue) == 0
+
+
+def test_delayed(client):
+    queue = ThrottledQueue(client, 'test', limit=10, resolution=Resolution.MINUTE, payload_threshold=8)
+    due = time() + 0.2
+    assert queue.push('name', 'a', not_before=due) == 1
+    assert queue.push('name', 'a', priority=5, not_before=due + 10) == 0
+    assert queue.push('name', 'long item', cost=2, not_before=due) == 1
+    assert queue.push('name', 'b', not_before=time() - 1) == 1
+    assert len(queue) == 1
+    assert queue.names() == ['name']
+    assert queue.pop('w') == 'b'
+    result = queue.pop_ex('w')
+    assert result.status is PopStatus.EMPTY
+    assert result.retry_after == pytest.approx(0.2, abs=0.05)
+    assert queue.pop('w', timeout=1) == 'a'
+    assert time() >= due
+    assert len(queue) == 1
+    assert queue.pop_many(10, 'w') == ['long item']
+    assert queue.pop_ex('w') == (PopStatus.EMPTY, None, None, None, None)
+
+
+def test_delayed_batches(client):
+    queue = ThrottledQueue(client, 'test', limit=1000, resolution=Resolution.MINUTE)
+    due = time() + 0.5
+    for item in range(150):
+        queue.push('name', f'item{item}', not_before=due)
+    sleep(due - time() + 0.01)
+    assert len(queue) == 0
+    # Up to 100 due items are queued by every pop call.
+    assert len(queue.pop_many(1000, 'w')) == 100
+    assert len(queue.pop_many(1000, 'w')) == 50
+
+
+def test_delayed_gcra(client):
+    queue = ThrottledQueue(client, 'test', limit=1, resolution=Resolution.MINUTE, strategy=Strategy.GCRA)
+    queue.push('name', 'a')
+    queue.push('other', 'b', not_before=time() + 0.1)
+    assert queue.pop() == 'a'
+    queue.push('name', 'c')
+    result = queue.pop_ex()
+    assert result.status is PopStatus.THROTTLED
+    assert result.retry_after == pytest.approx(0.1, abs=0.05)
+    assert queue.pop(timeout=1) == 'b'
+    queue.cleanup()
+    assert queue.pop_ex().status is PopStatus.EMPTY
+
+
+def test_expiry(client):
+    queue = ThrottledQueue(client, 'test', limit=1, resolution=Resolution.MINUTE, payload_threshold=8)
+    expires_at = time() + 0.2
+    assert queue.push('name', 'long item', priority=5, cost=2, expires_at=expires_at) == 1
+    for item in range(150):
+        queue.push('name', f'item{item}', priority=1, expires_at=expires_at)
+    queue.push('name', 'a')
+    assert queue.push('name', 'b', expires_at=time() - 1) == 0
+    assert queue.push('other', 'c', not_before=time() + 0.1, expires_at=time() + 0.05) == 0
+    assert len(queue) == 152
+    sleep(expires_at - time() + 0.01)
+    # Up to 100 expired items are dropped up front, the pop skips the rest (without charging them).
+    assert queue.pop('w') == 'a'
+    assert len(queue) == 0
+    assert queue.names() == []
+    assert queue.pop_ex('w').status is PopStatus.EMPTY
+
+
+def test_purge_expired(client):
+    queue = ThrottledQueue(client, 'test', limit=10, resolution=Resolution.MINUTE)
+    expires_at = time() + 0.1
+    for item in range(5):
+        queue.push(f'name{item % 2}', f'item{item}', expires_at=expires_at)
+    queue.push('name0', 'item0')  # doesn't expire anymore
+    queue.push('name2', 'x', expires_at=time() + 60)
+    queue.push('name2', 'y', not_before=time() + 0.05, expires_at=expires_at + 60)
+    sleep(expires_at - time() + 0.01)
+    assert len(queue) == 6
+    assert queue.extract(['name1']) == []
+    assert len(queue) == 4
+    assert queue.purge_expired(batch=1) == 1
+    assert queue.purge_expired() == 1
+    assert queue.purge_expired() == 0
+    assert len(queue) == 2
+    assert queue.names() == ['name0', 'name2']
+    assert sorted(queue.pop_many(10, 'w')) == ['item0', 'x', 'y']
+    pytest.raises(ValueError, queue.purge_expired, 0)
+
+
+def test_fcall_errors(client):
+    pytest.raises(ResponseError, client.fcall, 'RTQ_POP', 1, 'test', 'w', 1)
+    pytest.raises(ResponseError, client.fcall, 'RTQ_PUSH_MANY', 1, 'test', 'name', 1)
+    pytest.raises(ResponseError, client.fcall, 'RTQ_MISSING', 1, 'test')
+
+
+def test_fcall_ro(client):
+    queue = ThrottledQueue(client, 'test', limit=1, resolution=Resolution.MINUTE)
+    queue.push('name', 'item')
+    assert client.fcall_ro('RTQ_STATS', 1, 'test', 'w', 1, 60, 10, 10, '', '')[:2] == [1, 1]
+    pytest.raises(ResponseError, client.fcall_ro, 'RTQ_POP', 1, 'test', 'w', 1, 60, 10)
+    assert len(queue) == 1
+
+
+def test_same_as_redis(redis_conn: StrictRedis):
+    """
+    Runs the same random operations on both backends.
+    """
+    rng = random.Random(0)  # noqa: S311
+    # Some of the items get stored out of line (the ones with a two digit number).
+    queues = [
+        ThrottledQueue(redis_conn, 'test', limit=3, resolution=Resolution.MINUTE, page_size=2, payload_threshold=8),
+        ThrottledQueue(MemoryRedis(decode_responses=True), 'test', limit=3, resolution=Resolution.MINUTE, page_size=2, payload_threshold=8),
+    ]
+    names = [f'name{index}' for index in range(8)]
+    for _ in range(2000):
+        operation = rng.random()
+        window = rng.choice('abc')
+        if operation < 0.4:
+            name = rng.choice(names)
+            args = name, f'{name}-{rng.randrange(20)}'
+            kwargs = {
+                'priority': rng.randrange(5),
+                'cost': rng.choice([1, 1, 2, 4]),
+                'not_before': rng.choice([None, None, None, time() - 60, time() + 3600]),
+                'expires_at': rng.choice([None, None, None, time() - 60, time() + 3600]),
+            }
+            call = 'push'
+        elif operation < 0.5:
+            args = (
+                [(rng.choice(names), f'item{rng.randrange(50)}', rng.randrange(5), rng.randint(1, 2)) for _ in range(rng.randrange(5))],
+            )
+            kwargs = {}
+            call = 'push_many'
+        elif operation < 0.7:
+            args = (window,)
+            kwargs = {}
+            call = 'pop'
+        elif operation < 0.8:
+            args = (window,)
+            kwargs = {}
+            call = 'pop_ex'
+        elif operation < 0.95:
+            args = rng.randrange(6), window
+            kwargs = {'with_names': True}
+            call = 'pop_many'
+        elif operation < 0.97:
+            args = ({rng.choice(names): rng.choice([0, 1, 5, None])},)
+            kwargs = {}
+            call = 'set_limits'
+        elif operation < 0.985:
+            args = ({rng.choice(names): rng.choice([1, 2, 3, None])},)
+            kwargs = {}
+            call = 'set_weights'
+        else:
+            args = ({rng.choice(names): rng.choice([0, 1, None])},)
+            kwargs = {}
+            call = 'set_classes'
+        results = [getattr(queue, call)(*args, **kwargs) for queue in queues]
+        if call == 'pop_ex':
+            results = [result[:4] for result in results]
+        assert results[0] == results[1], (call, args)
+        assert len(queues[0]) == len(queues[1])
+    assert queues[0].names() == queues[1].names()
+    # The order of the names with the same count is not defined.
+    assert [sorted(value) if isinstance(value, list) else value for value in queues[0].stats(window='a')] == [
+        sorted(value) if isinstance(value, list) else value for value in queues[1].stats(window='a')
+    ]
+
+
+def test_blocking_pop():
+    queue = ThrottledQueue(MemoryRedis(), 'test', limit=1)
+    Timer(0.1, queue.push, ('name', 'item')).start()
+    start = time()
+    assert queue.pop(timeout=1) == b'item'
+    assert time() - start == pytest.approx(0.1, abs=0.05)
+    assert queue.pop(timeout=0.1) is None
+
+
+@pytest.mark.parametrize('strategy', list(Strategy))
+async def test_pop_many_ex(strategy):
+    queue = AsyncThrottledQueue(AsyncMemoryRedis(decode_responses=True), 'test', limit=1, resolution=Resolution.MINUTE, strategy=strategy)
+    await queue.push_many([('a', 'a0'), ('a', 'a1'), ('b', 'b0')])
+    items, miss = await queue._pop_many_ex(5, 'w')
+    assert sorted(items) == ['a1', 'b0']
+    assert miss.status is PopStatus.THROTTLED
+    assert 0 < miss.retry_after <= 60
+    assert await queue._pop_many_ex(1, 'w') == ([], miss._replace(retry_after=pytest.approx(miss.retry_after, abs=0.5)))
+    await queue.push('c', 'c0')
+    items, miss = await queue._pop_many_ex(1, 'x')
+    assert len(items) == 1
+    assert miss is None
+
+
+async def test_asyncio():
+    client = AsyncMemoryRedis(decode_responses=True)
+    queue = AsyncThrottledQueue(client, 'test', limit=1, resolution=Resolution.MINUTE)
+    await queue.push_many([('a', 'a0'), ('a', 'a1'), ('b', 'b0')])
+    assert await queue.size() == 3
+    assert await queue.pop_many(10, 'w') == ['a1', 'b0']
+    assert await queue.pop('w') is None
+    assert await queue.pop_many(10, 'x') == ['a0']
+    assert await queue.stats() == (0, 0, [], [])
+
+    async def push_later():
+        await asyncio.sleep(0.1)
+        await queue.push('c', 'c0')
+
+    task = asyncio.create_task(push_later())
+    start = time()
+    assert await queue.pop('y', timeout=1) == 'c0'
+    assert time() - start == pytest.approx(0.1, abs=0.05)
+    await task
+    await queue.cleanup()
+    assert await queue.names() == []
+
+
+async def test_asyncio_shared_client():
+    client = MemoryRedis()
+    producer = ThrottledQueue(client, 'test', limit=1)
+    consumer = AsyncThrottledQueue(AsyncMemoryRedis(client=client), 'test', limit=1)
+    asyncio.get_running_loop().call_later(0.1, producer.push, 'name', 'item')
+    assert await consumer.pop(timeout=1) == b'item'
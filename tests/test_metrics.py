@@ -0,0 +1,62 @@
+import pytest
+from redis.client import StrictRedis
+
+from redis_throttled_queue import Resolution
+from redis_throttled_queue import ThrottledQueue
+from redis_throttled_queue.metrics import Histogram
+from redis_throttled_queue.metrics import Metrics
+
+
+def test_histogram():
+    histogram = Histogram([0.001, 0.01, 0.1])
+    assert histogram.quantile(0.5) == 0
+    for value in [0.0005] * 50 + [0.005] * 45 + [0.05] * 4 + [1]:
+        histogram.add(value)
+    assert histogram.counts == [50, 45, 4, 1]
+    assert histogram.count == 100
+    assert histogram.mean == pytest.approx(0.0145)
+    assert histogram.quantile(0.5) == 0.001
+    assert histogram.quantile(0.95) == 0.01
+    assert histogram.quantile(0.99) == 0.1
+    assert histogram.quantile(1) == 1
+
+
+def test_metrics(redis_conn: StrictRedis, redis_monitor):
+    metrics = Metrics()
+    queue = ThrottledQueue(redis_conn, 'test', limit=2, resolution=Resolution.MINUTE, metrics=metrics)
+    assert queue.push('aaaaaa', 'a0') == 1
+    assert queue.push('aaaaaa', 'a0', priority=1) == 0
+    assert queue.push_many([('aaaaaa', 'a1'), ('aaaaaa', 'a2'), ('bbbbbb', 'b0'), ('bbbbbb', 'b0')]) == 3
+    assert queue.pop() == 'a0'
+    assert queue.pop_many(10) == ['b0', 'a2']
+    assert queue.pop() is None
+    assert queue.pop_ex().retry_after > 0
+    assert list(queue.cleanup(batch=10))
+
+    snapshot = metrics.snapshot()
+    assert snapshot['counters'] == {
+        'push.added': 4,
+        'push.deduplicated': 2,
+        'pop.item': 1,
+        'pop.miss': 1,
+        'pop.scanned': 1,  # the names that reached their limit are parked, thus not scanned again
+        'pop_ex.throttled': 1,
+        'pop_ex.scanned': 0,
+        'pop_many.calls': 1,
+        'pop_many.items': 2,
+        'pop_many.scanned': 2,
+        'cleanup.unlinked': snapshot['counters']['cleanup.unlinked'],
+    }
+    assert snapshot['counters']['cleanup.unlinked'] > 0
+    assert {operation: latency['count'] for operation, latency in snapshot['latencies'].items()} == {
+        'push': 2,
+        'push_many': 1,
+        'pop': 2,
+        'pop_ex': 1,
+        'pop_many': 1,
+        'cleanup': 1,
+    }
+    assert all(0 < latency['mean'] <= latency['max'] <= 1 for latency in snapshot['latencies'].values())
+
+    metrics.reset()
+    assert metrics.snapshot() == {'counters': {}, 'latencies': {}}
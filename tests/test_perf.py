@@ -1,7 +1,32 @@
+import asyncio
+import random
+import threading
+from itertools import islice
+
 import pytest
+from redis.asyncio import StrictRedis as AsyncStrictRedis
 from redis.client import StrictRedis
 
+from redis_throttled_queue import AsyncThrottledQueue
+from redis_throttled_queue import Resolution
+from redis_throttled_queue import Strategy
 from redis_throttled_queue import ThrottledQueue
+from redis_throttled_queue.codec import JSONCodec
+from redis_throttled_queue.codec import LzmaCodec
+from redis_throttled_queue.codec import ZlibCodec
+from redis_throttled_queue.codec import ZstdCodec
+
+# names, items per name
+WORKLOADS = {
+    'many-names-few-items': (100000, 1),
+    'few-names-many-items': (10, 10000),
+}
+
+
+def fill_items(names, items):
+    pending = ((f'N{name}', f'{name}-{item}') for name in range(names) for item in range(items))
+    while chunk := list(islice(pending, 10000)):
+        yield chunk
 
 
 @pytest.mark.parametrize('items', [1000])
@@ -31,3 +56,271 @@ def test_push(
                 queue.push(f'N{name}', str(name))
 
     benchmark.pedantic(run, setup=setup, iterations=1, rounds=10)
+
+
+@pytest.mark.parametrize('items', [1000])
+@pytest.mark.parametrize('limit', [5])
+@pytest.mark.parametrize('names', [100000])
+@pytest.mark.parametrize('push_names', [100])
+@pytest.mark.parametrize('resolution', [10])
+def test_push_many(
+    benchmark,
+    items,
+    limit,
+    names,
+    push_names,
+    redis_conn: StrictRedis,
+    redis_slowlog,
+    resolution,
+):
+    queue = ThrottledQueue(redis_conn, 'test', limit=limit, resolution=resolution)
+
+    def setup():
+        queue.push_many((f'N{name}', 'initial') for name in range(names))
+
+    def run():
+        for name in range(push_names):
+            queue.push_many((f'N{name}', str(name)) for _ in range(items))
+
+    benchmark.pedantic(run, setup=setup, iterations=1, rounds=10)
+
+
+@pytest.mark.parametrize('names', [1000, 10000, 100000, 1000000])
+@pytest.mark.parametrize('pops', [100])
+@pytest.mark.parametrize('page_size', [10])
+def test_pop(
+    benchmark,
+    names,
+    pops,
+    page_size,
+    redis_conn: StrictRedis,
+    redis_slowlog,
+):
+    """
+    Pop latency should not depend on the number of names.
+    """
+    queue = ThrottledQueue(redis_conn, 'test', limit=1, resolution=Resolution.MINUTE, page_size=page_size)
+    for start in range(0, names, 10000):
+        queue.push_many((f'N{name}', str(name)) for name in range(start, min(start + 10000, names)))
+    windows = iter(range(60))
+
+    def run():
+        window = next(windows)
+        for _ in range(pops):
+            queue.pop(window)
+
+    benchmark.pedantic(run, iterations=1, rounds=10)
+
+
+@pytest.mark.parametrize('strategy', [Strategy.FIXED_WINDOW, Strategy.GCRA])
+@pytest.mark.parametrize('names', [1000, 100000])
+@pytest.mark.parametrize('pops', [100])
+def test_pop_strategy(
+    benchmark,
+    strategy,
+    names,
+    pops,
+    redis_conn: StrictRedis,
+    redis_slowlog,
+):
+    """
+    Compares the strategies. The Redis CPU time per pop (from ``INFO commandstats``) is saved in the ``extra_info``.
+    """
+    queue = ThrottledQueue(redis_conn, 'test', limit=10, resolution=Resolution.MINUTE, strategy=strategy)
+    for start in range(0, names, 10000):
+        queue.push_many((f'N{name}', str(name)) for name in range(start, min(start + 10000, names)) for _ in range(10))
+    windows = iter(range(60))
+    redis_conn.config_resetstat()
+
+    def run():
+        window = next(windows)
+        for _ in range(pops):
+            queue.pop(window)
+
+    benchmark.pedantic(run, iterations=1, rounds=10)
+    benchmark.extra_info['redis_usec_per_pop'] = redis_conn.info('commandstats')['cmdstat_fcall']['usec_per_call']
+
+
+@pytest.mark.parametrize('method', ['pop', 'pop_many'])
+@pytest.mark.parametrize('workload', WORKLOADS)
+def test_pop_workload(
+    benchmark,
+    method,
+    workload,
+    redis_conn: StrictRedis,
+    redis_slowlog,
+    redis_stats,
+):
+    """
+    Pop-heavy: 100 items every round, with ``pop()`` or a single ``pop_many()``.
+    """
+    queue = ThrottledQueue(redis_conn, 'test', limit=10, resolution=Resolution.MINUTE)
+    for chunk in fill_items(*WORKLOADS[workload]):
+        queue.push_many(chunk)
+    windows = iter(range(60))
+    redis_stats.reset()
+
+    def run():
+        window = next(windows)
+        if method == 'pop':
+            for _ in range(100):
+                queue.pop(window)
+        else:
+            queue.pop_many(100, window)
+
+    benchmark.pedantic(run, iterations=1, rounds=10)
+    redis_stats.save(benchmark, 'test:names', 'test:queue:N0')
+
+
+@pytest.mark.parametrize('consumers', [1, 4])
+@pytest.mark.parametrize('names', [10, 1000])
+def test_mixed(
+    benchmark,
+    consumers,
+    names,
+    redis_conn: StrictRedis,
+    redis_slowlog,
+    redis_stats,
+):
+    """
+    A producer pushes 1000 items while the consumer threads pop them (blocking while the queue is empty).
+    """
+    queue = ThrottledQueue(redis_conn, 'test', limit=1000, resolution=Resolution.SECOND)
+    redis_stats.reset()
+
+    def run():
+        popped = []
+
+        def consume():
+            while len(popped) < 1000:
+                item = queue.pop(timeout=0.01)
+                if item is not None:
+                    popped.append(item)
+
+        threads = [threading.Thread(target=consume) for _ in range(consumers)]
+        for thread in threads:
+            thread.start()
+        for item in range(1000):
+            queue.push(f'N{item % names}', str(item))
+        for thread in threads:
+            thread.join()
+
+    benchmark.pedantic(run, iterations=1, rounds=10)
+    redis_stats.save(benchmark)
+
+
+@pytest.mark.parametrize('concurrency', [1, 10])
+@pytest.mark.parametrize('workload', WORKLOADS)
+def test_async_pop_workload(
+    benchmark,
+    concurrency,
+    workload,
+    redis_server,
+    redis_slowlog,
+    redis_stats,
+):
+    """
+    Same as ``test_pop_workload``, with ``AsyncThrottledQueue`` and `concurrency` pops in flight.
+    """
+    loop = asyncio.new_event_loop()
+    client = AsyncStrictRedis(unix_socket_path=redis_server, decode_responses=True)
+    queue = AsyncThrottledQueue(client, 'test', limit=10, resolution=Resolution.MINUTE)
+
+    async def setup():
+        AsyncThrottledQueue._library_missing = True
+        await AsyncThrottledQueue.register_library(client)
+        for chunk in fill_items(*WORKLOADS[workload]):
+            await queue.push_many(chunk)
+
+    async def pops(window):
+        for _ in range(100 // concurrency):
+            await asyncio.gather(*(queue.pop(window) for _ in range(concurrency)))
+
+    try:
+        loop.run_until_complete(setup())
+        windows = iter(range(60))
+        redis_stats.reset()
+        benchmark.pedantic(lambda: loop.run_until_complete(pops(next(windows))), iterations=1, rounds=10)
+        redis_stats.save(benchmark, 'test:names')
+    finally:
+        loop.run_until_complete(client.aclose())
+        loop.close()
+
+
+WORDS = 'request response user account order payment invoice shipped pending failed retry timeout region node'.split()
+
+
+def make_documents(count):
+    """
+    JSON-like documents of 2-20 KB, with the kind of repetition real payloads have.
+    """
+    rng = random.Random(0)  # noqa: S311
+    for index in range(count):
+        yield {
+            'id': index,
+            'user': f'user{rng.randrange(1000)}',
+            'events': [
+                {
+                    'type': rng.choice(WORDS),
+                    'ts': 1700000000 + rng.randrange(10**6),
+                    'message': ' '.join(rng.choices(WORDS, k=rng.randint(5, 20))),
+                }
+                for _ in range(rng.randint(15, 150))
+            ],
+        }
+
+
+@pytest.mark.parametrize('codec', ['json', 'json+zlib', 'json+lzma', 'json+zstd'])
+@pytest.mark.parametrize('items', [1000])
+def test_codec(
+    benchmark,
+    codec,
+    items,
+    redis_server,
+    redis_slowlog,
+    redis_stats,
+):
+    """
+    Pushes `items` documents with every codec. The Redis memory used per item (``MEMORY USAGE`` of the queue keys) is saved
+    in the ``extra_info`` as ``bytes_per_item``.
+    """
+    if codec == 'json+zstd':
+        pytest.importorskip('zstandard')
+    codecs = {'json': JSONCodec, 'json+zlib': ZlibCodec, 'json+lzma': LzmaCodec, 'json+zstd': ZstdCodec}
+    client = StrictRedis(unix_socket_path=redis_server)
+    ThrottledQueue._library_missing = True
+    queue = ThrottledQueue(client, 'test', limit=10, codec=JSONCodec() if codec == 'json' else JSONCodec() | codecs[codec]())
+    documents = list(make_documents(items))
+
+    def run():
+        queue.cleanup()
+        queue.push_many((f'N{index % 10}', document) for index, document in enumerate(documents))
+
+    redis_stats.reset()
+    benchmark.pedantic(run, iterations=1, rounds=5)
+    redis_stats.save(benchmark)
+    benchmark.extra_info['bytes_per_item'] = sum(client.memory_usage(f'test:queue:N{name}', samples=0) for name in range(10)) / items
+    client.close()
+
+
+@pytest.mark.parametrize('payload_threshold', [None, 64])
+@pytest.mark.parametrize('payload_size', [100, 10000])
+def test_out_of_line(
+    benchmark,
+    payload_threshold,
+    payload_size,
+    redis_conn: StrictRedis,
+    redis_slowlog,
+    redis_stats,
+):
+    """
+    Pops 100 items every round from 10 names with 1000 items each, with the items inline or out of line. With out of
+    line storage the pop latency and the memory of the queue keys should not depend on the payload size.
+    """
+    queue = ThrottledQueue(redis_conn, 'test', limit=100, resolution=Resolution.MINUTE, payload_threshold=payload_threshold)
+    for chunk in fill_items(10, 1000):
+        queue.push_many((name, data.ljust(payload_size, '.')) for name, data in chunk)
+    windows = iter(range(60))
+    redis_stats.reset()
+    benchmark.pedantic(lambda: queue.pop_many(100, next(windows)), iterations=1, rounds=10)
+    redis_stats.save(benchmark, 'test:queue:N0', 'test:data:N0')
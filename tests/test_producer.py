@@ -0,0 +1,201 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+from time import sleep
+
+import pytest
+from redis.exceptions import ResponseError
+
+from redis_throttled_queue import AsyncThrottledQueue
+from redis_throttled_queue import Resolution
+from redis_throttled_queue import ThrottledQueue
+from redis_throttled_queue.memory import AsyncMemoryRedis
+from redis_throttled_queue.memory import MemoryRedis
+from redis_throttled_queue.metrics import Metrics
+from redis_throttled_queue.producer import AsyncBufferedProducer
+from redis_throttled_queue.producer import BufferedProducer
+
+
+@pytest.fixture(params=['redis', 'memory'])
+def client(request):
+    """
+    Returns a client for each backend, the tests using it must pass with both.
+    """
+    if request.param == 'redis':
+        return request.getfixturevalue('redis_conn')
+    else:
+        return MemoryRedis(decode_responses=True)
+
+
+def test_batches(client):
+    metrics = Metrics()
+    queue = ThrottledQueue(client, 'test', limit=100, resolution=Resolution.MINUTE, metrics=metrics)
+    with BufferedProducer(queue, max_items=10, max_delay=60) as producer:
+        futures = [producer.push(f'name{item % 3}', f'item{item}', priority=item) for item in range(25)]
+        # The first two batches are full and get sent right away, the rest waits for the flush.
+        assert [future.result(timeout=1) for future in futures[:20]] == [1] * 20
+        assert not futures[-1].done()
+        producer.flush()
+        assert all(future.done() for future in futures)
+        future = producer.push('name0', 'item0')
+    assert future.result() == 0
+    assert len(queue) == 25
+    assert sorted(queue.pop_many(3, 'w')) == ['item22', 'item23', 'item24']
+    assert metrics.snapshot()['counters'].items() >= {'push.added': 25, 'push.deduplicated': 1}.items()
+    assert metrics.snapshot()['latencies']['push_pipeline']['count'] == 4
+
+
+def test_delay(client):
+    queue = ThrottledQueue(client, 'test', limit=100)
+    with BufferedProducer(queue, max_items=100, max_delay=0.05) as producer:
+        future = producer.push('name', 'item')
+        sleep(0.01)
+        assert not future.done()
+        assert future.result(timeout=1) == 1
+
+
+def test_threads(client):
+    queue = ThrottledQueue(client, 'test', limit=1000, resolution=Resolution.MINUTE)
+    with BufferedProducer(queue, max_items=16, max_pending=32) as producer:
+        with ThreadPoolExecutor(8) as executor:
+            futures = list(executor.map(lambda item: producer.push(f'name{item % 5}', f'item{item}'), range(500)))
+    assert sum(future.result() for future in futures) == 500
+    assert len(queue) == 500
+
+
+def test_errors(redis_conn):
+    queue = ThrottledQueue(redis_conn, 'test', limit=10)
+    producer = BufferedProducer(queue, max_items=2)
+    pytest.raises(ValueError, producer.push, 'bad:name', 'item')
+    pytest.raises(ValueError, producer.push, 'name', 'item', cost=0)
+    redis_conn.set('test:queue:broken', 'string')
+    futures = [producer.push('name', 'item'), producer.push('broken', 'item')]
+    assert futures[0].result(timeout=1) == 1
+    pytest.raises(ResponseError, futures[1].result, timeout=1)
+    producer.close()
+    pytest.raises(RuntimeError, producer.push, 'name', 'item')
+    pytest.raises(ValueError, BufferedProducer, queue, max_items=0)
+    pytest.raises(ValueError, BufferedProducer, queue, max_items=10, max_pending=5)
+
+
+def test_backpressure():
+    queue = ThrottledQueue(MemoryRedis(), 'test', limit=10)
+    unblock = Event()
+    push_each = queue._push_each
+
+    def slow_push_each(calls):
+        unblock.wait()
+        return push_each(calls)
+
+    queue._push_each = slow_push_each
+    with BufferedProducer(queue, max_items=2, max_delay=60, max_pending=2) as producer:
+        futures = [producer.push('name', item) for item in 'abcd']
+        # The first batch is stuck in the flusher and the other one fills up the buffer.
+        pytest.raises(TimeoutError, producer.push, 'name', 'e', timeout=0.05)
+        unblock.set()
+        futures.append(producer.push('name', 'e', timeout=1))
+    assert [future.result() for future in futures] == [1] * 5
+    assert len(queue) == 5
+
+
+def test_delay_after_batch():
+    queue = ThrottledQueue(MemoryRedis(), 'test', limit=10)
+    unblock = Event()
+    push_each = queue._push_each
+
+    def slow_push_each(calls):
+        unblock.wait()
+        return push_each(calls)
+
+    queue._push_each = slow_push_each
+    with BufferedProducer(queue, max_items=2, max_delay=0.2) as producer:
+        futures = [producer.push('name', item) for item in 'abcde']
+        sleep(0.3)
+        unblock.set()
+        # The item left after the second batch was pushed more than max_delay ago, thus it doesn't wait again.
+        assert futures[-1].result(timeout=0.1) == 1
+
+
+async def test_asyncio():
+    metrics = Metrics()
+    queue = AsyncThrottledQueue(AsyncMemoryRedis(decode_responses=True), 'test', limit=100, resolution=Resolution.MINUTE, metrics=metrics)
+    async with AsyncBufferedProducer(queue, max_items=10, max_delay=60, max_pending=20) as producer:
+        futures = [await producer.push(f'name{item % 3}', f'item{item}', priority=item) for item in range(25)]
+        assert await asyncio.gather(*futures[:20]) == [1] * 20
+        assert not futures[-1].done()
+        await producer.flush()
+        assert all(future.done() for future in futures)
+        future = await producer.push('name0', 'item0')
+    assert await future == 0
+    assert await queue.size() == 25
+    assert metrics.snapshot()['counters'] == {'push.added': 25, 'push.deduplicated': 1}
+    with pytest.raises(RuntimeError):
+        await producer.push('name', 'item')
+
+
+async def test_asyncio_delay():
+    queue = AsyncThrottledQueue(AsyncMemoryRedis(), 'test', limit=100)
+    producer = AsyncBufferedProducer(queue, max_delay=0.05)
+    future = await producer.push('name', 'item')
+    await asyncio.sleep(0.01)
+    assert not future.done()
+    assert await asyncio.wait_for(future, 1) == 1
+    await producer.aclose()
+
+
+async def test_asyncio_backpressure():
+    queue = AsyncThrottledQueue(AsyncMemoryRedis(), 'test', limit=10)
+    unblock = asyncio.Event()
+    push_each = queue._push_each
+
+    async def slow_push_each(calls):
+        await unblock.wait()
+        return await push_each(calls)
+
+    class Pending(list):
+        most = 0
+
+        def append(self, value):
+            super().append(value)
+            Pending.most = max(Pending.most, len(self))
+
+    queue._push_each = slow_push_each
+    async with AsyncBufferedProducer(queue, max_items=2, max_delay=60, max_pending=2) as producer:
+        producer._pending = Pending()
+        futures = [await producer.push('name', item) for item in 'ab']
+        await asyncio.sleep(0.01)
+        # The first batch is stuck in the flusher and the other one fills up the buffer.
+        futures += [await producer.push('name', item) for item in 'cd']
+        with pytest.raises(TimeoutError):
+            await producer.push('name', 'e', timeout=0.05)
+        waiting = [asyncio.ensure_future(producer.push('name', item, timeout=1)) for item in 'fghij']
+        await asyncio.sleep(0.01)
+        unblock.set()
+        futures += await asyncio.gather(*waiting)
+    assert await asyncio.gather(*futures) == [1] * 9
+    assert Pending.most == 2
+    assert await queue.size() == 9
+
+
+async def test_asyncio_cancel():
+    queue = AsyncThrottledQueue(AsyncMemoryRedis(), 'test', limit=10)
+    unblock = asyncio.Event()
+
+    async def stuck_push_each(calls):
+        await unblock.wait()
+
+    queue._push_each = stuck_push_each
+    producer = AsyncBufferedProducer(queue, max_items=2, max_delay=60, max_pending=2)
+    futures = [await producer.push('name', item) for item in 'ab']
+    await asyncio.sleep(0.01)
+    futures += [await producer.push('name', item) for item in 'cd']
+    waiting = asyncio.ensure_future(producer.push('name', 'e'))
+    flushing = asyncio.ensure_future(producer.flush())
+    await asyncio.sleep(0.01)
+    producer._task.cancel()
+    await asyncio.wait_for(flushing, 1)
+    with pytest.raises(RuntimeError):
+        await asyncio.wait_for(waiting, 1)
+    assert all(future.cancelled() for future in futures)
+    with pytest.raises(asyncio.CancelledError):
+        await producer.aclose()
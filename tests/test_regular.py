@@ -1,11 +1,15 @@
+from threading import Timer
 from time import sleep
+from time import time
 from types import SimpleNamespace
 
 import freezegun
 import pytest
 from redis.client import StrictRedis
 
+from redis_throttled_queue import PopStatus
 from redis_throttled_queue import Resolution
+from redis_throttled_queue import Strategy
 from redis_throttled_queue import ThrottledQueue
 
 pytest_plugins = ('pytester',)
@@ -87,6 +91,309 @@ def test_dupes(redis_conn: StrictRedis, redis_monitor):
     assert len(queue) == 0
 
 
+def test_push_many(redis_conn: StrictRedis, redis_monitor):
+    queue = ThrottledQueue(redis_conn, 'test', limit=5, resolution=Resolution.SECOND)
+    assert queue.push_many([]) == 0
+    assert queue.push_many([('aaaaaa', f'a{item}', 10 - item) for item in range(10)]) == 10
+    assert queue.push_many({'bbbbbb': [(f'b{item}', 10 - item) for item in range(10)]}) == 10
+    assert queue.push_many([('aaaaaa', 'a0', 20), ('aaaaaa', 'a9'), ('bbbbbb', 'b0', 20)]) == 0
+    assert queue.push_many({'cccccc': ['c0', 'c0']}) == 1
+
+    assert len(queue) == 21
+    items = ','.join(queue.pop() for _ in range(11))
+    assert items == 'a0,b0,c0,a1,b1,a2,b2,a3,b3,a4,b4'
+    assert len(queue) == 10
+    pytest.raises(ValueError, queue.push_many, [('a:b', 'x')])
+    assert len(queue) == 10
+
+
+def test_pop_many(redis_conn: StrictRedis, redis_monitor):
+    queue = ThrottledQueue(redis_conn, 'test', limit=5, resolution=Resolution.SECOND)
+    assert queue.pop_many(10) == []
+    for item in range(10):
+        queue.push('aaaaaa', f'a{item}', priority=10 - item)
+    for item in range(10):
+        queue.push('bbbbbb', f'b{item}', priority=10 - item)
+    queue.push('cccccc', 'c0')
+
+    assert len(queue) == 21
+    assert queue.pop_many(4) == ['a0', 'b0', 'c0', 'a1']
+    assert queue.pop_many(3, with_names=True) == [('bbbbbb', 'b1'), ('aaaaaa', 'a2'), ('bbbbbb', 'b2')]
+    assert len(queue) == 14
+    assert queue.pop_many(100) == ['a3', 'b3', 'a4', 'b4']
+    assert queue.pop_many(100) == []
+    assert len(queue) == 10
+
+    sleep(1)
+
+    assert queue.pop_many(100) == ['a5', 'b5', 'a6', 'b6', 'a7', 'b7', 'a8', 'b8', 'a9', 'b9']
+    assert len(queue) == 0
+
+
+def test_usage_sparse(redis_conn: StrictRedis, redis_monitor):
+    queue = ThrottledQueue(redis_conn, 'test', limit=2, resolution=Resolution.SECOND)
+    for name in range(100):
+        queue.push(f'N{name:02}', f'n{name}')
+
+    assert queue.pop('X') == 'n0'
+    assert queue.pop('X') == 'n1'
+    # The scores have a fractional part that breaks ties (in the order the names were served).
+    assert [(name, round(score)) for name, score in redis_conn.zrange('test:usage:X', 0, -1, withscores=True)] == [('N01', -1), ('N00', -1)]
+    assert redis_conn.zcard('test:names') == 98
+
+    queue.push('N00', 'n0-again')
+    queue.push('N01', 'n1-again')
+    assert queue.pop_many(98, 'X') == [f'n{name}' for name in range(2, 100)]
+    assert queue.pop_many(10, 'X') == ['n0-again', 'n1-again']
+    assert [round(redis_conn.zscore('test:usage:X', name)) for name in ('N00', 'N01', 'N02', 'N03')] == [-2, -2, -1, -1]
+    assert queue.pop('X') is None
+    assert len(queue) == 0
+    assert redis_conn.zcard('test:usage:X') == 100
+
+
+def test_limits(redis_conn: StrictRedis, redis_monitor):
+    queue = ThrottledQueue(redis_conn, 'test', limit=2, resolution=Resolution.SECOND)
+    queue.set_limits({'aaaaaa': 4, 'bbbbbb': 1, 'cccccc': 0})
+    queue.set_limit('dddddd', 3)
+    queue.set_limit('dddddd', None)
+    assert queue.limits() == {'aaaaaa': 4, 'bbbbbb': 1, 'cccccc': 0}
+    with pytest.raises(ValueError):
+        queue.set_limit('dddddd', -1)
+    for name in 'abcd':
+        for item in range(5):
+            queue.push(name * 6, f'{name}{item}', priority=-item)
+
+    assert queue.pop_many(100, 'X') == ['a0', 'b0', 'd0', 'a1', 'd1', 'a2', 'a3']
+    assert redis_conn.zrange('test:usage:X', 0, -1, withscores=True) == [
+        ('aaaaaa', float('inf')),
+        ('bbbbbb', float('inf')),
+        ('cccccc', float('inf')),
+        ('dddddd', float('inf')),
+    ]
+    assert queue.pop('X') is None
+
+    queue.set_limits({'aaaaaa': None, 'cccccc': None, 'dddddd': 1})
+    assert queue.pop_many(100, 'Y') == ['a4', 'b1', 'c0', 'd2', 'c1']
+    assert queue.pop('Y') is None
+
+
+def test_out_of_line(redis_conn: StrictRedis, redis_monitor):
+    queue = ThrottledQueue(redis_conn, 'test', limit=10, resolution=Resolution.MINUTE, payload_threshold=100)
+    big = 'x' * 1000
+    assert queue.push('aaaaaa', big) == 1
+    assert queue.push('aaaaaa', big, priority=5) == 0
+    assert queue.push_many([('aaaaaa', 'y' * 100, 3, 2), ('aaaaaa', 'small', 4)]) == 2
+    members = redis_conn.zrange('test:queue:aaaaaa', 0, -1)
+    assert sorted(map(len, members)) == [5, 32, 32]
+    assert redis_conn.hlen('test:data:aaaaaa') == 2
+    assert queue.pop_many(2, 'X') == [big, 'small']
+    assert queue.extract(['aaaaaa']) == [('aaaaaa', 'y' * 100, 3, 2)]
+    assert not redis_conn.exists('test:data:aaaaaa')
+
+    queue.push('bbbbbb', big)
+    queue.push('cccccc', big)
+    assert queue.pop_ex('Y')[:3] == (PopStatus.ITEM, big, 'bbbbbb')
+    queue.cleanup()
+    assert redis_conn.keys() == []
+    with pytest.raises(ValueError):
+        ThrottledQueue(redis_conn, 'test', payload_threshold=0)
+
+
+def test_weights(redis_conn: StrictRedis, redis_monitor):
+    queue = ThrottledQueue(redis_conn, 'test', limit=100, resolution=Resolution.MINUTE)
+    queue.set_weights({'aaaaaa': 3, 'bbbbbb': 2})
+    queue.set_weights({'bbbbbb': None})
+    assert queue.weights() == {'aaaaaa': 3}
+    with pytest.raises(ValueError):
+        queue.set_weights({'bbbbbb': 0})
+    for name in 'abc':
+        for item in range(8):
+            queue.push(name * 6, f'{name}{item}', priority=-item)
+
+    assert queue.pop_many(12, 'X') == ['a0', 'b0', 'c0', 'a1', 'a2', 'a3', 'b1', 'c1', 'a4', 'a5', 'a6', 'b2']
+    assert queue.stats(window='X').by_usage == [('aaaaaa', 7), ('bbbbbb', 3), ('cccccc', 2)]
+
+
+def test_classes(redis_conn: StrictRedis, redis_monitor):
+    queue = ThrottledQueue(redis_conn, 'test', limit=2, resolution=Resolution.MINUTE)
+    queue.set_classes({'bbbbbb': 1})
+    assert queue.classes() == {'bbbbbb': 1}
+    with pytest.raises(ValueError):
+        queue.set_classes({'bbbbbb': 16})
+    for name in 'abc':
+        for item in range(3):
+            queue.push(name * 6, f'{name}{item}', priority=-item)
+
+    # The names in class 1 only get items once the names in class 0 reached their limit.
+    assert queue.pop_many(10, 'X') == ['a0', 'c0', 'a1', 'c1', 'b0', 'b1']
+    assert queue.pop_many(10, 'Y') == ['a2', 'c2', 'b2']
+
+
+def test_fair_ties(redis_conn: StrictRedis, redis_monitor):
+    queue = ThrottledQueue(redis_conn, 'test', limit=10, resolution=Resolution.MINUTE)
+    for name in ('zzzzzz', 'aaaaaa', 'mmmmmm'):
+        for item in range(3):
+            queue.push(name, f'{name[0]}{item}', priority=-item)
+
+    # Names with the same usage are served in the order they got there, not in the order of their names.
+    assert queue.pop_many(9, 'X') == ['z0', 'a0', 'm0', 'z1', 'a1', 'm1', 'z2', 'a2', 'm2']
+
+
+def test_stats(redis_conn: StrictRedis, redis_monitor):
+    queue = ThrottledQueue(redis_conn, 'test', limit=2, resolution=Resolution.MINUTE)
+    assert queue.stats() == (0, 0, [], [])
+    queue.push_many((f'name{index}', f'item{item}') for index in range(5) for item in range(index + 1))
+    assert queue.stats(3, page_size=2) == (15, 5, [('name4', 5), ('name3', 4), ('name2', 3)], [])
+    assert queue.pop_many(7, with_names=True) == [
+        ('name0', 'item0'),
+        ('name1', 'item1'),
+        ('name2', 'item2'),
+        ('name3', 'item3'),
+        ('name4', 'item4'),
+        ('name1', 'item0'),
+        ('name2', 'item1'),
+    ]
+    total, active_names, by_depth, by_usage = queue.stats(3, page_size=2)
+    assert (total, active_names) == (8, 3)
+    assert by_depth == [('name4', 4), ('name3', 3), ('name2', 1)]
+    assert sorted(by_usage[:2]) == [('name1', 2), ('name2', 2)]
+    assert by_usage[2] in [('name0', 1), ('name3', 1), ('name4', 1)]
+    assert sorted(queue.stats(10).by_usage) == [('name0', 1), ('name1', 2), ('name2', 2), ('name3', 1), ('name4', 1)]
+    assert queue.stats(10, window='other').by_usage == []
+
+
+def test_cost(redis_conn: StrictRedis, redis_monitor):
+    queue = ThrottledQueue(redis_conn, 'test', limit=5, resolution=Resolution.MINUTE)
+    pytest.raises(ValueError, queue.push, 'aaaaaa', 'a0', cost=0)
+    pytest.raises(ValueError, queue.push_many, [('aaaaaa', 'a0', 0, 1.5)])
+    queue.push('aaaaaa', 'big', priority=2, cost=4)
+    queue.push('aaaaaa', 'small', priority=1)
+    queue.push('aaaaaa', 'huge', cost=10)
+    queue.push_many([('bbbbbb', 'b0'), ('bbbbbb', 'b1'), ('bbbbbb', 'b2')])
+    assert queue.pop_many(10, 'X') == ['big', 'b2', 'b1', 'b0', 'small']
+    assert queue.stats(window='X').by_usage == [('aaaaaa', 5), ('bbbbbb', 3)]
+    # Items that cost more than the limit get popped at the start of a window.
+    assert queue.pop_many(10, 'Y') == ['huge']
+
+    queue.push_many([('aaaaaa', 'a0', 1, 3), ('aaaaaa', 'a1', 0, 3), ('bbbbbb', 'b0')])
+    assert queue.pop_many(10, 'Z') == ['a0', 'b0']
+    # The next item of aaaaaa doesn't fit (3 + 3 > 5), it waits for the next window.
+    assert queue.pop_ex('Z').status is PopStatus.THROTTLED
+    assert queue.extract(['aaaaaa']) == [('aaaaaa', 'a1', 0, 3)]
+    assert len(queue) == 0
+
+
+def test_gcra_cost(redis_conn: StrictRedis, redis_monitor):
+    queue = ThrottledQueue(redis_conn, 'test', limit=5, resolution=Resolution.SECOND, strategy=Strategy.GCRA)
+    queue.push('aaaaaa', 'a0', priority=1, cost=3)
+    queue.push('aaaaaa', 'a1')
+    assert queue.pop() == 'a0'
+    status, value, name, priority, retry_after = queue.pop_ex()
+    assert status is PopStatus.THROTTLED
+    assert retry_after == pytest.approx(0.6, abs=0.05)
+
+
+def test_gcra(redis_conn: StrictRedis, redis_monitor):
+    queue = ThrottledQueue(redis_conn, 'test', limit=5, resolution=Resolution.SECOND, strategy=Strategy.GCRA)
+    assert queue.pop_ex() == (PopStatus.EMPTY, None, None, None, None)
+    for item in range(6):
+        queue.push('aaaaaa', f'a{item}', priority=10 - item)
+    queue.push('bbbbbb', 'b0')
+    assert queue.pop() == 'a0'
+    assert queue.pop() == 'b0'
+    assert queue.pop() is None
+    status, value, name, priority, retry_after = queue.pop_ex()
+    assert status is PopStatus.THROTTLED
+    assert retry_after == pytest.approx(0.2, abs=0.05)
+
+    start = time()
+    assert [queue.pop(timeout=1) for _ in range(4)] == ['a1', 'a2', 'a3', 'a4']
+    assert time() - start == pytest.approx(0.8, abs=0.1)
+
+    queue.set_limit('aaaaaa', 10)
+    queue.push('bbbbbb', 'b1')
+    start = time()
+    assert queue.pop_many(10, with_names=True) == [('bbbbbb', 'b1')]
+    assert queue.pop(timeout=1) == 'a5'
+    assert time() - start == pytest.approx(0.2, abs=0.05)
+    assert len(queue) == 0
+    queue.cleanup()
+    assert redis_conn.keys('*') == []
+
+
+@pytest.mark.parametrize('server_time', [False, True])
+def test_subsecond_resolution(redis_conn: StrictRedis, redis_monitor, server_time):
+    queue = ThrottledQueue(redis_conn, 'test', limit=3, resolution=0.2, server_time=server_time)
+    for item in range(7):
+        queue.push('aaaaaa', f'a{item}', priority=10 - item)
+    sleep(0.2 - time() % 0.2)  # so the pops below don't straddle two windows
+    assert queue.pop_many(10) == ['a0', 'a1', 'a2']
+    status, value, name, priority, retry_after = queue.pop_ex()
+    assert status is PopStatus.THROTTLED
+    assert 0 < retry_after <= 0.2
+    assert all(0 < redis_conn.pttl(key) <= 200 for key in redis_conn.keys('test:window:*'))
+
+    start = time()
+    assert [queue.pop(timeout=1) for _ in range(4)] == ['a3', 'a4', 'a5', 'a6']
+    assert time() - start <= 0.45
+    queue.cleanup()
+    assert redis_conn.keys('*') == []
+
+
+def test_gcra_burst(redis_conn: StrictRedis, redis_monitor):
+    queue = ThrottledQueue(redis_conn, 'test', limit=10, resolution=Resolution.SECOND, strategy=Strategy.GCRA, burst=3)
+    for item in range(5):
+        queue.push('aaaaaa', f'a{item}', priority=10 - item)
+    assert queue.pop_many(10) == ['a0', 'a1', 'a2']
+    assert queue.pop_many(10) == []
+    sleep(0.1)
+    assert queue.pop_many(10) == ['a3']
+    sleep(0.3)
+    assert queue.pop_many(10) == ['a4']
+
+
+def test_pop_timeout(redis_conn: StrictRedis, redis_monitor):
+    queue = ThrottledQueue(redis_conn, 'test', limit=1, resolution=Resolution.SECOND)
+    start = time()
+    assert queue.pop('X', timeout=0.2) is None
+    assert time() - start == pytest.approx(0.2, abs=0.1)
+
+    pusher = Timer(0.2, queue.push, ('aaaaaa', 'a0'))
+    pusher.start()
+    start = time()
+    assert queue.pop('X', timeout=5) == 'a0'
+    assert time() - start == pytest.approx(0.2, abs=0.1)
+    pusher.join()
+
+    queue.push('aaaaaa', 'a1')
+    queue.push('aaaaaa', 'a2')
+    assert queue.pop() == 'a2'
+    start = time()
+    assert queue.pop(timeout=5) == 'a1'
+    assert time() - start <= 1
+    assert len(queue) == 0
+
+
+def test_pop_ex(redis_conn: StrictRedis, redis_monitor):
+    queue = ThrottledQueue(redis_conn, 'test', limit=1, resolution=Resolution.MINUTE)
+    assert queue.pop_ex() == (PopStatus.EMPTY, None, None, None, None)
+    queue.push('aaaaaa', 'a0', priority=5)
+    queue.push('aaaaaa', 'a1', priority=4)
+
+    assert queue.pop_ex('X') == (PopStatus.ITEM, 'a0', 'aaaaaa', 5, None)
+    status, value, name, priority, retry_after = queue.pop_ex('X')
+    assert status is PopStatus.THROTTLED
+    assert retry_after == pytest.approx(60, abs=0.5)
+    assert queue.pop_ex('Y') == (PopStatus.ITEM, 'a1', 'aaaaaa', 4, None)
+    assert queue.pop_ex('Y') == (PopStatus.EMPTY, None, None, None, None)
+
+    queue.push('aaaaaa', 'a2')
+    with freezegun.freeze_time('2022-02-22 00:00:45'):
+        assert queue.pop_ex().status is PopStatus.ITEM
+        queue.push('aaaaaa', 'a3')
+        assert queue.pop_ex() == (PopStatus.THROTTLED, None, None, None, 15)
+
+
 def test_cleanup(redis_conn: StrictRedis, redis_monitor):
     queue = ThrottledQueue(redis_conn, 'test', limit=5, resolution=Resolution.SECOND)
     for item in range(10):
@@ -105,6 +412,7 @@ def test_cleanup(redis_conn: StrictRedis, redis_monitor):
     sleep(1)
 
     queue.cleanup()
+    assert redis_conn.keys('*') == []
     assert len(queue) == 0
     assert queue.pop() is None
     assert get_ttl(redis_conn) == {}
@@ -119,10 +427,45 @@ def test_cleanup_directly(redis_conn: StrictRedis, redis_monitor):
 
     assert len(queue) == 20
     queue.cleanup()
+    assert redis_conn.keys('*') == []
     assert len(queue) == 0
     assert queue.pop() is None
 
 
+def test_cleanup_batch(redis_conn: StrictRedis, redis_monitor):
+    redis_conn.set('other', 'stuff')
+    queue = ThrottledQueue(redis_conn, 'test', limit=1, resolution=Resolution.SECOND)
+    queue.push_many((f'name{index}', f'item{index}-{item}') for index in range(5) for item in range(2))
+    assert len(queue.pop_many(10)) == 5
+    pytest.raises(ValueError, queue.cleanup, 0)
+
+    steps = queue.cleanup(batch=2)
+    assert next(steps) == 2
+    assert len(queue) == 3
+    assert list(steps) == [2, 1 + 2 + 3]
+    assert redis_conn.keys('*') == ['other']
+    assert len(queue) == 0
+    assert list(queue.cleanup(batch=2)) == [0]
+
+
+def test_cluster_prefix(redis_conn: StrictRedis, redis_monitor):
+    queue = ThrottledQueue(redis_conn, 'test', limit=5, resolution=Resolution.SECOND, cluster=True)
+    queue.push('aaaaaa', 'a0')
+    queue.push_many([('bbbbbb', 'b0', 1), ('bbbbbb', 'b1')])
+    assert len(queue) == 3
+    assert queue.pop() == 'a0'
+    assert queue.pop_many(2) == ['b0', 'b1']
+    assert len(queue) == 0
+    assert redis_conn.keys('*')
+    assert all(key.startswith('{test}:') for key in redis_conn.keys('*'))
+    queue.cleanup()
+    assert redis_conn.keys('*') == []
+
+    assert ThrottledQueue(redis_conn, 'te{st}', cluster=True)._prefix == 'te{st}'
+    assert ThrottledQueue(redis_conn, 'te{}st', cluster=True)._prefix == '{te{}st}'
+    assert ThrottledQueue(redis_conn, 'test')._prefix == 'test'
+
+
 def test_cleanup_nothing(redis_conn: StrictRedis, redis_monitor):
     queue = ThrottledQueue(redis_conn, 'test', limit=5, resolution=Resolution.SECOND)
     assert len(queue) == 0
@@ -231,21 +574,44 @@ def test_mocked_resolution():
         )
         queue.pop()
         assert calls == [
-            ('RTQ_POP', 0, 'foobar', 0, '?', 10),
+            ('RTQ_POP', 1, 'foobar', 0, '?', 10, 10),
         ]
         ft.tick(9)
         queue.pop()
         assert calls == [
-            ('RTQ_POP', 0, 'foobar', 0, '?', 10),
-            ('RTQ_POP', 0, 'foobar', 0, '?', 10),
+            ('RTQ_POP', 1, 'foobar', 0, '?', 10, 10),
+            ('RTQ_POP', 1, 'foobar', 0, '?', 10, 10),
         ]
         ft.tick(1)
         queue.pop()
         assert calls == [
-            ('RTQ_POP', 0, 'foobar', 0, '?', 10),
-            ('RTQ_POP', 0, 'foobar', 0, '?', 10),
-            ('RTQ_POP', 0, 'foobar', 1, '?', 10),
+            ('RTQ_POP', 1, 'foobar', 0, '?', 10, 10),
+            ('RTQ_POP', 1, 'foobar', 0, '?', 10, 10),
+            ('RTQ_POP', 1, 'foobar', 1, '?', 10, 10),
+        ]
+
+
+def test_mocked_subsecond_resolution():
+    calls = []
+    conn = SimpleNamespace(info=lambda: {'redis_version': '10'}, function_list=lambda _: [1], fcall=lambda *args: calls.append(args))
+    with freezegun.freeze_time('2022-02-22') as ft:
+        queue = ThrottledQueue(conn, 'foobar', limit='?', resolution=0.25)
+        queue.pop()
+        ft.tick(0.2)
+        queue.pop()
+        ft.tick(0.05)
+        queue.pop()
+        ft.tick(14.75)
+        queue.pop()
+        assert calls == [
+            ('RTQ_POP', 1, 'foobar', 0, '?', 0.25, 10),
+            ('RTQ_POP', 1, 'foobar', 0, '?', 0.25, 10),
+            ('RTQ_POP', 1, 'foobar', 1, '?', 0.25, 10),
+            ('RTQ_POP', 1, 'foobar', 0, '?', 0.25, 10),
         ]
+    queue = ThrottledQueue(conn, 'foobar', limit='?', resolution=Resolution.MINUTE, server_time=True)
+    queue.pop()
+    assert calls[-1] == ('RTQ_POP', 1, 'foobar', '', '?', 60, 10)
 
 
 def test_mocked_window():
@@ -259,12 +625,24 @@ def test_mocked_window():
     )
     queue.pop(window='foobar1')
     assert calls == [
-        ('RTQ_POP', 0, 'foobar', 'foobar1', '?', 10),
+        ('RTQ_POP', 1, 'foobar', 'foobar1', '?', 10, 10),
     ]
     queue.pop(window='foobar2')
     assert calls == [
-        ('RTQ_POP', 0, 'foobar', 'foobar1', '?', 10),
-        ('RTQ_POP', 0, 'foobar', 'foobar2', '?', 10),
+        ('RTQ_POP', 1, 'foobar', 'foobar1', '?', 10, 10),
+        ('RTQ_POP', 1, 'foobar', 'foobar2', '?', 10, 10),
+    ]
+
+
+def test_mocked_gcra():
+    calls = []
+    conn = SimpleNamespace(info=lambda: {'redis_version': '10'}, function_list=lambda _: [1], fcall=lambda *args: calls.append(args) or [])
+    queue = ThrottledQueue(conn, 'foobar', limit='?', resolution=10, strategy=Strategy.GCRA, burst=2)
+    queue.pop(window='foobar1')
+    queue.pop_many(5)
+    assert calls == [
+        ('RTQ_GCRA_POP', 1, 'foobar', '?', 10, 2, 10),
+        ('RTQ_GCRA_POP_MANY', 1, 'foobar', '?', 10, 2, 10, 5),
     ]
 
 
@@ -274,4 +652,5 @@ def test_validation():
     conn = SimpleNamespace(info=lambda: {'redis_version': '10'}, register_script=lambda _: None)
     pytest.raises(TypeError, ThrottledQueue, conn, b'caca')
     pytest.raises(TypeError, ThrottledQueue, conn, 123)
+    pytest.raises(ValueError, ThrottledQueue, conn, 'foo', resolution=0)
     pytest.raises(ValueError, ThrottledQueue(conn, 'foo').push, ':', None)
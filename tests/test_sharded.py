@@ -0,0 +1,183 @@
+from collections import Counter
+from time import sleep
+from time import time
+
+import pytest
+from redis.client import StrictRedis
+
+from redis_throttled_queue import PopStatus
+from redis_throttled_queue import Resolution
+from redis_throttled_queue import ThrottledQueue
+from redis_throttled_queue.sharded import HashRing
+from redis_throttled_queue.sharded import ShardedThrottledQueue
+
+
+def make_shards(redis_conn, count, **kwargs):
+    return {f'shard{index}': ThrottledQueue(redis_conn, f'shard{index}', **kwargs) for index in range(count)}
+
+
+def test_hash_ring():
+    ring = HashRing(['a', 'b', 'c'])
+    names = [f'name{index}' for index in range(3000)]
+    owners = {name: ring.get(name) for name in names}
+    assert owners == {name: ring.get(name.encode()) for name in names}
+    assert all(count > 700 for count in Counter(owners.values()).values())
+
+    bigger = HashRing(['a', 'b', 'c', 'd'])
+    moved = [name for name in names if bigger.get(name) != owners[name]]
+    assert all(bigger.get(name) == 'd' for name in moved)
+    assert 500 < len(moved) < 1000
+
+
+def test_push_pop(redis_conn: StrictRedis, redis_monitor):
+    shards = make_shards(redis_conn, 3, limit=2, resolution=Resolution.MINUTE)
+    queue = ShardedThrottledQueue(shards)
+    for name in range(10):
+        for item in range(3):
+            queue.push(f'name{name}', f'{name}-{item}', priority=-item)
+    assert len(queue) == 30
+    for name in range(10):
+        assert [f'name{name}' in shard.names() for shard in shards.values()].count(True) == 1
+
+    items = [queue.pop() for _ in range(20)]
+    assert sorted(items) == sorted(f'{name}-{item}' for name in range(10) for item in range(2))
+    assert queue.pop() is None
+    status, *_, retry_after = queue.pop_ex()
+    assert status is PopStatus.THROTTLED
+    assert 0 < retry_after <= 60
+    assert len(queue) == 10
+
+    assert sum(queue.cleanup(batch=3)) > 10
+    assert redis_conn.keys('*') == []
+    assert len(queue) == 0
+    assert queue.pop_ex().status is PopStatus.EMPTY
+
+
+def test_push_many_pop_many(redis_conn: StrictRedis, redis_monitor):
+    shards = make_shards(redis_conn, 3, limit=100)
+    queue = ShardedThrottledQueue(shards)
+    assert queue.push_many((f'name{index % 7}', f'item{index}') for index in range(50)) == 50
+    assert {shard_id: len(shard) for shard_id, shard in shards.items()} == {
+        shard_id: sum(1 for index in range(50) if queue._ring.get(f'name{index % 7}') == shard_id) for shard_id in shards
+    }
+    items = queue.pop_many(45, 'X')
+    assert len(items) == 45
+    items += queue.pop_many(45, 'X')
+    assert sorted(items) == sorted(f'item{index}' for index in range(50))
+    assert queue.pop_many(10, 'X') == []
+
+    queue.push('name1', 'one')
+    assert queue.pop_many(1, 'X', with_names=True) == [('name1', 'one')]
+
+
+def test_pop_timeout(redis_conn: StrictRedis, redis_monitor):
+    queue = ShardedThrottledQueue(make_shards(redis_conn, 2, limit=1), poll_interval=0.05)
+    start = time()
+    assert queue.pop(timeout=0.2) is None
+    assert time() - start == pytest.approx(0.2, abs=0.1)
+
+    queue.push('aaaaaa', 'a0', priority=1)
+    queue.push('aaaaaa', 'a1')
+    assert queue.pop(timeout=1) == 'a0'
+    start = time()
+    assert queue.pop(timeout=2) == 'a1'
+    assert time() - start <= 1.1
+
+
+def test_delayed(redis_conn: StrictRedis, redis_monitor):
+    shards = make_shards(redis_conn, 2, limit=1, resolution=Resolution.MINUTE)
+    queue = ShardedThrottledQueue(shards, poll_interval=1)
+    queue.push('aaaaaa', 'a0')
+    queue.push('aaaaaa', 'a1')
+    queue.push('cccccc', 'c0', not_before=time() + 0.2)
+    assert queue.shard_for('aaaaaa') is not queue.shard_for('cccccc')
+    assert queue.pop('X') == 'a1'
+    result = queue.pop_ex('X')
+    assert result.status is PopStatus.THROTTLED
+    assert result.retry_after == pytest.approx(0.2, abs=0.1)
+    start = time()
+    assert queue.pop('X', timeout=2) == 'c0'
+    assert time() - start == pytest.approx(0.2, abs=0.1)
+
+
+def test_expiry(redis_conn: StrictRedis, redis_monitor):
+    queue = ShardedThrottledQueue(make_shards(redis_conn, 2, limit=10, resolution=Resolution.MINUTE))
+    queue.push('aaaaaa', 'a0', expires_at=time() + 0.05)
+    queue.push('cccccc', 'c0', expires_at=time() + 0.05)
+    queue.push('cccccc', 'c1')
+    sleep(0.1)
+    assert queue.purge_expired() == 2
+    assert len(queue) == 1
+    assert queue.pop_many(10, 'X') == ['c1']
+
+
+def test_reshard(redis_conn: StrictRedis, redis_monitor):
+    shards = make_shards(redis_conn, 4, limit=100)
+    queue = ShardedThrottledQueue({shard_id: shards[shard_id] for shard_id in ('shard0', 'shard1')})
+    for name in range(20):
+        for item in range(3):
+            queue.push(f'name{name}', f'{name}-{item}', priority=item)
+    assert len(shards['shard2']) == len(shards['shard3']) == 0
+    on_shard1 = shards['shard1'].names()
+
+    moved = queue.reshard({shard_id: shards[shard_id] for shard_id in ('shard1', 'shard2', 'shard3')}, batch=3)
+    kept = [name for name in on_shard1 if queue.shard_for(name) is shards['shard1']]
+    assert moved == 60 - 3 * len(kept)
+    assert len(shards['shard0']) == 0
+    assert len(shards['shard2']) > 0
+    assert len(shards['shard3']) > 0
+    assert len(queue) == 60
+    for name in range(20):
+        shard = queue.shard_for(f'name{name}')
+        assert shard.names().count(f'name{name}') == 1
+    items = queue.pop_many(100, 'X')
+    assert sorted(items) == sorted(f'{name}-{item}' for name in range(20) for item in range(3))
+    # priorities were kept
+    assert [item for item in items if item.startswith('7-')] == ['7-2', '7-1', '7-0']
+
+
+def test_extract(redis_conn: StrictRedis, redis_monitor):
+    queue = ThrottledQueue(redis_conn, 'test', limit=100)
+    queue.push('aaaaaa', 'a0', priority=1)
+    queue.push('aaaaaa', 'a1', priority=2)
+    queue.push('bbbbbb', 'b0')
+    assert queue.extract([]) == []
+    assert sorted(queue.names()) == ['aaaaaa', 'bbbbbb']
+    assert queue.extract(['aaaaaa', 'cccccc']) == [('aaaaaa', 'a1', 2), ('aaaaaa', 'a0', 1)]
+    assert queue.names() == ['bbbbbb']
+    assert len(queue) == 1
+    assert queue.pop() == 'b0'
+
+
+def test_limits(redis_conn: StrictRedis, redis_monitor):
+    shards = make_shards(redis_conn, 3, limit=1)
+    queue = ShardedThrottledQueue({shard_id: shards[shard_id] for shard_id in ('shard0', 'shard1')})
+    queue.set_limits({f'name{index}': index for index in range(10)})
+    queue.set_limit('name0', None)
+    limits = {f'name{index}': index for index in range(1, 10)}
+    assert queue.limits() == limits
+    for name, limit in limits.items():
+        assert queue.shard_for(name).limits()[name] == limit
+
+    queue.reshard(shards)
+    assert queue.limits() == limits
+    for shard in shards.values():
+        assert shard.limits() == {name: limit for name, limit in limits.items() if queue.shard_for(name) is shard}
+    assert shards['shard2'].limits()
+
+
+def test_weights_and_classes(redis_conn: StrictRedis, redis_monitor):
+    shards = make_shards(redis_conn, 3, limit=1)
+    queue = ShardedThrottledQueue({shard_id: shards[shard_id] for shard_id in ('shard0', 'shard1')})
+    weights = {f'name{index}': index + 1 for index in range(10)}
+    classes = {f'name{index}': index % 2 for index in range(10)}
+    queue.set_weights(weights)
+    queue.set_classes(classes)
+    assert queue.weights() == weights
+    assert queue.classes() == classes
+
+    queue.reshard(shards)
+    assert queue.weights() == weights
+    assert queue.classes() == classes
+    for shard in shards.values():
+        assert shard.weights() == {name: weight for name, weight in weights.items() if queue.shard_for(name) is shard}
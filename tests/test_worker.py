@@ -0,0 +1,127 @@
+import signal
+import sys
+import threading
+from time import time
+
+import pytest
+from process_tests import TestProcess
+from process_tests import dump_on_error
+from process_tests import wait_for_strings
+from redis.client import StrictRedis
+
+from redis_throttled_queue import Resolution
+from redis_throttled_queue import ThrottledQueue
+from redis_throttled_queue.worker import Runner
+from redis_throttled_queue.worker import resolve_handler
+
+
+def test_resolve_handler():
+    assert resolve_handler('os.path:join') is __import__('os').path.join
+    assert resolve_handler('os:path.join') is __import__('os').path.join
+    assert resolve_handler(print) is print
+    with pytest.raises(ValueError):
+        resolve_handler('os.path.join')
+    with pytest.raises(TypeError):
+        resolve_handler('os:sep')
+
+
+def test_runner(redis_conn: StrictRedis, redis_server, redis_monitor):
+    queue = ThrottledQueue(redis_conn, 'test', limit=100, resolution=Resolution.SECOND)
+    for item in range(20):
+        queue.push('aaaaaa', f'a{item}')
+        queue.push('bbbbbb', f'b{item}')
+    items = []
+    lock = threading.Lock()
+
+    def handler(item):
+        with lock:
+            items.append(item)
+            if len(items) == 40:
+                runner.stop()
+
+    runner = Runner(f'unix://{redis_server}', 'test', handler, threads=3, batch=5, limit=100, redis_options={'decode_responses': True})
+    runner.run()
+    assert sorted(items) == sorted([f'a{item}' for item in range(20)] + [f'b{item}' for item in range(20)])
+    assert sum(stats.handled for stats in runner.stats) == 40
+    assert len(runner.stats) == 3
+    assert len(queue) == 0
+
+
+def test_runner_errors(redis_conn: StrictRedis, redis_server, redis_monitor):
+    queue = ThrottledQueue(redis_conn, 'test', limit=100, resolution=Resolution.SECOND)
+    for item in range(10):
+        queue.push('aaaaaa', f'a{item}')
+    handled = []
+
+    def handler(item):
+        handled.append(item)
+        if len(handled) == 10:
+            runner.stop()
+        if item in ('a3', 'a6'):
+            raise RuntimeError(item)
+
+    runner = Runner(f'unix://{redis_server}', 'test', handler, limit=100, redis_options={'decode_responses': True})
+    runner.run()
+    assert len(handled) == 10
+    assert [(stats.handled, stats.errors) for stats in runner.stats] == [(8, 2)]
+
+
+def test_runner_throttled(redis_conn: StrictRedis, redis_server, redis_monitor):
+    queue = ThrottledQueue(redis_conn, 'test', limit=2, resolution=Resolution.SECOND)
+    for item in range(4):
+        queue.push('aaaaaa', f'a{item}')
+    handled = []
+
+    def handler(item):
+        handled.append(time())
+        if len(handled) == 4:
+            runner.stop()
+
+    start = time()
+    runner = Runner(f'unix://{redis_server}', 'test', handler, threads=2, limit=2, poll_interval=5)
+    runner.run()
+    assert handled[-1] - start <= 1.1
+    assert int(handled[1]) != int(handled[2])
+
+
+def test_runner_stop_idle(redis_conn: StrictRedis, redis_server):
+    runner = Runner(f'unix://{redis_server}', 'test', print, threads=2, poll_interval=0.2)
+    threading.Timer(0.1, runner.stop).start()
+    start = time()
+    runner.run()
+    assert time() - start == pytest.approx(0.2, abs=0.15)
+    assert [stats.handled for stats in runner.stats] == [0, 0]
+
+
+@pytest.mark.parametrize('processes', [0, 2])
+def test_cli_sigterm(redis_conn: StrictRedis, redis_server, processes):
+    queue = ThrottledQueue(redis_conn, 'test', limit=100, resolution=Resolution.SECOND)
+    for item in range(5):
+        queue.push('aaaaaa', f'item-{item}')
+    with TestProcess(
+        sys.executable,
+        '-u',
+        '-m',
+        'redis_throttled_queue',
+        'worker',
+        'builtins:print',
+        '--url',
+        f'unix://{redis_server}',
+        '--prefix',
+        'test',
+        '--limit',
+        '100',
+        '--decode-responses',
+        '--threads',
+        '2',
+        '--processes',
+        str(processes),
+    ) as worker:
+        with dump_on_error(worker.read):
+            # the items have the same priority and two threads print them, so the order is not deterministic
+            for item in range(5):
+                wait_for_strings(worker.read, 5, f'item-{item}')
+            worker.signal(signal.SIGTERM)
+            wait_for_strings(worker.read, 5, 'Got signal SIGTERM, stopping.', '/thread-1:')
+            assert worker.proc.wait(5) == 0
+    assert len(queue) == 0